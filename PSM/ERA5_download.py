@@ -1,48 +1,291 @@
-import cdsapi
-c = cdsapi.Client()
-
-c.retrieve(
-    'reanalysis-era5-single-levels',
-    {
-        'format':'netcdf',
-        'variable':[ '10v'
-        ],        
-        'year':[
-            '1979', '1980', '1981', '1982', '1983', '1984', '1985', '1986', '1987', '1989',
-		'1990', '1991', '1992', '1993', '1994', '1995', '1996', '1997', '1998', '1999',
-		'2000', '2001', '2002', '2003', '2004', '2005', '2006', '2007', '2008', '2009',
-		'2010', '2011', '2012', '2013', '2014', '2015', '2016', '2017', '2018', '2019'
-        ],
-        'month':[
-            '01','02','03',
-            '04','05','06',
-            '07','08','09',
-            '10','11','12'
-        ],
-        'day':[
-            '01','02','03',
-            '04','05','06',
-            '07','08','09',
-            '10','11','12',
-            '13','14','15',
-            '16','17','18',
-            '19','20','21',
-            '22','23','24',
-            '25','26','27',
-            '28','29','30',
-            '31'
-        ],
-        'area': [70.22, 30.59, 65.22, 35.59], # North, West, South, East. Default: global
-        "product_type": "reanalysis",
-        'time':[
-            '00:00',#'01:00','02:00',
-            #'03:00','04:00','05:00',
-            '06:00',#'07:00','08:00',
-            #'09:00','10:00','11:00',
-            '12:00',#'13:00','14:00',
-            #'15:00','16:00','17:00',
-            '18:00'#,'19:00','20:00',
-            #'21:00','22:00','23:00'
-        ]
-    },
-    'Imandra_ERA5_10v.nc')
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+Download ERA5 single-level fields for the Imandra box from the Copernicus
+Climate Data Store.
+
+Requests are built from a list of variables and a range of years and split
+into one request per variable and year, which queue faster than one request
+for the whole record and can fail and be retried on their own. Chunks are
+downloaded concurrently by a small worker pool into a cache directory. A
+manifest in the cache records the request and the SHA-256 of every finished
+file, so a rerun (e.g. after an interruption) skips chunks that are already
+there and intact and downloads only the rest.
+
+The client is anything with a cdsapi-style ``retrieve(dataset, request,
+target)`` method; cdsapi.Client is used by default, and LocalClient serves
+canned NetCDF files from a directory for offline runs and tests.
+
+Usage:
+    python ERA5_download.py [first_year last_year [cache_dir]]
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DATASET = 'reanalysis-era5-single-levels'
+
+# Variables needed for met-input-Imandra-*.txt: air temperature, dewpoint (for
+# RH), 10 m wind components, down-welling short- and longwave radiation,
+# surface pressure and total precipitation
+VARIABLES = ['2t', '2d', '10u', '10v', 'ssrd', 'strd', 'sp', 'tp']
+AREA = [70.22, 30.59, 65.22, 35.59]  # North, West, South, East
+TIMES = ['00:00', '06:00', '12:00', '18:00']
+
+# Accumulated variables: each hourly value is the total of the hour before it,
+# so all hours are requested and era5_metinput sums them over each 6-hour step
+ACCUMULATED = ['ssrd', 'strd', 'tp']
+HOURS = [f'{h:02d}:00' for h in range(24)]
+
+MANIFEST = 'era5-manifest.json'
+
+
+def chunk_name(variable, year, prefix='Imandra_ERA5'):
+    """ File name of one variable-year chunk """
+    return f'{prefix}_{variable}_{year}.nc'
+
+
+def era5_requests(variables=VARIABLES, first_year=1979, last_year=2019, area=AREA, times=TIMES,
+                  prefix='Imandra_ERA5', accumulated=ACCUMULATED):
+    """ One CDS request per variable and year
+
+    Parameters
+    ----------
+
+    variables : list of str
+        ERA5 short names
+
+    first_year, last_year : int
+        Years requested, both included
+
+    area : list of float
+        North, West, South, East
+
+    times : list of str
+        Hours of the day of the instantaneous variables
+
+    prefix : str
+        Start of the chunk file names
+
+    accumulated : list of str
+        Variables requested for every hour of the day
+
+    Returns
+    -------
+
+    requests : list of (str, dict)
+        Chunk file name and CDS request
+
+    """
+    requests = []
+    for variable in variables:
+        for year in range(first_year, last_year + 1):
+            request = {
+                'product_type': 'reanalysis',
+                'format': 'netcdf',
+                'variable': [variable],
+                'year': [f'{year}'],
+                'month': [f'{m:02d}' for m in range(1, 13)],
+                'day': [f'{d:02d}' for d in range(1, 32)],
+                'time': list(HOURS if variable in accumulated else times),
+                'area': list(area),
+            }
+            requests.append((chunk_name(variable, year, prefix), request))
+    return requests
+
+
+def _sha256(path, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _request_key(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def _is_netcdf(path):
+    with open(path, 'rb') as fh:
+        magic = fh.read(4)
+    return magic[:3] == b'CDF' or magic == b'\x89HDF'
+
+
+class Cache:
+    """ Directory of downloaded chunks with a checksum manifest
+
+    Parameters
+    ----------
+
+    path : str
+        Cache directory, created if missing
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(path, MANIFEST)) as fh:
+                self.manifest = json.load(fh)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def target(self, name):
+        return os.path.join(self.path, name)
+
+    def has(self, name, request):
+        """ True if the chunk is in the cache, intact and from the same request """
+        entry = self.manifest.get(name)
+        path = self.target(name)
+        if entry is None or entry['request'] != _request_key(request) or not os.path.exists(path):
+            return False
+        return os.path.getsize(path) == entry['size'] and _sha256(path) == entry['sha256']
+
+    def add(self, name, request):
+        """ Record a finished chunk and save the manifest """
+        path = self.target(name)
+        entry = {'request': _request_key(request), 'size': os.path.getsize(path), 'sha256': _sha256(path)}
+        with self._lock:
+            self.manifest[name] = entry
+            tmp = os.path.join(self.path, MANIFEST + '.part')
+            with open(tmp, 'w') as fh:
+                json.dump(self.manifest, fh, indent=1, sort_keys=True)
+            os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+
+class LocalClient:
+    """ Stand-in for cdsapi.Client that copies canned NetCDF files
+
+    A request for variable v and year y is served from ``<source>/<v>_<y>.nc``.
+
+    Parameters
+    ----------
+
+    source : str
+        Directory with the canned files
+
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def retrieve(self, dataset, request, target):
+        (variable,), (year,) = request['variable'], request['year']
+        shutil.copyfile(os.path.join(self.source, f'{variable}_{year}.nc'), target)
+
+
+def _default_client():
+    import cdsapi
+    return cdsapi.Client()
+
+
+def download(requests, cache_dir='ERA5', client=None, workers=4, retries=3, backoff=30.,
+             dataset=DATASET, verbose=True):
+    """ Retrieve chunks that are not in the cache yet
+
+    Parameters
+    ----------
+
+    requests : list of (str, dict)
+        Chunk file names and CDS requests (see era5_requests)
+
+    cache_dir : str
+        Directory the chunks are downloaded to
+
+    client : object
+        Object with a ``retrieve(dataset, request, target)`` method; by
+        default one cdsapi.Client is made per worker thread
+
+    workers : int
+        Chunks requested at the same time
+
+    retries : int
+        Attempts per chunk before giving up on it
+
+    backoff : float
+        Seconds waited after the first failed attempt, doubled after each
+        further one
+
+    dataset : str
+        CDS dataset name
+
+    verbose : bool
+        Print progress
+
+    Returns
+    -------
+
+    paths : list of str
+        Paths of all requested chunks, in request order
+
+    Raises
+    ------
+
+    RuntimeError
+        If some chunks could not be retrieved; finished chunks stay in the
+        cache, so calling download again resumes
+
+    """
+    cache = Cache(cache_dir)
+    local = threading.local()
+
+    def get_client():
+        if client is not None:
+            return client
+        if not hasattr(local, 'client'):
+            local.client = _default_client()
+        return local.client
+
+    def fetch(name, request):
+        target = cache.target(name)
+        part = target + '.part'
+        for attempt in range(retries):
+            try:
+                get_client().retrieve(dataset, request, part)
+                if not _is_netcdf(part):
+                    raise ValueError(f'{name}: downloaded file is not NetCDF')
+                os.replace(part, target)
+                cache.add(name, request)
+                return name
+            except Exception:
+                if os.path.exists(part):
+                    os.remove(part)
+                if attempt == retries - 1:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+
+    todo = [(name, request) for name, request in requests if not cache.has(name, request)]
+    if verbose:
+        print(f'{len(requests) - len(todo)} of {len(requests)} chunks in {cache_dir}, {len(todo)} to download')
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch, name, request): name for name, request in todo}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                if verbose:
+                    print(f'  {name}')
+            except Exception as err:
+                failed.append(name)
+                if verbose:
+                    print(f'  {name} failed: {err}')
+    if failed:
+        raise RuntimeError(f'{len(failed)} chunks failed ({", ".join(sorted(failed))}); rerun to resume')
+    return [cache.target(name) for name, _ in requests]
+
+
+if __name__ == '__main__':
+    first_year = int(sys.argv[1]) if len(sys.argv) > 1 else 1979
+    last_year = int(sys.argv[2]) if len(sys.argv) > 2 else 2019
+    cache_dir = sys.argv[3] if len(sys.argv) > 3 else 'ERA5'
+    download(era5_requests(VARIABLES, first_year, last_year), cache_dir)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the PSM and proxy hot paths on synthetic data.
+
+The generators make inputs of any size without the ERA5 forcing, a
+hypercube run or a real archive:
+
+    synthetic_forcing      6-hourly met-input forcing of a given length
+    synthetic_isotopes     monthly precipitation isotopes
+    write_trial_outputs    N surface*.txt / profile-laketemp*.txt trial outputs
+    write_lpd              .lpd archive with a paleo table and an age ensemble
+
+Each benchmark runs one hot path over a range of sizes with profiling on
+(see profiling), so every stage (runoff_condition, runoff_reservoir,
+gtail_wma, load_trials, score_trials, ...) is appended to the log with its
+wall time, peak memory and throughput, next to an outer bench_* stage
+(bench_runoff, bench_gtail, bench_getlipd, ...) recording the sizes. Logs of successive runs can be compared with
+profiling.read_log to follow scaling and catch regressions.
+
+Usage:
+    python benchmarks.py bench-log.jsonl [quick|full]
+"""
+
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import profiling
+from calibration_scores import score_trials
+from lake_outputs import load_trials
+from profiling import stage
+from runoff_batch import MET_COLUMNS
+from runoff_model import STEPS_PER_DAY, run_runoff
+from smoothing import gtail_wma
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+# Mid-range runoff parameters (see parameter_space.RUNOFF_PARAMETERS)
+RUNOFF_PARAMS = dict(melt_ratio=0.5, rp_ratio_summer=0.5, rp_ratio_winter=0.5, rsm_ratio=0.5,
+                     p=50., s=5., thresh_spring=10, thresh_fall=10)
+
+# Sizes of each benchmark per scale
+SIZES = {
+    'quick': dict(years=(1, 5), periods=(20, 100, 1000), trials=(20, 100), scored=(100, 1000),
+                  lpd=((100, 5, 100), (100, 20, 1000))),
+    'full': dict(years=(1, 10, 40, 100), periods=(20, 100, 1000, 4000), trials=(100, 1000),
+                 scored=(1000, 10000), lpd=((100, 20, 1000), (1000, 20, 1000), (100, 20, 10000))),
+}
+
+
+def synthetic_forcing(years, steps_per_day=STEPS_PER_DAY, first_year=1980, seed=0):
+    """ Forcing table with the met-input-Imandra-* columns
+
+    365-day years with a seasonal and daily temperature cycle around
+    freezing and intermittent precipitation.
+
+    Returns
+    -------
+
+    met_data : pandas.DataFrame
+        One row per time step, columns as runoff_batch.MET_COLUMNS
+
+    """
+    rng = np.random.default_rng(seed)
+    n = int(years * 365 * steps_per_day)
+    step = np.arange(n)
+    day = step // steps_per_day
+    doy = day % 365
+    month = np.searchsorted(np.cumsum(_MONTH_DAYS), doy, side='right') + 1
+    dom = doy - np.concatenate([[0], np.cumsum(_MONTH_DAYS)])[month - 1] + 1
+    hour = (step % steps_per_day) * (24 // steps_per_day)
+
+    season = -np.cos(2 * np.pi * (doy - 15) / 365)
+    T2M = 273.15 + 14 * season + 3 * np.sin(2 * np.pi * (hour - 9) / 24) + rng.normal(0, 2, n)
+    TP = np.where(rng.random(n) < 0.4, rng.gamma(0.5, 4e-4, n), 0.)
+    return pd.DataFrame({'YEAR': first_year + day // 365, 'MONTH': month, 'DAY': dom, 'HOUR': hour,
+                         'T2M': T2M,
+                         'RH': np.clip(80 + rng.normal(0, 8, n), 20, 100),
+                         'WIND': np.abs(rng.normal(4, 2, n)),
+                         'SSRD': np.maximum(0., 150 * (season + 1) * np.sin(np.pi * hour / 24)),
+                         'STRD': 280 + 40 * season + rng.normal(0, 10, n),
+                         'SP': 1.0e5 + rng.normal(0, 800, n),
+                         'TP': TP}, columns=MET_COLUMNS)
+
+
+def synthetic_isotopes():
+    """ Monthly precipitation isotopes, as read by runoff_batch.read_isotope_seasonality """
+    month = np.arange(1, 13)
+    d18O = -14 + 4 * np.sin(2 * np.pi * (month - 4) / 12)
+    return pd.DataFrame({'MONTH': month, 'd2H': 8 * d18O + 10, 'd18O': d18O})
+
+
+def _trial_text(days, columns, seed):
+    """ Whitespace separated table with a header line and ``days`` rows of values """
+    rng = np.random.default_rng(seed)
+    values = np.column_stack([np.arange(days) // 365 + 1, np.arange(days) % 365 + 1,
+                              rng.normal(10, 5, (days, columns - 2))])
+    out = io.StringIO()
+    out.write(' '.join(f'c{j}' for j in range(columns)) + '\n')
+    np.savetxt(out, values, fmt='%.4f')
+    return out.getvalue()
+
+
+def write_trial_outputs(path, n, days=365, skiprows=1461, layers=20, templates=8, seed=0):
+    """ Fake lake-model outputs of n trials, as read by lake_outputs.load_trials
+
+    Writes surface1.txt ... surface<n>.txt (lake temperature in column 3)
+    and profile-laketemp1.txt ... (layer temperatures from column 4), each
+    with a header line and skiprows + days rows. Files cycle through a few
+    distinct contents, which parse as fast as n different ones.
+
+    Returns
+    -------
+
+    path : str
+
+    """
+    os.makedirs(path, exist_ok=True)
+    rows = skiprows + days
+    kinds = {'surface': 6, 'profile-laketemp': 4 + layers}
+    for prefix, columns in kinds.items():
+        texts = [_trial_text(rows, columns, seed + j) for j in range(min(templates, n))]
+        for k in range(1, n + 1):
+            with open(os.path.join(path, f'{prefix}{k}.txt'), 'w') as fh:
+                fh.write(texts[k % len(texts)])
+    return path
+
+
+def write_lpd(path, samples=100, variables=10, realizations=1000, ensemble_depths=100, seed=0):
+    """ .lpd archive (BagIt zip with JSON-LD metadata) with one paleo table and one age ensemble
+
+    The paleo table has a depth, an ageMedian and ``variables`` value
+    columns named v001, v002, ...; the ensemble table has
+    ``ensemble_depths`` rows of ``realizations`` monotonic age models.
+
+    Returns
+    -------
+
+    names : list of str
+        paleoData variable names
+
+    """
+    rng = np.random.default_rng(seed)
+    max_depth = 1000.
+    depth = np.sort(rng.uniform(0, max_depth, samples))
+    ens_depth = np.linspace(0, max_depth, ensemble_depths)
+    ages = np.cumsum(rng.gamma(4., 3., (ensemble_depths, realizations)), axis=0)
+    ages -= ages[0]
+    median = np.interp(depth, ens_depth, np.median(ages, axis=1))
+    names = [f'v{j + 1:03d}' for j in range(variables)]
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    paleo_file = f'{stem}.paleo0measurement0.csv'
+    ens_file = f'{stem}.chron0model0ensemble0.csv'
+    paleo = np.column_stack([depth, median, rng.normal(0, 1, (samples, variables))])
+    ensemble = np.column_stack([ens_depth, ages])
+
+    def column(name, number, units=None):
+        return {'variableName': name, 'number': number, 'units': units}
+
+    metadata = {
+        '@context': 'context.jsonld', 'dataSetName': stem, 'archiveType': 'LakeSediment', 'lipdVersion': 1.3,
+        'paleoData': [{'measurementTable': [{
+            'tableName': 'paleo0measurement0', 'filename': paleo_file, 'missingValue': 'nan',
+            'columns': [column('depth', 1, 'cm'), column('ageMedian', 2, 'yr BP')]
+                       + [column(name, j + 3) for j, name in enumerate(names)]}]}],
+        'chronData': [{'model': [{'ensembleTable': [{
+            'tableName': 'chron0model0ensemble0', 'filename': ens_file, 'missingValue': 'nan',
+            'columns': [column('depth', 1, 'cm'),
+                        column('ageEnsemble', list(range(2, realizations + 2)), 'yr BP')]}]}]}],
+    }
+
+    members = {}
+    for name, table in ((paleo_file, paleo), (ens_file, ensemble)):
+        out = io.StringIO()
+        np.savetxt(out, table, fmt='%.6g', delimiter=',')
+        members[f'data/{name}'] = out.getvalue().encode()
+    members['data/metadata.jsonld'] = json.dumps(metadata).encode()
+    manifest = ''.join(f'{hashlib.md5(data).hexdigest()}  {name}\n' for name, data in members.items())
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('bag/bagit.txt', 'BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n')
+        z.writestr('bag/bag-info.txt', 'Bag-Software-Agent: benchmarks.py\n')
+        for name, data in members.items():
+            z.writestr(f'bag/{name}', data)
+        z.writestr('bag/manifest-md5.txt', manifest)
+    return names
+
+
+def bench_runoff(years=(1, 10, 40)):
+    """ run_runoff (threshold masks, reservoir loop, gtail_wma) on forcing of each length """
+    piso = synthetic_isotopes()
+    for y in years:
+        met = synthetic_forcing(y)
+        with stage('bench_runoff', items=len(met), years=y):
+            run_runoff(met['T2M'].values, met['TP'].values, met['MONTH'].values,
+                       piso['d2H'].values, piso['d18O'].values, **RUNOFF_PARAMS)
+
+
+def bench_gtail(years=(1, 10, 40), periods=(20, 100, 1000), sigma=5.):
+    """ gtail_wma alone, direct and FFT, for each record length and window """
+    rng = np.random.default_rng(0)
+    for y in years:
+        series = rng.gamma(0.5, 1., (3, int(y * 365 * STEPS_PER_DAY)))
+        for period in periods:
+            for method in ('direct', 'fft'):
+                with stage('bench_gtail', items=series.size, years=y, period=period, sigma=sigma, method=method):
+                    gtail_wma(series, period, sigma, method=method)
+
+
+def bench_load_trials(trials=(100, 1000), workdir=None):
+    """ load_trials on N fake outputs: parsing everything, then from the cache """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for n in trials:
+            path = write_trial_outputs(os.path.join(tmp, f'trials-{n}'), n)
+            for prefix, usecols in (('surface', (3,)), ('profile-laketemp', tuple(range(4, 24)))):
+                for run in ('cold', 'warm'):
+                    with stage('bench_load_trials', items=n, trials=n, prefix=prefix, run=run):
+                        load_trials(path, prefix, usecols=usecols)
+
+
+def bench_score_trials(trials=(1000, 10000), layers=20, observations=300):
+    """ score_trials on random (trials x 365 x layers) simulations """
+    rng = np.random.default_rng(0)
+    for n in trials:
+        sim = rng.normal(10, 5, (n, 365, layers))
+        obs = rng.normal(10, 5, observations)
+        day_idx = rng.integers(0, 365, observations)
+        depth_idx = rng.integers(0, layers, observations)
+        with stage('bench_score_trials', items=n, trials=n, layers=layers, observations=observations):
+            score_trials(sim, obs, day_idx, depth_idx)
+
+
+def bench_getlipd(sizes=((100, 20, 1000),), workdir=None):
+    """ getlipd for every variable, and one depth-aligned table, on synthetic archives
+
+    sizes are (samples, variables, realizations) triples; every size is read
+    by a fresh session, so archive opening is included.
+    """
+    if _ROOT not in sys.path:
+        sys.path.insert(0, _ROOT)
+    from lipd_utils import LiPDSession
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for samples, variables, realizations in sizes:
+            lpd = os.path.join(tmp, f'synthetic-{samples}-{variables}-{realizations}.lpd')
+            names = write_lpd(lpd, samples, variables, realizations)
+            info = dict(samples=samples, variables=variables, realizations=realizations)
+            session = LiPDSession(engine='zip', verbose=False)
+            with stage('bench_getlipd', items=variables, **info):
+                for name in names:
+                    session.getlipd(lpd, name, depth_name='depth', val_unit='')
+            with stage('bench_lipd_table', items=variables, **info):
+                session.table(lpd, names, depth_name='depth')
+
+
+BENCHMARKS = {
+    'runoff': lambda sizes, workdir: bench_runoff(sizes['years']),
+    'gtail_wma': lambda sizes, workdir: bench_gtail(sizes['years'], sizes['periods']),
+    'load_trials': lambda sizes, workdir: bench_load_trials(sizes['trials'], workdir),
+    'score_trials': lambda sizes, workdir: bench_score_trials(sizes['scored']),
+    'getlipd': lambda sizes, workdir: bench_getlipd(sizes['lpd'], workdir),
+}
+
+
+def run(logfile, scale='quick', benchmarks=None, workdir=None, memory=True):
+    """ Run benchmarks with profiling on
+
+    Parameters
+    ----------
+
+    logfile : str
+        JSON lines log the stages are appended to
+
+    scale : {'quick', 'full'}
+        Sizes to run (see SIZES)
+
+    benchmarks : list of str
+        Names in BENCHMARKS; all by default
+
+    workdir : str
+        Directory for the temporary synthetic files
+
+    memory : bool
+        Trace peak memory (slows down the pure-Python runoff loop)
+
+    Returns
+    -------
+
+    log : pandas.DataFrame
+        All records of the log (see profiling.read_log)
+
+    """
+    sizes = SIZES[scale]
+    with profiling.profile(logfile, memory=memory):
+        for name in benchmarks or BENCHMARKS:
+            BENCHMARKS[name](sizes, workdir)
+    return profiling.read_log(logfile)
+
+
+if __name__ == '__main__':
+    logfile = sys.argv[1] if len(sys.argv) > 1 else 'bench-log.jsonl'
+    scale = sys.argv[2] if len(sys.argv) > 2 else 'quick'
+    log = run(logfile, scale)
+    pd.set_option('display.width', 200)
+    print(log[['stage', 'wall_s', 'peak_bytes', 'items', 'items_per_s']].to_string())
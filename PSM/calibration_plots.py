@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Figures for a hypercube calibration.
+
+plot_ensemble draws every trial of a (trials x days) ensemble as a single
+LineCollection, or, for large ensembles, as a rasterized density image with
+percentile envelopes, so drawing time hardly depends on the number of trials.
+plot_param_grid draws the parameter vs. objective scatter panels for all
+parameters of a parameter_space.ParameterSpace, switching to density images
+when there are too many points to draw as markers.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from parameter_space import LAKE_PARAMETERS
+
+# Above this many trials plot_ensemble draws a density band instead of lines
+MAX_LINES = 1000
+
+# Above this many points a scatter panel is drawn as a density image
+MAX_MARKERS = 20000
+
+_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _bin(v, lo, hi, n):
+    """ Bin index of each value on n equal bins over [lo, hi]; n for NaNs """
+    with np.errstate(invalid='ignore'):
+        b = np.floor((v - lo) * (n / (hi - lo)))
+    b = np.where(np.isfinite(b), b, n).astype(np.intp)
+    b[b < n] = b[b < n].clip(0, n - 1)
+    return b
+
+
+def _histogram2d(x, y, bins, extent):
+    """ Counts of (x, y) points on a bins[0] x bins[1] grid, via np.bincount """
+    nx, ny = bins
+    ix = _bin(np.asarray(x, dtype=float), extent[0], extent[1], nx)
+    iy = _bin(np.asarray(y, dtype=float), extent[2], extent[3], ny)
+    ok = (ix < nx) & (iy < ny)
+    return np.bincount(iy[ok] * nx + ix[ok], minlength=nx * ny).reshape(ny, nx)
+
+
+def _density_image(ax, counts, extent, cmap, zorder=0):
+    """ Draw a (y bins x x bins) count grid as a rasterized image """
+    return ax.imshow(np.ma.masked_equal(counts, 0), origin='lower', extent=extent, aspect='auto',
+                     cmap=cmap, interpolation='nearest', rasterized=True, zorder=zorder)
+
+
+def _histogram_percentiles(counts, q, lo, hi):
+    """ Percentiles of each column of a (bins x columns) histogram, interpolated within bins """
+    nbins = counts.shape[0]
+    cdf = np.cumsum(counts, axis=0, dtype=float)
+    total = cdf[-1]
+    out = np.full((len(q), counts.shape[1]), np.nan)
+    cols = np.arange(counts.shape[1])
+    for k, qk in enumerate(q):
+        target = qk / 100. * total
+        idx = np.minimum((cdf < target[None, :]).sum(axis=0), nbins - 1)
+        below = np.where(idx > 0, cdf[idx - 1, cols], 0.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((target - below) / counts[idx, cols], 0., 1.)
+        out[k] = np.where(total > 0, lo + (idx + frac) * (hi - lo) / nbins, np.nan)
+    return out
+
+
+def plot_ensemble(ax, x, values, mode='auto', color='black', linewidth=0.1, alpha=1.,
+                  percentiles=_PERCENTILES, bins=200, cmap='Greys', highlight=None,
+                  highlight_color='red'):
+    """ Draw an ensemble of simulated series
+
+    Parameters
+    ----------
+
+    ax : matplotlib Axes
+
+    x : 1D array
+        Common x values of the series (e.g. Julian day)
+
+    values : 2D array
+        One series per row (trials x len(x))
+
+    mode : {'auto', 'lines', 'band'}
+        'lines' draws all series as one LineCollection, 'band' draws a
+        rasterized density image of the series with percentile envelopes,
+        'auto' uses lines up to MAX_LINES series
+
+    color, linewidth, alpha :
+        Line style of the series ('lines') and envelopes ('band')
+
+    percentiles : sequence of float
+        Envelopes drawn in 'band' mode, the middle one solid; they are
+        taken from the density histogram, so are accurate to within a
+        fraction of a bin
+
+    bins : int
+        Vertical resolution of the density image
+
+    cmap : str
+        Colormap of the density image
+
+    highlight : array of int
+        Rows drawn on top as lines in ``highlight_color`` (e.g. the best trials)
+
+    Returns
+    -------
+
+    artist : LineCollection or AxesImage
+
+    """
+    x = np.asarray(x, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if mode == 'auto':
+        mode = 'lines' if len(values) <= MAX_LINES else 'band'
+
+    if mode == 'lines':
+        segments = np.empty(values.shape + (2,))
+        segments[..., 0] = x
+        segments[..., 1] = values
+        artist = LineCollection(segments, colors=color, linewidths=linewidth, alpha=alpha)
+        ax.add_collection(artist)
+        ax.autoscale_view()
+    elif mode == 'band':
+        # Histogram each column (day) of the ensemble in one bincount and
+        # take the envelopes from the histogram, so the cost is one pass over
+        # the values and the image size does not depend on the ensemble size
+        lo, hi = (np.nanmin(values), np.nanmax(values)) if np.isfinite(values).any() else (0., 1.)
+        if hi == lo:
+            hi = lo + 1.
+        ndays = values.shape[1]
+        iy = _bin(values, lo, hi, bins)
+        counts = np.bincount((iy * ndays + np.arange(ndays)).ravel(),
+                             minlength=(bins + 1) * ndays).reshape(bins + 1, ndays)[:bins]
+        dx = (x[-1] - x[0]) / max(ndays - 1, 1)
+        artist = _density_image(ax, counts, [x[0] - dx / 2, x[-1] + dx / 2, lo, hi], cmap)
+        env = _histogram_percentiles(counts, percentiles, lo, hi)
+        mid = len(percentiles) // 2
+        for k, line in enumerate(env):
+            ax.plot(x, line, color=color, linewidth=1. if k == mid else 0.5,
+                    linestyle='-' if k == mid else '--', alpha=alpha)
+    else:
+        raise ValueError(f"mode must be 'auto', 'lines' or 'band', not {mode!r}")
+
+    if highlight is not None:
+        best = values[np.asarray(highlight)]
+        segments = np.stack([np.broadcast_to(x, best.shape), best], axis=-1)
+        ax.add_collection(LineCollection(segments, colors=highlight_color, linewidths=max(linewidth, 0.3)))
+    return artist
+
+
+def plot_param_grid(stats, good=None, metric='NSE', space=LAKE_PARAMETERS, ncols=3, panel_size=(3, 1.67), color='grey',
+                    good_color='black', s=5, bins=60):
+    """ Scatter panels of every parameter against a calibration objective
+
+    Parameters
+    ----------
+
+    stats : pandas.DataFrame
+        All trials, with parameter columns and the objective column
+
+    good : pandas.DataFrame
+        Acceptable trials, drawn on top in ``good_color``
+
+    metric : str
+        Objective column on the y axis
+
+    space : parameter_space.ParameterSpace
+        Parameters to draw, in panel order, with their labels and ranges;
+        parameters that are not columns of ``stats`` are skipped
+
+    ncols : int
+        Panels per row
+
+    panel_size : (float, float)
+        Size of one panel in inches
+
+    color, good_color, s :
+        Marker colors and size
+
+    bins : int
+        Resolution of the density images used above MAX_MARKERS points
+
+    Returns
+    -------
+
+    fig, axes
+
+    """
+    params = [p for p in space if p.name in stats.columns]
+    nrows = -(-len(params) // ncols)
+    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, squeeze=False,
+                             figsize=(panel_size[0] * ncols, panel_size[1] * nrows))
+    y = np.asarray(stats[metric], dtype=float)
+    ylim = (np.nanmin(y), np.nanmax(y)) if np.isfinite(y).any() else (0., 1.)
+
+    for ax, param in zip(axes.flat, params):
+        name = param.name
+        x = np.asarray(stats[name], dtype=float)
+        xlim = (param.low, param.high)
+        ok = np.isfinite(x) & np.isfinite(y)
+        if ok.sum() > MAX_MARKERS:
+            extent = list(xlim) + list(ylim)
+            _density_image(ax, _histogram2d(x[ok], y[ok], (bins, bins), extent), extent, 'Greys')
+        else:
+            ax.scatter(x[ok], y[ok], color=color, s=s, rasterized=True)
+        if good is not None and len(good):
+            gx = np.asarray(good[name], dtype=float)
+            gy = np.asarray(good[metric], dtype=float)
+            if len(gx) > MAX_MARKERS:
+                extent = list(xlim) + list(ylim)
+                _density_image(ax, _histogram2d(gx, gy, (bins, bins), extent), extent, 'Reds', zorder=1)
+            else:
+                ax.scatter(gx, gy, color=good_color, s=s, rasterized=True)
+        ax.set_xlabel(param.label)
+        ax.set_xlim(*xlim)
+    for ax in axes[:, 0]:
+        ax.set_ylabel(metric)
+    for ax in axes.flat[len(params):]:
+        ax.set_visible(False)
+    return fig, axes
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Objective functions for scoring a hypercube calibration against observations.
+
+Simulated lake temperatures are passed as one (trials x days x depths) array,
+e.g. the cube returned by lake_outputs.load_trials, and the observations as
+values with their day and depth positions in that array. NSE, RSR, bias, RMSE
+and KGE are computed for all trials at once. Observations can be weighted by
+depth and can come from several years of a multi-year simulation.
+"""
+
+import numpy as np
+import pandas as pd
+
+from profiling import stage
+
+METRICS = ['NSE', 'rsr', 'bias', 'RMSE', 'KGE']
+
+# Upper bound on trials x observations gathered at a time
+_BLOCK_VALUES = 1 << 22
+
+
+def observation_index(obs, first_year=None, days_per_year=365, day='Julian', year='Year',
+                      depth=None, depths=None):
+    """ Positions of observations along the day and depth axes of a simulation
+
+    Parameters
+    ----------
+
+    obs : pandas.DataFrame
+        Observation table with a day-of-year column (1-based)
+
+    first_year : int
+        Year of the first simulated day. If given, the simulation is taken to
+        span several years of ``days_per_year`` days and observations are
+        placed by their ``year`` column; if None all observations fall in the
+        single simulated year.
+
+    days_per_year : int
+        Days in each simulated year
+
+    day, year : str
+        Day-of-year and year columns of ``obs``
+
+    depth : str
+        Depth column of ``obs``; None puts every observation in the first layer
+
+    depths : 1D array
+        Depth of each layer of the simulation; observations go to the nearest
+        layer
+
+    Returns
+    -------
+
+    day_idx, depth_idx : 1D int arrays
+
+    """
+    day_idx = np.asarray(obs[day], dtype=int) - 1
+    if first_year is not None:
+        day_idx = day_idx + (np.asarray(obs[year], dtype=int) - first_year) * days_per_year
+    if depth is None:
+        depth_idx = np.zeros(len(day_idx), dtype=int)
+    else:
+        layers = np.asarray(depths, dtype=float)
+        values = np.asarray(obs[depth], dtype=float)
+        depth_idx = np.abs(values[:, None] - layers[None, :]).argmin(axis=1)
+    return day_idx, depth_idx
+
+
+def score_predictions(pred, o, w):
+    """ Weighted metrics for simulated values already matched to observations
+
+    Parameters
+    ----------
+
+    pred : 2D array
+        Simulated value of each trial (rows) at each observation (columns)
+
+    o, w : 1D arrays
+        Observed values and their weights
+
+    Returns
+    -------
+
+    stats : dict of 1D arrays
+        NSE, rsr, bias, RMSE and KGE for each trial
+
+    """
+    wn = w / w.sum()
+    mu_o = wn @ o
+    mu_s = pred @ wn
+    dev_o = o - mu_o
+    dev_s = pred - mu_s[:, None]
+    sse = ((pred - o) ** 2) @ w
+    sst = (dev_o ** 2) @ w
+    sd_o = np.sqrt((dev_o ** 2) @ wn)
+    sd_s = np.sqrt((dev_s ** 2) @ wn)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (dev_s @ (wn * dev_o)) / (sd_s * sd_o)
+        kge = 1. - np.sqrt((r - 1.) ** 2 + (sd_s / sd_o - 1.) ** 2 + (mu_s / mu_o - 1.) ** 2)
+        return {'NSE': 1. - sse / sst,
+                'rsr': np.sqrt(sse) / np.sqrt(sst),
+                'bias': mu_o - mu_s,
+                'RMSE': np.sqrt(sse / w.sum()),
+                'KGE': kge}
+
+
+def score_trials(sim, obs, day_idx, depth_idx=None, depth_weights=None, trials=None):
+    """ Score every trial of a simulation ensemble against observations
+
+    Parameters
+    ----------
+
+    sim : 2D or 3D array
+        Simulated values, (trials x days) or (trials x days x depths)
+
+    obs : 1D array
+        Observed values; NaNs are ignored
+
+    day_idx, depth_idx : 1D int arrays
+        Position of each observation in ``sim`` (see observation_index);
+        depth_idx defaults to the first layer
+
+    depth_weights : 1D array
+        Weight of each depth layer; observations are weighted by the weight of
+        their layer. Equal weights by default.
+
+    trials : 1D array
+        Trial numbers, added as a 'trial' column
+
+    Returns
+    -------
+
+    stats : pandas.DataFrame
+        One row per trial with columns NSE, rsr, bias (mean observed minus
+        mean simulated), RMSE and KGE
+
+    """
+    sim = np.asarray(sim)  # no copy for memmaps
+    if sim.ndim == 2:
+        sim = sim[:, :, None]
+    obs = np.asarray(obs, dtype=float)
+    day_idx = np.asarray(day_idx, dtype=int)
+    depth_idx = np.zeros(len(obs), dtype=int) if depth_idx is None else np.asarray(depth_idx, dtype=int)
+    if len(day_idx) != len(obs) or len(depth_idx) != len(obs):
+        raise ValueError('obs, day_idx and depth_idx must have the same length')
+    if ((day_idx < 0) | (day_idx >= sim.shape[1])).any():
+        raise ValueError(f'Observation days outside the {sim.shape[1]} simulated days')
+    if ((depth_idx < 0) | (depth_idx >= sim.shape[2])).any():
+        raise ValueError(f'Observation depths outside the {sim.shape[2]} simulated layers')
+
+    keep = np.isfinite(obs)
+    obs, day_idx, depth_idx = obs[keep], day_idx[keep], depth_idx[keep]
+    if depth_weights is None:
+        w = np.ones(len(obs))
+    else:
+        w = np.asarray(depth_weights, dtype=float)[depth_idx]
+
+    ntrials = sim.shape[0]
+    block = max(1, _BLOCK_VALUES // max(len(obs), 1))
+    stats = {m: np.empty(ntrials) for m in METRICS}
+    with stage('score_trials', items=ntrials, observations=len(obs)):
+        for start in range(0, ntrials, block):
+            pred = np.asarray(sim[start:start + block, day_idx, depth_idx], dtype=float)
+            for m, v in score_predictions(pred, obs, w).items():
+                stats[m][start:start + block] = v
+
+    stats = pd.DataFrame(stats, columns=METRICS)
+    if trials is not None:
+        stats['trial'] = np.asarray(trials)
+    return stats
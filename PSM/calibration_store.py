@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent store of calibration scores.
+
+Scores for every trial are kept in an SQLite file together with a hash of the
+trial's simulated output and of the observation set they were computed
+against. The simulated values matched to each observation are stored too, so
+when trials are added to the ensemble or observation dates are added, only the
+new (trial, observation) pairs are taken from the simulation, and only trials
+whose observation set or output changed are rescored. Picking the acceptable
+parameter sets (NSE threshold, best N trials) is an indexed query on the
+stored scores. Queries only return trials scored against the observation set
+of the last update, unless asked for all stored scores.
+
+    with CalibrationStore('calibration.sqlite') as store:
+        store.update(trials, cube, obs_mon['temp'], day_idx, depth_idx)
+        good = store.select('NSE', minimum=0.85)
+        best = store.top(50)
+"""
+
+import hashlib
+import sqlite3
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from calibration_scores import METRICS, score_predictions
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS trials (trial INTEGER PRIMARY KEY, output_hash TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS observations (obs_hash TEXT PRIMARY KEY, day INTEGER, depth INTEGER, value REAL);
+CREATE TABLE IF NOT EXISTS predictions (trial INTEGER, obs_hash TEXT, value REAL, PRIMARY KEY (trial, obs_hash));
+CREATE TABLE IF NOT EXISTS scores (trial INTEGER PRIMARY KEY, obs_set TEXT NOT NULL,
+                                   {', '.join(f'{m} REAL' for m in METRICS)});
+{' '.join(f'CREATE INDEX IF NOT EXISTS scores_{m} ON scores ({m});' for m in METRICS)}
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def output_hash(values):
+    """ Hash of one trial's simulated values """
+    return _digest(np.ascontiguousarray(values, dtype=float).tobytes())
+
+
+def observation_hashes(obs, day_idx, depth_idx):
+    """ Hash of each observation (day, depth, value); repeats are numbered """
+    seen = Counter()
+    hashes = []
+    for key in zip(np.asarray(day_idx, dtype=int).tolist(), np.asarray(depth_idx, dtype=int).tolist(),
+                   np.asarray(obs, dtype=float).tolist()):
+        hashes.append(_digest(repr(key + (seen[key],)).encode()))
+        seen[key] += 1
+    return hashes
+
+
+class CalibrationStore:
+    """ Calibration scores kept on disk and updated incrementally
+
+    Parameters
+    ----------
+
+    path : str
+        SQLite file, created if missing
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def obs_set(self):
+        """ Key of the observation set of the last update (None before the first) """
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'obs_set'").fetchone()
+        return None if row is None else row[0]
+
+    def update(self, trials, sim, obs, day_idx, depth_idx=None, depth_weights=None):
+        """ Bring the stored scores up to date with a simulation and observations
+
+        Parameters
+        ----------
+
+        trials : 1D int array
+            Trial numbers, one per row of ``sim``
+
+        sim : 2D or 3D array
+            Simulated values, (trials x days) or (trials x days x depths)
+
+        obs, day_idx, depth_idx, depth_weights :
+            As in calibration_scores.score_trials
+
+        Returns
+        -------
+
+        rescored : 1D int array
+            Trials whose scores were (re)computed
+
+        """
+        trials = np.asarray(trials, dtype=int)
+        sim = np.asarray(sim)
+        if sim.ndim == 2:
+            sim = sim[:, :, None]
+        obs = np.asarray(obs, dtype=float)
+        day_idx = np.asarray(day_idx, dtype=int)
+        depth_idx = np.zeros(len(obs), dtype=int) if depth_idx is None else np.asarray(depth_idx, dtype=int)
+        keep = np.isfinite(obs)
+        obs, day_idx, depth_idx = obs[keep], day_idx[keep], depth_idx[keep]
+        weights = (np.ones(len(obs)) if depth_weights is None
+                   else np.asarray(depth_weights, dtype=float)[depth_idx])
+
+        obs_hashes = observation_hashes(obs, day_idx, depth_idx)
+        obs_set = _digest(repr((obs_hashes, weights.tolist())).encode())
+        db = self.db
+
+        with db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('obs_set', ?)", (obs_set,))
+            db.executemany('INSERT OR IGNORE INTO observations VALUES (?, ?, ?, ?)',
+                           zip(obs_hashes, day_idx.tolist(), depth_idx.tolist(), obs.tolist()))
+
+            # Trials that are new or whose output changed lose their stored predictions
+            stored = dict(db.execute('SELECT trial, output_hash FROM trials'))
+            hashes = [output_hash(sim[k]) for k in range(len(trials))]
+            changed = [(int(t), h) for t, h in zip(trials, hashes) if stored.get(int(t)) != h]
+            db.executemany('DELETE FROM predictions WHERE trial = ?', [(t,) for t, _ in changed])
+            db.executemany('INSERT OR REPLACE INTO trials VALUES (?, ?)', changed)
+
+            # Simulated values for (trial, observation) pairs not stored yet
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS current_obs (obs_hash TEXT PRIMARY KEY, pos INTEGER)')
+            db.execute('DELETE FROM current_obs')
+            db.executemany('INSERT INTO current_obs VALUES (?, ?)', zip(obs_hashes, range(len(obs_hashes))))
+            have = pd.read_sql_query('SELECT p.trial, c.pos, p.value FROM predictions p '
+                                     'JOIN current_obs c ON p.obs_hash = c.obs_hash', db)
+            pred = np.full((len(trials), len(obs)), np.nan)
+            present = np.zeros(pred.shape, dtype=bool)
+            row = pd.Series(np.arange(len(trials)), index=trials)
+            have = have[have['trial'].isin(row.index)]
+            r = row[have['trial']].values.astype(int)
+            c = have['pos'].values.astype(int)
+            pred[r, c] = have['value'].values.astype(float)
+            present[r, c] = True
+
+            rows, cols = np.nonzero(~present)
+            if len(rows):
+                pred[rows, cols] = sim[rows, day_idx[cols], depth_idx[cols]]
+                db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                               zip(trials[rows].tolist(), [obs_hashes[c] for c in cols],
+                                   pred[rows, cols].tolist()))
+
+            # Rescore trials with new predictions or a different observation set
+            scored = dict(db.execute('SELECT trial, obs_set FROM scores'))
+            redo = np.array([scored.get(int(t)) != obs_set for t in trials]) | (~present).any(axis=1)
+            rescored = trials[redo]
+            if redo.any():
+                stats = score_predictions(pred[redo], obs, weights)
+                db.executemany(f'INSERT OR REPLACE INTO scores VALUES ({", ".join("?" * (len(METRICS) + 2))})',
+                               zip(rescored.tolist(), [obs_set] * len(rescored),
+                                   *(stats[m].tolist() for m in METRICS)))
+        return rescored
+
+    def _query(self, clauses=(), args=(), order=None, limit=None, current=True):
+        clauses, args = list(clauses), list(args)
+        obs_set = self.obs_set if current else None
+        if obs_set is not None:
+            clauses.append('obs_set = ?')
+            args.append(obs_set)
+        sql = f'SELECT trial, {", ".join(METRICS)} FROM scores'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if order is not None:
+            sql += f' ORDER BY {order}'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return pd.read_sql_query(sql, self.db, params=args)
+
+    def scores(self, current=True):
+        """ Stored scores by trial number, only those of the current observation set with ``current`` """
+        return self._query(order='trial', current=current)
+
+    def select(self, metric='NSE', minimum=None, maximum=None, current=True):
+        """ Trials with ``minimum <= metric <= maximum``, best first for NSE/KGE """
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric {metric}, expected one of {METRICS}')
+        clauses, args = [f'{metric} IS NOT NULL'], []
+        if minimum is not None:
+            clauses.append(f'{metric} >= ?')
+            args.append(minimum)
+        if maximum is not None:
+            clauses.append(f'{metric} <= ?')
+            args.append(maximum)
+        order = f'{metric} DESC' if metric in ('NSE', 'KGE') else metric
+        return self._query(clauses, args, order=order, current=current)
+
+    def top(self, n=50, metric='NSE', current=True):
+        """ The ``n`` best trials by a metric (highest NSE/KGE, lowest rsr/RMSE/|bias|) """
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric {metric}, expected one of {METRICS}')
+        order = {'NSE': 'NSE DESC', 'KGE': 'KGE DESC', 'bias': 'ABS(bias)'}.get(metric, metric)
+        return self._query([f'{metric} IS NOT NULL'], order=order, limit=n, current=current)
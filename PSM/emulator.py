@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Surrogate emulator of the calibration objectives.
+
+A regression model is trained on the scored hypercube (parameter values of
+each trial and its NSE, rsr, bias, ...) to predict every objective, with an
+uncertainty, from a parameter vector in the unit coordinates of a
+parameter_space.ParameterSpace. Two kinds of surrogate are available: a
+Gaussian process (Matern kernel with one length scale per parameter) or
+gradient-boosted trees, whose uncertainty comes from 16% / 84% quantile
+models. The trained emulator gives Sobol sensitivity indices of every
+objective at the cost of surrogate evaluations only, and can screen a
+candidate batch so that only parameter sets likely to be acceptable are run
+through the lake model.
+
+Requires scikit-learn.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from parameter_space import LAKE_PARAMETERS
+
+try:
+    from sklearn.ensemble import GradientBoostingRegressor
+    from sklearn.exceptions import ConvergenceWarning
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+except ImportError:  # scikit-learn is only needed by the emulator
+    GaussianProcessRegressor = None
+
+
+class Emulator:
+    """ Surrogate model of calibration objectives
+
+    Parameters
+    ----------
+
+    space : parameter_space.ParameterSpace
+        Parameters the objectives depend on
+
+    metrics : list of str
+        Objectives to emulate (columns of the scores table)
+
+    method : {'gp', 'gbt'}
+        Gaussian process or gradient-boosted trees
+
+    floor : float or dict
+        Objective values below this are raised to it before training, e.g.
+        -1 for NSE, so that a few very poor trials do not dominate the fit
+
+    max_train : int
+        Largest training set for the Gaussian process (its cost grows with
+        the cube of the training size); larger sets are subsampled
+
+    seed : int
+        Random seed for subsampling, the optimizer restarts and the trees
+
+    Examples
+    --------
+
+    >>> emulator = Emulator(metrics=['NSE'], floor=-1.).fit(LST_stat)
+    >>> emulator.sensitivity('NSE')
+    >>> batch = LAKE_PARAMETERS.refine(LST_good, 2000)
+    >>> keep, prob = emulator.screen(batch, 'NSE', 0.85)
+
+    """
+
+    def __init__(self, space=LAKE_PARAMETERS, metrics=('NSE', 'rsr', 'bias'), method='gp',
+                 floor=None, max_train=2000, seed=None):
+        if GaussianProcessRegressor is None:
+            raise ImportError('The emulator requires scikit-learn')
+        if method not in ('gp', 'gbt'):
+            raise ValueError(f"method must be 'gp' or 'gbt', not {method!r}")
+        self.space = space
+        self.metrics = list(metrics)
+        self.method = method
+        self.floor = floor
+        self.max_train = max_train
+        self.seed = seed
+        self.models = {}
+
+    def _unit(self, X):
+        """ Unit coordinates of a DataFrame of parameter values, or a unit matrix as is """
+        if isinstance(X, pd.DataFrame):
+            return self.space.unscale(X)
+        return np.atleast_2d(np.asarray(X, dtype=float))
+
+    def _floor(self, metric):
+        if isinstance(self.floor, dict):
+            return self.floor.get(metric)
+        return self.floor
+
+    def fit(self, stats):
+        """ Train one surrogate per objective
+
+        Parameters
+        ----------
+
+        stats : pandas.DataFrame
+            Scored trials, with a column for every parameter of the space
+            and every objective (e.g. LST_stat)
+
+        Returns
+        -------
+
+        self
+
+        """
+        rng = np.random.default_rng(self.seed)
+        X_all = self.space.unscale(stats)
+        for metric in self.metrics:
+            y = np.asarray(stats[metric], dtype=float)
+            ok = np.isfinite(y) & np.isfinite(X_all).all(axis=1)
+            X, y = X_all[ok], y[ok]
+            if self._floor(metric) is not None:
+                y = np.maximum(y, self._floor(metric))
+            if self.method == 'gp':
+                if len(y) > self.max_train:
+                    pick = rng.choice(len(y), self.max_train, replace=False)
+                    X, y = X[pick], y[pick]
+                d = X.shape[1]
+                kernel = (ConstantKernel(1.0, (1e-3, 1e3))
+                          * Matern(length_scale=np.full(d, 0.5), length_scale_bounds=(1e-2, 1e2), nu=2.5)
+                          + WhiteKernel(1e-2, (1e-8, 1e1)))
+                model = GaussianProcessRegressor(kernel, normalize_y=True, n_restarts_optimizer=1,
+                                                 random_state=self.seed)
+                with warnings.catch_warnings():
+                    # length scales at the upper bound mark parameters the objective does not depend on
+                    warnings.simplefilter('ignore', ConvergenceWarning)
+                    self.models[metric] = model.fit(X, y)
+            else:
+                models = {}
+                for name, kwargs in (('mean', {'loss': 'squared_error'}),
+                                     ('lo', {'loss': 'quantile', 'alpha': norm.cdf(-1)}),
+                                     ('hi', {'loss': 'quantile', 'alpha': norm.cdf(1)})):
+                    models[name] = GradientBoostingRegressor(n_estimators=300, max_depth=3, learning_rate=0.05,
+                                                             subsample=0.8, random_state=self.seed,
+                                                             **kwargs).fit(X, y)
+                self.models[metric] = models
+        return self
+
+    def predict(self, X, metric=None):
+        """ Predicted objectives and their standard deviations
+
+        Parameters
+        ----------
+
+        X : pandas.DataFrame or 2D array
+            Parameter values (DataFrame with the parameter columns) or unit
+            coordinates (trials x parameters)
+
+        metric : str
+            Predict only this objective
+
+        Returns
+        -------
+
+        pred : pandas.DataFrame
+            For each objective a column with the prediction and a '<metric>_std'
+            column with its standard deviation
+
+        """
+        X = self._unit(X)
+        pred = {}
+        for m in ([metric] if metric else self.metrics):
+            model = self.models[m]
+            if self.method == 'gp':
+                pred[m], pred[m + '_std'] = model.predict(X, return_std=True)
+            else:
+                pred[m] = model['mean'].predict(X)
+                pred[m + '_std'] = np.maximum(model['hi'].predict(X) - model['lo'].predict(X), 0.) / 2.
+        return pd.DataFrame(pred)
+
+    def screen(self, X, metric='NSE', threshold=0.85, probability=0.5, above=True):
+        """ Candidate parameter sets likely to meet an acceptance threshold
+
+        Parameters
+        ----------
+
+        X : pandas.DataFrame or 2D array
+            Candidates, as for predict (e.g. a batch from ParameterSpace.refine)
+
+        metric : str
+            Objective the threshold applies to
+
+        threshold : float
+            Acceptance threshold, e.g. NSE >= 0.85
+
+        probability : float
+            Smallest predicted probability of acceptance for a candidate to
+            be kept
+
+        above : bool
+            Acceptable values are >= threshold (True) or <= threshold (False)
+
+        Returns
+        -------
+
+        keep : 1D bool array
+            Candidates to send to the lake model
+
+        prob : 1D array
+            Predicted probability of acceptance, from a normal distribution
+            with the predicted mean and standard deviation
+
+        """
+        pred = self.predict(X, metric)
+        z = (pred[metric].values - threshold) / np.maximum(pred[metric + '_std'].values, 1e-12)
+        prob = norm.cdf(z if above else -z)
+        return prob >= probability, prob
+
+    def sensitivity(self, metric='NSE', n=1024, seed=None):
+        """ Sobol sensitivity indices of an objective, from the surrogate
+
+        First-order (S1) and total (ST) indices of every parameter over its
+        full range, estimated with the Saltelli/Jansen estimators from
+        n x (parameters + 2) surrogate evaluations.
+
+        Parameters
+        ----------
+
+        metric : str
+
+        n : int
+            Base sample size
+
+        seed : int
+
+        Returns
+        -------
+
+        indices : pandas.DataFrame
+            Columns S1 and ST, one row per parameter
+
+        """
+        rng = np.random.default_rng(seed)
+        d = len(self.space)
+        A = self.space.sample(n, rng)
+        B = self.space.sample(n, rng)
+        AB = np.repeat(A[None], d, axis=0)
+        AB[np.arange(d), :, np.arange(d)] = B.T  # AB[i] is A with column i taken from B
+        f = self.predict(np.vstack([A, B, AB.reshape(-1, d)]), metric)[metric].values
+        fA, fB, fAB = f[:n], f[n:2 * n], f[2 * n:].reshape(d, n)
+        var = np.var(np.concatenate([fA, fB]))
+        S1 = np.mean(fB * (fAB - fA), axis=1) / var
+        ST = 0.5 * np.mean((fA - fAB) ** 2, axis=1) / var
+        return pd.DataFrame({'S1': S1, 'ST': ST}, index=self.space.names)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+ERA5 NetCDF to met-input forcing.
+
+Turns the per-variable, per-year Imandra_ERA5_<variable>_<year>.nc chunks
+written by ERA5_download.py into the tab separated 6-hourly forcing the
+runoff script reads (met-input-Imandra-MODERN-ERA5-6hrlycorr.txt):
+
+    YEAR MONTH DAY HOUR T2M RH WIND SSRD STRD SP TP
+
+The files are read one year and one block of time steps at a time. Every
+field is averaged over the box (cos-latitude weighted), and the table is
+derived from those series:
+- RH from temperature and dewpoint (Magnus formula)
+- wind speed from the u/v components
+- radiation from J m-2 summed over the 6 hours up to each step to the mean
+  W m-2 of those hours
+- pressure from Pa to hPa
+- precipitation from m summed over the 6 hours up to each step to mm per 6 h
+
+ERA5 radiation and precipitation are hourly accumulations stamped at the end
+of their hour, so their chunks hold all 24 hours of the day (see
+ERA5_download.ACCUMULATED) and are summed over each 6-hour step.
+
+Monthly bias-correction coefficients (an additive delta or a multiplicative
+scaling per variable and month) are fitted once against station data, cached
+in a CSV file and applied to each block before it is written. Only one block
+of gridded data is held in memory at a time.
+
+NetCDF files are read with netCDF4 if it is installed, otherwise with
+scipy.io.netcdf_file (NetCDF3 files only, each read whole; a chunk holds one
+variable for one year).
+
+Usage:
+    python era5_metinput.py ERA5 met-input-Imandra-MODERN-ERA5-6hrlycorr.txt 1979 2019 [station.txt]
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from ERA5_download import ACCUMULATED, VARIABLES, chunk_name
+from met_io import MetInputWriter, write_met_text
+from runoff_batch import MET_COLUMNS
+
+try:
+    import netCDF4
+except ImportError:  # NetCDF3 files can still be read with scipy
+    netCDF4 = None
+
+# Variable names of the ERA5 short names in CDS NetCDF files
+NETCDF_NAMES = {'2t': 't2m', '2d': 'd2m', '10u': 'u10', '10v': 'v10', 'ssrd': 'ssrd', 'strd': 'strd',
+                'sp': 'sp', 'tp': 'tp'}
+
+# Bias correction of each forcing column: 'delta' adds the monthly mean
+# difference station - ERA5, 'scale' multiplies by the monthly mean ratio
+BIAS_METHODS = {'T2M': 'delta', 'RH': 'delta', 'WIND': 'scale', 'SSRD': 'scale', 'STRD': 'delta',
+                'SP': 'delta', 'TP': 'scale'}
+
+# Hours in one forcing time step
+STEP_HOURS = 6
+
+_TIME_UNITS = {'days': 'D', 'hours': 'h', 'minutes': 'm', 'seconds': 's'}
+
+
+def decode_time(values, units):
+    """ CF time values ('<unit> since <date>') to datetime64 """
+    unit, _, origin = units.partition(' since ')
+    origin = np.datetime64(origin.strip().replace(' ', 'T')[:19], 's')
+    return origin + np.asarray(values).astype('int64') * np.timedelta64(1, _TIME_UNITS[unit.strip()])
+
+
+class NetCDFField:
+    """ One gridded variable of a NetCDF file, read lazily by time blocks
+
+    Parameters
+    ----------
+
+    path : str
+        NetCDF file
+
+    variable : str
+        ERA5 short name (e.g. '2t') or name in the file (e.g. 't2m')
+
+    """
+
+    def __init__(self, path, variable):
+        name = NETCDF_NAMES.get(variable, variable)
+        if netCDF4 is not None:
+            self.ds = netCDF4.Dataset(path)
+            variables = self.ds.variables
+        else:
+            from scipy.io import netcdf_file
+            self.ds = netcdf_file(path, mmap=False, maskandscale=True)  # one variable-year per file
+            variables = self.ds.variables
+        if name not in variables:
+            raise KeyError(f'{path} has no variable {name}')
+        self.var = variables[name]
+        time_name = self.var.dimensions[0]
+        time = variables[time_name]
+        self.time = decode_time(np.array(time[:]), _attr(time, 'units'))
+        lat = np.array(variables[_coordinate(variables, ('latitude', 'lat'))][:], dtype=float)
+        self.weights = np.broadcast_to(np.cos(np.deg2rad(lat))[:, None],
+                                       self.var.shape[-2:]).astype(float)
+
+    def __len__(self):
+        return len(self.time)
+
+    def area_mean(self, start, stop):
+        """ Box-mean values of time steps start:stop """
+        block = np.ma.filled(np.ma.asarray(self.var[start:stop]).astype(float), np.nan)
+        if block.ndim == 4:  # (time, expver, lat, lon): final and preliminary ERA5 in separate slots
+            with np.errstate(invalid='ignore'):
+                block = np.nanmean(block, axis=1)
+        w = np.where(np.isfinite(block), self.weights, 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nansum(block * w, axis=(1, 2)) / w.sum(axis=(1, 2))
+
+    def close(self):
+        self.ds.close()
+
+
+def _attr(var, name):
+    value = getattr(var, name)
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _coordinate(variables, names):
+    for name in names:
+        if name in variables:
+            return name
+    raise KeyError(f'None of the coordinates {names} found')
+
+
+def relative_humidity(t2m, d2m):
+    """ Relative humidity (%) from air and dewpoint temperature (K), Magnus formula over water """
+    def es(t):
+        t = t - 273.15
+        return 6.1094 * np.exp(17.625 * t / (t + 243.04))
+    return np.minimum(100. * es(d2m) / es(t2m), 100.)
+
+
+def window_sums(hourly_time, hourly, time, hours=STEP_HOURS):
+    """ Sums of hourly accumulations over the ``hours`` up to each time
+
+    Parameters
+    ----------
+
+    hourly_time : 1D datetime64 array
+        End of each accumulation hour, increasing
+
+    hourly : 1D array
+        Accumulation of each hour
+
+    time : 1D datetime64 array
+        End of each window
+
+    hours : int
+        Window length
+
+    Returns
+    -------
+
+    sums : 1D array
+        NaN where an hour of the window is NaN. Windows reaching back before
+        the first hour (the start of the record) are scaled up from the hours
+        they have.
+
+    Raises
+    ------
+
+    ValueError
+        If hours are missing inside the record, e.g. for chunks downloaded
+        at 6-hourly steps only
+
+    """
+    hourly_time = np.asarray(hourly_time, dtype='datetime64[s]')
+    time = np.asarray(time, dtype='datetime64[s]')
+    hourly = np.asarray(hourly, dtype=float)
+    bad = ~np.isfinite(hourly)
+    total = np.concatenate([[0.], np.cumsum(np.where(bad, 0., hourly))])
+    nbad = np.concatenate([[0], np.cumsum(bad)])
+    hour = np.timedelta64(1, 'h')
+    hi = np.searchsorted(hourly_time, time, side='right')
+    lo = np.searchsorted(hourly_time, time - hours * hour, side='right')
+    count = hi - lo
+    early = time - (hours - 1) * hour < hourly_time[0]
+    if ((count < hours) & ~early).any():
+        raise ValueError(f'Accumulated variables need hourly steps; {hours}-hour windows are incomplete')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sums = (total[hi] - total[lo]) * np.where(early, hours / count, 1.)
+    return np.where(nbad[hi] > nbad[lo], np.nan, sums)
+
+
+def forcing_from_era5(fields, time):
+    """ Forcing columns from box-mean ERA5 series
+
+    Parameters
+    ----------
+
+    fields : dict of 1D arrays
+        Box means of the VARIABLES, keyed by ERA5 short name, in ERA5 units;
+        the accumulated variables summed over each time step (window_sums)
+
+    time : 1D datetime64 array
+
+    Returns
+    -------
+
+    table : pandas.DataFrame
+        Columns of MET_COLUMNS
+
+    """
+    t = pd.DatetimeIndex(time)
+    return pd.DataFrame({
+        'YEAR': t.year, 'MONTH': t.month, 'DAY': t.day, 'HOUR': t.hour,
+        'T2M': fields['2t'],
+        'RH': relative_humidity(fields['2t'], fields['2d']),
+        'WIND': np.hypot(fields['10u'], fields['10v']),
+        'SSRD': np.maximum(fields['ssrd'] / (STEP_HOURS * 3600.), 0.),  # J m-2 per step -> mean W m-2
+        'STRD': fields['strd'] / (STEP_HOURS * 3600.),
+        'SP': fields['sp'] / 100.,  # Pa -> hPa
+        'TP': np.maximum(fields['tp'] * 1000., 0.),  # m per step -> mm per step
+    }, columns=MET_COLUMNS)
+
+
+def era5_blocks(cache_dir, first_year, last_year, blocksize=1460, prefix='Imandra_ERA5'):
+    """ Uncorrected forcing table, one block of time steps at a time
+
+    Parameters
+    ----------
+
+    cache_dir : str
+        Directory with the Imandra_ERA5_<variable>_<year>.nc chunks
+
+    first_year, last_year : int
+        Years to read, both included
+
+    blocksize : int
+        Time steps per block (1460 = one year of 6-hourly steps)
+
+    prefix : str
+        Start of the chunk file names
+
+    Yields
+    ------
+
+    table : pandas.DataFrame
+        Forcing for consecutive time steps (see forcing_from_era5)
+
+    """
+    instant = [v for v in VARIABLES if v not in ACCUMULATED]
+    accumulated = [v for v in VARIABLES if v in ACCUMULATED]
+    tail = {}  # last hours of the previous year, for the first windows of the next
+    for year in range(first_year, last_year + 1):
+        fields = {v: NetCDFField(os.path.join(cache_dir, chunk_name(v, year, prefix)), v) for v in VARIABLES}
+        try:
+            time = fields[instant[0]].time
+            for v in instant:
+                f = fields[v]
+                if len(f.time) != len(time) or (f.time != time).any():
+                    raise ValueError(f'{chunk_name(v, year, prefix)} has different time steps '
+                                     f'than {chunk_name(instant[0], year, prefix)}')
+            sums = {}
+            for v in accumulated:
+                f = fields[v]
+                blocks = [f.area_mean(start, min(start + STEP_HOURS * blocksize, len(f)))
+                          for start in range(0, len(f), STEP_HOURS * blocksize)]
+                hourly_time, hourly = tail.get(v, (f.time[:0], np.zeros(0)))
+                hourly_time = np.concatenate([hourly_time, f.time])
+                hourly = np.concatenate([hourly] + blocks)
+                sums[v] = window_sums(hourly_time, hourly, time)
+                tail[v] = hourly_time[-(STEP_HOURS - 1):], hourly[-(STEP_HOURS - 1):]
+            for start in range(0, len(time), blocksize):
+                stop = min(start + blocksize, len(time))
+                means = {v: fields[v].area_mean(start, stop) for v in instant}
+                means.update({v: sums[v][start:stop] for v in accumulated})
+                yield forcing_from_era5(means, time[start:stop])
+        finally:
+            for f in fields.values():
+                f.close()
+
+
+def fit_bias_correction(era5, station, methods=BIAS_METHODS):
+    """ Monthly bias-correction coefficients
+
+    Parameters
+    ----------
+
+    era5 : pandas.DataFrame
+        Uncorrected forcing (MET_COLUMNS), e.g. pd.concat(era5_blocks(...))
+
+    station : pandas.DataFrame
+        Station observations with YEAR, MONTH, DAY, HOUR and any of the
+        forcing columns; only time steps present in both are used
+
+    methods : dict
+        'delta' or 'scale' for each forcing column
+
+    Returns
+    -------
+
+    coeffs : pandas.DataFrame
+        One row per month (1-12), one column per corrected variable.
+        Months without overlapping data get 0 (delta) or 1 (scale).
+
+    """
+    keys = ['YEAR', 'MONTH', 'DAY', 'HOUR']
+    columns = [c for c in methods if c in station.columns]
+    both = pd.merge(era5[keys + columns], station[keys + columns], on=keys, suffixes=('', '_obs'))
+    coeffs = pd.DataFrame(index=pd.Index(range(1, 13), name='MONTH'))
+    for c in columns:
+        ok = both[[c, c + '_obs']].notna().all(axis=1)
+        monthly = both[ok].groupby('MONTH')[[c, c + '_obs']].mean()
+        if methods[c] == 'delta':
+            coeffs[c] = (monthly[c + '_obs'] - monthly[c]).reindex(coeffs.index).fillna(0.)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = monthly[c + '_obs'] / monthly[c]
+            coeffs[c] = ratio.replace([np.inf, -np.inf], np.nan).reindex(coeffs.index).fillna(1.)
+    return coeffs
+
+
+def load_bias_correction(cachefile, era5=None, station=None, methods=BIAS_METHODS):
+    """ Cached bias-correction coefficients, fitted and saved on first use
+
+    Parameters
+    ----------
+
+    cachefile : str
+        CSV file with the coefficients
+
+    era5 : pandas.DataFrame or callable
+        Uncorrected forcing, or a function returning it; only used if the
+        cache does not exist yet
+
+    station : pandas.DataFrame
+        Station observations, only used if the cache does not exist yet
+
+    methods : dict
+        See fit_bias_correction
+
+    Returns
+    -------
+
+    coeffs : pandas.DataFrame
+
+    """
+    if os.path.exists(cachefile):
+        return pd.read_csv(cachefile, index_col='MONTH')
+    if era5 is None or station is None:
+        raise FileNotFoundError(f'No bias correction in {cachefile} and no data to fit one')
+    coeffs = fit_bias_correction(era5() if callable(era5) else era5, station, methods)
+    coeffs.to_csv(cachefile)
+    return coeffs
+
+
+def apply_bias_correction(table, coeffs, methods=BIAS_METHODS):
+    """ Apply monthly coefficients to a forcing table (returns a copy) """
+    table = table.copy()
+    month = table['MONTH'].values
+    for c in coeffs.columns:
+        k = coeffs[c].reindex(range(1, 13)).values[month - 1]
+        table[c] = table[c] + k if methods[c] == 'delta' else table[c] * k
+    if 'RH' in coeffs.columns:
+        table['RH'] = table['RH'].clip(0., 100.)
+    for c in ('WIND', 'SSRD', 'TP'):
+        if c in coeffs.columns:
+            table[c] = table[c].clip(lower=0.)
+    return table
+
+
+def write_met_input(cache_dir, outfile, first_year, last_year, coeffs=None, methods=BIAS_METHODS,
+                    blocksize=1460, fmt='%g', binary=False, prefix='Imandra_ERA5'):
+    """ Stream ERA5 chunks into a met-input forcing file
+
+    Parameters
+    ----------
+
+    cache_dir, first_year, last_year, blocksize, prefix :
+        See era5_blocks
+
+    outfile : str
+        Forcing file to write
+
+    coeffs : pandas.DataFrame
+        Bias-correction coefficients (see load_bias_correction); None
+        writes uncorrected forcing
+
+    methods : dict
+        See fit_bias_correction
+
+    fmt : str
+        Number format of the text file
+
+    binary : bool
+        Write a binary met-input file (see met_io) instead of text
+
+    Returns
+    -------
+
+    n : int
+        Number of time steps written
+
+    """
+    out = MetInputWriter(outfile, MET_COLUMNS) if binary else open(outfile, 'w')
+    n = 0
+    try:
+        for table in era5_blocks(cache_dir, first_year, last_year, blocksize, prefix):
+            if coeffs is not None:
+                table = apply_bias_correction(table, coeffs, methods)
+            if binary:
+                out.write(table.values)
+            else:
+                write_met_text(out, table.values, fmt)
+            n += len(table)
+    finally:
+        out.close()
+    return n
+
+
+if __name__ == '__main__':
+    cache_dir, outfile = sys.argv[1], sys.argv[2]
+    first_year, last_year = int(sys.argv[3]), int(sys.argv[4])
+    coeffs = None
+    if len(sys.argv) > 5:
+        station = pd.read_csv(sys.argv[5], sep=r'\s+')
+        coeffs = load_bias_correction('bias-correction.csv',
+                                      lambda: pd.concat(era5_blocks(cache_dir, first_year, last_year)),
+                                      station)
+    write_met_input(cache_dir, outfile, first_year, last_year, coeffs)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Loader for the lake-model outputs of a hypercube calibration.
+
+Reads one year of daily values from every surface*.txt / profile-laketemp*.txt
+trial file in parallel, takes the trial number from the end of the file name
+(e.g. profile-laketemp123.txt -> 123) and returns the values as a
+(trials x days x columns) cube sorted by trial number. The cube is cached in
+a columnar .npz file next to the outputs, keyed by each file's path, size and
+modification time, so a rerun only parses files that are new or changed.
+"""
+
+import glob
+import itertools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from profiling import stage
+
+_TRIAL = re.compile(r'(\d+)\.txt$')
+
+
+def trial_number(path):
+    """ Trial number at the end of a lake-model output file name """
+    match = _TRIAL.search(os.path.basename(path))
+    if match is None:
+        raise ValueError(f'No trial number in file name {path}')
+    return int(match.group(1))
+
+
+def read_trial_output(path, usecols, skiprows=1461, nrows=365):
+    """ Read ``nrows`` days of the given columns from one output file
+
+    Same rows as pd.read_csv(path, delim_whitespace=True, header=0,
+    skiprows=skiprows, nrows=nrows): the line after the skipped ones is taken
+    as a header and the following ``nrows`` lines are read. Skipped lines are
+    not tokenized.
+
+    Returns
+    -------
+
+    values : 2D array (nrows x len(usecols))
+
+    """
+    with open(path) as fh:
+        lines = [line for line in itertools.islice(fh, skiprows + 1, skiprows + 1 + nrows) if line.strip()]
+    return np.loadtxt(lines, usecols=usecols, ndmin=2)
+
+
+def _read_cache(cachefile, settings):
+    try:
+        cache = np.load(cachefile, allow_pickle=False)
+    except (OSError, ValueError):
+        return {}
+    with cache:
+        if str(cache['settings']) != settings:
+            return {}
+        return {str(p): (int(size), float(mtime), values)
+                for p, size, mtime, values in zip(cache['path'], cache['size'], cache['mtime'], cache['values'])}
+
+
+def load_trials(path, prefix='profile-laketemp', usecols=(4,), skiprows=1461, nrows=365,
+                cache=True, workers=None, processes=False):
+    """ Load one year of lake-model output for every trial
+
+    Parameters
+    ----------
+
+    path : str
+        Directory with the trial output files
+
+    prefix : str
+        File name prefix, 'surface' or 'profile-laketemp'
+
+    usecols : sequence of int
+        Columns to read (e.g. the depth layers of a profile file)
+
+    skiprows, nrows : int
+        Rows skipped before the header line, and number of days read
+
+    cache : bool or str
+        Cache file; True puts '<prefix>-cache.npz' in ``path``, False disables it
+
+    workers : int
+        Number of parallel readers (None: executor default)
+
+    processes : bool
+        Use a process pool instead of threads (call from a __main__ guarded
+        script on Windows)
+
+    Returns
+    -------
+
+    trials : 1D int array
+        Trial numbers, ascending
+
+    cube : 3D array
+        Values with shape (trials, nrows, len(usecols))
+
+    """
+    usecols = tuple(int(c) for c in usecols)
+    files = glob.glob(os.path.join(path, prefix + '*.txt'))
+    files = sorted((f for f in files if _TRIAL.search(os.path.basename(f))), key=trial_number)
+    stats = [os.stat(f) for f in files]
+
+    if cache is True:
+        cache = os.path.join(path, prefix + '-cache.npz')
+    settings = repr((usecols, skiprows, nrows))
+    cached = _read_cache(cache, settings) if cache else {}
+
+    values = [None] * len(files)
+    todo = []
+    for k, (f, st) in enumerate(zip(files, stats)):
+        hit = cached.get(os.path.abspath(f))
+        if hit is not None and hit[0] == st.st_size and hit[1] == st.st_mtime:
+            values[k] = hit[2]
+        else:
+            todo.append(k)
+
+    if todo:
+        reader = partial(read_trial_output, usecols=usecols, skiprows=skiprows, nrows=nrows)
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with stage('load_trials', items=len(todo), prefix=prefix, cached=len(files) - len(todo),
+                   processes=bool(processes)):
+            with Executor(max_workers=workers) as pool:
+                for k, v in zip(todo, pool.map(reader, [files[k] for k in todo])):
+                    values[k] = v
+
+    cube = np.stack(values) if values else np.zeros((0, nrows, len(usecols)))
+    trials = np.array([trial_number(f) for f in files], dtype=int)
+
+    if cache and (todo or len(cached) != len(files)):
+        np.savez(cache,
+                 settings=np.array(settings),
+                 path=np.array([os.path.abspath(f) for f in files], dtype=str),
+                 size=np.array([st.st_size for st in stats], dtype=np.int64),
+                 mtime=np.array([st.st_mtime for st in stats], dtype=float),
+                 values=cube)
+    return trials, cube
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter space of the lake and runoff model calibration.
+
+Each parameter has a name, a range, the column it takes in the
+lake-params-*.txt Latin hypercube files (values between 0 and 1), a transform
+from those unit values to the parameter range and whether it is rounded to an
+integer. LAKE_PARAMETERS holds the ranges used in writeParameter-original.f90
+and Calibrate_Temp.py.
+
+ParameterSpace draws Latin hypercube batches in unit coordinates, writes them
+in the lake-params-*.txt layout and scales them to parameter values. For
+sequential calibration, refine draws the next batch only inside the box
+spanned by the currently acceptable trials (widened by a margin), so fewer
+lake-model runs are spent where NSE is poor.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class Parameter:
+    """ One calibrated parameter
+
+    Parameters
+    ----------
+
+    name : str
+
+    low, high : float
+        Parameter range
+
+    column : int
+        Column of the parameter in lake-params-*.txt
+
+    transform : {'linear', 'log'}
+        Scaling of unit values to [low, high]: linear, or linear in log10
+
+    integer : bool
+        Round scaled values to the nearest integer
+
+    label : str
+        Axis label, the name by default
+
+    """
+
+    def __init__(self, name, low, high, column, transform='linear', integer=False, label=None):
+        if transform not in ('linear', 'log'):
+            raise ValueError(f"transform must be 'linear' or 'log', not {transform!r}")
+        if transform == 'log' and low <= 0:
+            raise ValueError(f'{name}: a log transform needs a positive range')
+        self.name = name
+        self.low = low
+        self.high = high
+        self.column = column
+        self.transform = transform
+        self.integer = integer
+        self.label = label or name
+
+    def __repr__(self):
+        return (f'Parameter({self.name!r}, {self.low!r}, {self.high!r}, column={self.column}, '
+                f'transform={self.transform!r}, integer={self.integer})')
+
+    def scale(self, u):
+        """ Unit values (0-1) to parameter values """
+        u = np.asarray(u, dtype=float)
+        if self.transform == 'log':
+            lo, hi = np.log10(self.low), np.log10(self.high)
+            x = 10 ** (lo + (hi - lo) * u)
+        else:
+            x = self.low + (self.high - self.low) * u
+        return np.round(x) if self.integer else x
+
+    def unscale(self, x):
+        """ Parameter values to unit values """
+        x = np.asarray(x, dtype=float)
+        if self.transform == 'log':
+            lo, hi = np.log10(self.low), np.log10(self.high)
+            return (np.log10(x) - lo) / (hi - lo)
+        return (x - self.low) / (self.high - self.low)
+
+    def unit_step(self):
+        """ Half an integer step in unit coordinates (0 for continuous parameters) """
+        if not self.integer:
+            return 0.
+        return 0.5 / (self.high - self.low)
+
+
+class ParameterSpace:
+    """ Ordered set of Parameters with Latin hypercube sampling
+
+    Parameters
+    ----------
+
+    parameters : list of Parameter
+
+    """
+
+    def __init__(self, parameters):
+        self.parameters = list(parameters)
+        self._index = {p.name: k for k, p in enumerate(self.parameters)}
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def __iter__(self):
+        return iter(self.parameters)
+
+    def __getitem__(self, name):
+        return self.parameters[self._index[name]]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def names(self):
+        return [p.name for p in self.parameters]
+
+    @property
+    def labels(self):
+        return {p.name: p.label for p in self.parameters}
+
+    @property
+    def ranges(self):
+        return {p.name: (p.low, p.high) for p in self.parameters}
+
+    def subset(self, names):
+        """ Space of the named parameters only """
+        return ParameterSpace([self[name] for name in names])
+
+    def scale(self, unit):
+        """ Scale a (trials x parameters) unit matrix to a DataFrame of parameter values """
+        unit = np.atleast_2d(np.asarray(unit, dtype=float))
+        return pd.DataFrame({p.name: p.scale(unit[:, k]) for k, p in enumerate(self.parameters)})
+
+    def unscale(self, values):
+        """ Parameter values (DataFrame with the parameter columns) to a unit matrix """
+        return np.column_stack([p.unscale(values[p.name]) for p in self.parameters])
+
+    def from_table(self, table, first_trial=1):
+        """ Scale the raw columns of a lake-params-*.txt table
+
+        Parameters
+        ----------
+
+        table : pandas.DataFrame or 2D array
+            Unit values as read from lake-params-*.txt, one row per trial
+
+        first_trial : int
+            Trial number of the first row (e.g. 1001 for a refinement batch
+            run after lake-params-1000.txt)
+
+        Returns
+        -------
+
+        params : pandas.DataFrame
+            One column per parameter, and a 'trial' column numbering the rows
+            from ``first_trial``
+
+        """
+        raw = np.asarray(table, dtype=float)
+        params = self.scale(raw[:, [p.column for p in self.parameters]])
+        params['trial'] = range(first_trial, first_trial + len(params))
+        return params
+
+    def to_table(self, unit):
+        """ Arrange a (trials x parameters) unit matrix in lake-params-*.txt column order """
+        unit = np.atleast_2d(np.asarray(unit, dtype=float))
+        table = np.zeros((len(unit), max(p.column for p in self.parameters) + 1))
+        for k, p in enumerate(self.parameters):
+            table[:, p.column] = unit[:, k]
+        return table
+
+    def write_table(self, path, unit):
+        """ Write a unit matrix as a lake-params-*.txt file """
+        np.savetxt(path, self.to_table(unit), fmt='%.15g', delimiter='\t', newline='\r\n')
+
+    def sample(self, n, seed=None, low=None, high=None):
+        """ Latin hypercube sample in unit coordinates
+
+        Parameters
+        ----------
+
+        n : int
+            Number of trials
+
+        seed : int or numpy.random.Generator
+
+        low, high : 1D arrays
+            Unit-coordinate box to sample (the whole space by default)
+
+        Returns
+        -------
+
+        unit : 2D array (n x parameters)
+
+        """
+        rng = np.random.default_rng(seed)
+        d = len(self.parameters)
+        low = np.zeros(d) if low is None else np.asarray(low, dtype=float)
+        high = np.ones(d) if high is None else np.asarray(high, dtype=float)
+        strata = np.argsort(rng.random((n, d)), axis=0)  # an independent permutation per column
+        u = (strata + rng.random((n, d))) / n
+        return low + (high - low) * u
+
+    def refine(self, accepted, n, margin=0.1, seed=None):
+        """ Latin hypercube batch inside the region of the acceptable trials
+
+        Parameters
+        ----------
+
+        accepted : pandas.DataFrame
+            Parameter values of the currently acceptable trials (e.g. the
+            trials with NSE >= 0.85)
+
+        n : int
+            Number of trials in the new batch
+
+        margin : float
+            Fraction of each parameter's full unit range added on both
+            sides of the box spanned by the acceptable trials
+
+        seed : int or numpy.random.Generator
+
+        Returns
+        -------
+
+        unit : 2D array (n x parameters)
+            New batch in unit coordinates; the whole space is sampled if
+            there are no acceptable trials
+
+        """
+        if len(accepted) == 0:
+            return self.sample(n, seed)
+        unit = self.unscale(accepted)
+        pad = np.array([max(margin, p.unit_step()) for p in self.parameters])
+        low = np.clip(np.nanmin(unit, axis=0) - pad, 0., 1.)
+        high = np.clip(np.nanmax(unit, axis=0) + pad, 0., 1.)
+        return self.sample(n, seed, low, high)
+
+
+LAKE_PARAMETERS = ParameterSpace([
+    Parameter('cdrn', 1.e-3, 3.e-3, 0),  # neutral drag coefficient
+    Parameter('eta', 0.2, 0.7, 1),  # shortwave extinction coefficient
+    Parameter('albsnow', 0.7, 0.9, 2, label='alb snow'),  # snow albedo
+    Parameter('albslush', 0.4, 0.7, 3, label='alb slush'),  # slush albedo
+    Parameter('csed', 2.e6, 4.e6, 4),  # sediment specific heat capacity
+    Parameter('condsed', 0.5, 2.5, 5),  # sediment thermal conductivity
+    Parameter('albsed', 0.05, 0.2, 6, label='alb sed'),  # sediment albedo
+    Parameter('d18Oa', -42.1, -18.1, 7),
+    Parameter('d2ha', -322.8, -133.9, 8, label='d2Ha'),
+    Parameter('f', 0., 1., 9),
+    Parameter('melt_ratio', 0.05, 1., 10, label='melt ratio'),
+    Parameter('rp_ratio_summer', 0.05, 1., 11, label='rp ratio summer'),
+    Parameter('rp_ratio_winter', 0.05, 1., 12, label='rp ratio winter'),
+    Parameter('rsm_ratio', 0.05, 1., 13, label='rsm ratio'),
+    Parameter('p', 0., 100., 14),  # smoothing period
+    Parameter('s', 0., 10., 15),  # smoothing sigma
+    Parameter('thresh_spring', 0., 20., 16, integer=True, label='thresh spring'),  # days above freezing
+    Parameter('thresh_fall', 0., 20., 17, integer=True, label='thresh fall'),
+])
+
+# Parameters of the runoff model (runoff_model.generate_runoff)
+RUNOFF_PARAMETERS = LAKE_PARAMETERS.subset(['melt_ratio', 'rp_ratio_summer', 'rp_ratio_winter', 'rsm_ratio',
+                                            'p', 's', 'thresh_spring', 'thresh_fall'])
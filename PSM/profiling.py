@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of pipeline stages.
+
+Pipeline functions wrap their main steps in ``stage(name, items=...)``.
+Nothing is measured unless profiling is switched on, with enable(logfile) or
+by setting the PSM_PROFILE environment variable to a log file before the
+modules are imported; a disabled stage costs one attribute check. When on,
+every stage appends one JSON line to the log with its wall time, its peak
+traced memory above the memory in use when it started (tracemalloc, which
+sees NumPy buffers) and its throughput in items per second, so runs with
+growing ensemble sizes and record lengths can be compared afterwards.
+
+Stages may be nested; each reports its own peak. Worker processes of a pool
+log their own stages, with their pid, when profiling is on in them (forked
+while enabled, or started with PSM_PROFILE set).
+
+Examples
+--------
+
+>>> enable('profile.jsonl')
+>>> with stage('load_trials', items=len(files), prefix='surface') as st:
+...     ...
+>>> read_log('profile.jsonl')
+"""
+
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+_state = {'logfile': os.environ.get('PSM_PROFILE') or None, 'memory': True}
+_stack = []
+
+
+def enable(logfile, memory=True):
+    """ Record stages to a JSON lines file
+
+    Parameters
+    ----------
+
+    logfile : str
+        Log file, appended to
+
+    memory : bool
+        Trace memory (tracemalloc slows down code that allocates many small
+        Python objects)
+
+    """
+    _state['logfile'] = logfile
+    _state['memory'] = memory
+
+
+def disable():
+    """ Stop recording stages """
+    _state['logfile'] = None
+
+
+def enabled():
+    return _state['logfile'] is not None
+
+
+@contextmanager
+def profile(logfile, memory=True):
+    """ Record stages to logfile within a with block, then restore the previous setting """
+    previous = dict(_state)
+    enable(logfile, memory)
+    try:
+        yield
+    finally:
+        _state.update(previous)
+
+
+class stage:
+    """ Context manager timing one pipeline stage
+
+    Parameters
+    ----------
+
+    name : str
+        Stage name
+
+    items : int
+        Items processed (trials, time steps, files, ...); can also be set
+        on the returned object before the stage ends
+
+    **info
+        Further fields for the log record (sizes, settings)
+
+    """
+
+    def __init__(self, name, items=None, **info):
+        self.name = name
+        self.items = items
+        self.info = info
+        self.record = None
+
+    def __enter__(self):
+        if _state['logfile'] is None:
+            return self
+        self._memory = _state['memory']
+        if self._memory:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if _stack:
+                _stack[-1]._peak = max(_stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._start_memory = current
+            self._peak = current
+        _stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not _stack or _stack[-1] is not self:
+            return False
+        wall = time.perf_counter() - self._start
+        _stack.pop()
+        record = {'stage': self.name, 'wall_s': wall}
+        if self._memory:
+            peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = peak - self._start_memory
+            if _stack:
+                _stack[-1]._peak = max(_stack[-1]._peak, peak)
+            elif self._started_tracing:
+                tracemalloc.stop()
+        if self.items is not None:
+            record['items'] = self.items
+            record['items_per_s'] = self.items / wall if wall > 0 else None
+        record.update(self.info)
+        record.update({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid(), 'failed': exc[0] is not None})
+        self.record = record
+        if _state['logfile'] is not None:
+            with open(_state['logfile'], 'a') as fh:
+                fh.write(json.dumps(record) + '\n')
+        return False
+
+
+def read_log(logfile):
+    """ Stage records of a log as a DataFrame, one row per stage """
+    with open(logfile) as fh:
+        return pd.DataFrame([json.loads(line) for line in fh if line.strip()])
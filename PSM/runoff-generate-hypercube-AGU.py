@@ -3,8 +3,9 @@ import warnings
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import math
-from math import sqrt, pi, exp
+
+from met_io import ACC_COLUMNS, write_met_binary, write_met_text
+from runoff_model import generate_runoff
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.seterr(divide='ignore')
@@ -23,6 +24,7 @@ piso_data.columns = ['MONTH', 'd2H', 'd18O']
 
 exportfile = 'met-input.txt'
 accexportfile = 'acc-met-input.txt'
+export_binary = False  # True: write met-input.bin + acc-met-input.bin (ACC columns only) instead, see met_io.py
 
 show_plt = False
 
@@ -44,150 +46,32 @@ thresh_spring = round(thresh_spring)
 thresh_fall = round(thresh_fall)
 thresh_avg = False
 
-glacier_2H = min(piso_data['d2H'])  # glacier isotopes default to minimum monthly precip values
-glacier_18O = min(piso_data['d18O'])
-
-# Can change months where summer/winter rp ratios apply
-rp_ratio_months = [np.repeat(rp_ratio_winter, 4), np.repeat(rp_ratio_summer, 5), np.repeat(rp_ratio_winter, 3)] # based on growing season
-rp_ratio_months = np.concatenate(rp_ratio_months)
+# Can change months where summer/winter rp ratios apply in runoff_model.rp_ratio_by_month
 
 # =============================================================================
 # =========================== Calculate runoff ================================
 # =============================================================================
 
+runoff = generate_runoff(met_data, piso_data, melt_ratio, rp_ratio_summer, rp_ratio_winter, rsm_ratio,
+                         p, s, thresh_spring, thresh_fall, thresh_avg=thresh_avg, glacier_flux=glacier_flux)
+
 M_tp = met_data['TP']
 M_T2M = met_data['T2M']
 month = met_data['MONTH'].astype(int)
 
-d2H = piso_data['d2H'].values
-d18O = piso_data['d18O'].values
-
-M_d18O = np.zeros(len(month))
-M_d2H = np.zeros(len(month))
-
-for i in range(len(month)):
-    M_d2H[i] = d2H[(month[i] - 1)]
-    M_d18O[i] = d18O[(month[i] - 1)]
-
-M_acc = np.zeros(len(month))
-M_runoff = np.zeros(len(month))
-M_acc_d2H = np.zeros(len(month))
-M_acc_d18O = np.zeros(len(month))
-M_runoff_d2H = np.zeros(len(month))
-M_runoff_d18O = np.zeros(len(month))
-
+M_d2H = runoff['d2HP']
+M_d18O = runoff['d18OP']
+M_acc = runoff['ACC']
+M_acc_d2H = runoff['d2HACC']
+M_acc_d18O = runoff['d18OACC']
+M_runoff = runoff['runoff_raw']
+M_runoff_d2H = runoff['runoff_d2H_raw']
+M_runoff_d18O = runoff['runoff_d18O_raw']
 
-
-thresh_list_spring = list()
-thresh_list_fall = list()
-
-## Make if statement for spring temp threshold
-if thresh_avg == False:
-    if thresh_spring == 0:
-        if_state_spring = 'M_T2M[i] > 273'
-    else:
-        for j in range(int(thresh_spring)):
-            thresh_list_spring.append('M_T2M[i-' + str(j * 4) + ']>273 and M_T2M[i-' + str(j * 4 + 1) + ']>273 and')
-        if_state_spring = ' '.join(thresh_list_spring)[0:-4]
-else:
-    if thresh_spring == 0:
-        if_state_spring = 'M_T2M[i] > 273'
-    else:
-        for j in range(int(thresh_spring)):
-            thresh_list_spring.append('mean([M_T2M[i-' + str(j * 4) + '], M_T2M[i-' + str(j * 4 + 1) + ']])>273 and')
-        if_state_spring = ' '.join(thresh_list_spring)[0:-4]
-
-## Make if statement for fall temp threshold
-if thresh_avg == False:
-    if thresh_fall == 0:
-        if_state_fall = 'M_T2M[i] < 273'
-    else:
-        for j in range(int(thresh_fall)):
-            thresh_list_fall.append('M_T2M[i-' + str(j * 4) + ']<273 and M_T2M[i-' + str(j * 4 + 1) + ']<273 and')
-        if_state_fall = ' '.join(thresh_list_fall)[0:-4]
-else:
-    if thresh_fall == 0:
-        if_state_fall = 'M_T2M[i] < 273'
-    else:
-        for j in range(int(thresh_fall)):
-            thresh_list_fall.append('mean([M_T2M[i-' + str(j * 4) + '], M_T2M[i-' + str(j * 4 + 1) + ']])<273 and')
-        if_state_fall = ' '.join(thresh_list_fall)[0:-4]
-
-
-
-for i in range(len(month)):
-    M_acc[0] = 0
-    M_acc_d2H[0] = M_d2H[0]
-    M_acc_d18O[0] = M_d18O[0]
-
-    rp_ratio = rp_ratio_months[(month[i] - 1)]
-
-    if ((eval(if_state_spring) and (month[i] in range(0, 7) or month[i] in range(11,13))) or #Spring statement applies Nov-June
-         (M_T2M[i] > 273 and month[i] in range(7,9)) or #No threshold for July-Aug
-           (month[i] in range(9, 11)) and eval(if_state_fall) == False ): #Fall-winter threshold applies Sept-Dec
-
-        M_runoff[i] = (M_tp[i] * rp_ratio) + (M_acc[i - 1] * melt_ratio * rsm_ratio) + (
-                glacier_flux * rsm_ratio)
-        if M_runoff[i] < 0.0001:  # to prevent rounding errors with v low run-off amounts
-            M_acc[i] = M_acc[i - 1]
-            M_runoff_d2H[i] = 'NaN'
-            M_acc_d2H[i] = M_acc_d2H[i - 1]
-            M_runoff_d18O[i] = 'NaN'
-            M_acc_d18O[i] = M_acc_d18O[i - 1]
-        else:
-            M_acc[i] = M_acc[i - 1] * (1 - melt_ratio)
-            M_runoff_d2H[i] = (M_tp[i] * rp_ratio * M_d2H[i] / M_runoff[i]) + \
-                              (M_acc[i - 1] * melt_ratio * rsm_ratio * M_acc_d2H[i - 1] / M_runoff[i]) + \
-                              (glacier_flux * rsm_ratio * glacier_2H / M_runoff[i])
-            M_acc_d2H[i] = M_acc_d2H[i - 1]
-
-            M_runoff_d18O[i] = (M_tp[i] * rp_ratio * M_d18O[i] / M_runoff[i]) + \
-                               (M_acc[i - 1] * melt_ratio * rsm_ratio * M_acc_d18O[i - 1] / M_runoff[i]) + \
-                               (glacier_flux * rsm_ratio * glacier_18O / M_runoff[i])
-            M_acc_d18O[i] = M_acc_d18O[i - 1]
-
-    else:
-        M_runoff[i] = 0
-        M_acc[i] = M_acc[i - 1] + M_tp[i]
-        M_runoff_d2H[i] = 'NaN'
-        M_runoff_d18O[i] = 'NaN'
-
-        if M_acc[i - 1] == 0 and M_tp[i] == 0:
-            M_acc_d2H[i] = 'NaN'
-            M_acc_d18O[i] = 'NaN'
-        elif M_acc[i - 1] == 0 and M_tp[i] > 0:
-            M_acc_d2H[i] = M_d2H[i]
-            M_acc_d18O[i] = M_d18O[i]
-        else:
-            M_acc_d2H[i] = ((M_acc[i - 1] * M_acc_d2H[i - 1]) / (M_acc[i - 1] + M_tp[i])) + (
-                    (M_tp[i] * (M_d2H[i])) / (M_acc[i - 1] + (M_tp[i])))
-
-            M_acc_d18O[i] = ((M_acc[i - 1] * M_acc_d18O[i - 1]) / (M_acc[i - 1] + M_tp[i])) + (
-                    (M_tp[i] * (M_d18O[i])) / (M_acc[i - 1] + (M_tp[i])))
-
-    if np.isnan(M_runoff_d18O[i]):
-        M_runoff_d18O[i] = d18O[(month[i] - 1)]
-        M_runoff_d2H[i] = d2H[(month[i] - 1)]
-
-
-## Smooth runoff across timesteps
-
-def gtail_wma(arr, period, sigma):
-    period = math.ceil(period / 2.) * 2  # period must even, rounded up if odd
-    r = range(-int(period / 2), int(period / 2) + 1)
-    kernel = np.asarray([1 / (sigma * sqrt(2 * pi)) * exp(-float(x) ** 2 / (2 * sigma ** 2)) for x in r])
-    kernel[range(int(period / 2 + 1), int(period + 1))] = 0
-    knorm = np.flip(kernel / kernel.sum())
-    return np.convolve(arr, knorm, 'same')
-
-
-M_runoff_wma = gtail_wma(M_runoff, period=p, sigma=s)
-
-M_runoff_d2H_wma = gtail_wma(M_runoff * M_runoff_d2H, period=p, sigma=s) / M_runoff_wma
-M_runoff_d18O_wma = gtail_wma(M_runoff * M_runoff_d18O, period=p, sigma=s) / M_runoff_wma
-
-M_runoff_d2H_wma[np.isnan(M_runoff_d2H_wma)] = M_runoff_d2H[np.isnan(M_runoff_d2H_wma)]
-M_runoff_d18O_wma[np.isnan(M_runoff_d18O_wma)] = M_runoff_d18O[np.isnan(M_runoff_d18O_wma)]
+## Smoothed runoff across timesteps
+M_runoff_wma = runoff['RUNOFF']
+M_runoff_d2H_wma = runoff['d2HR']
+M_runoff_d18O_wma = runoff['d18OR']
 
 if show_plt:
     plt.figure(figsize=(20, 12))
@@ -236,11 +120,19 @@ met_data['d18OR'] = M_runoff_d18O_wma
 met_data['d2HP'] = M_d2H
 met_data['d2HR'] = M_runoff_d2H_wma
 
-np.savetxt(exportfile, met_data, '%2.3f', delimiter='\t')
+if export_binary:
+    write_met_binary(os.path.splitext(exportfile)[0] + '.bin', met_data, met_data.columns)
+else:
+    write_met_text(exportfile, met_data)
 
 # Export other values w/in runoff calc to compare to obs #========================================
 
-met_data['ACC'] = M_acc
-met_data['d2HACC'] = M_acc_d2H
-met_data['d18OACC'] = M_acc_d18O
-np.savetxt(accexportfile, met_data, '%2.3f', delimiter='\t')
+if export_binary:
+    # side table only; binary_to_text(met-input.bin, ..., sidecar=acc-met-input.bin) gives the full acc layout
+    write_met_binary(os.path.splitext(accexportfile)[0] + '.bin',
+                     np.column_stack([M_acc, M_acc_d2H, M_acc_d18O]), ACC_COLUMNS)
+else:
+    met_data['ACC'] = M_acc
+    met_data['d2HACC'] = M_acc_d2H
+    met_data['d18OACC'] = M_acc_d18O
+    write_met_text(accexportfile, met_data)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Batch runoff generation for the whole Latin-hypercube parameter matrix.
+
+Instead of one runoff-generate-hypercube-AGU.py invocation per parameter set,
+the forcing and monthly precipitation isotopes are read once, copied into
+shared memory and every trial in lake-params-*.txt is run through
+runoff_model.run_runoff on a process pool. Results come back as
+(trials x timesteps) arrays.
+
+Usage:
+    python runoff_batch.py lake-params-1000.txt runoff-ensemble.npz
+"""
+
+import sys
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from parameter_space import RUNOFF_PARAMETERS
+from profiling import stage
+from runoff_model import run_runoff
+
+MET_COLUMNS = ['YEAR', 'MONTH', 'DAY', 'HOUR', 'T2M', 'RH', 'WIND', 'SSRD', 'STRD', 'SP', 'TP']
+
+# Series returned for every trial
+BATCH_OUTPUTS = ['RUNOFF', 'd18OR', 'd2HR']
+
+# Forcing columns placed in shared memory, in this order
+_FORCING = ['T2M', 'TP', 'MONTH']
+
+
+def read_met_input(metfile='met-input-Imandra-MODERN-ERA5-6hrlycorr.txt'):
+    """ Read the tab separated 6-hourly met-input forcing file """
+    met_data = pd.read_csv(metfile, sep="\t", header=None)
+    met_data.columns = MET_COLUMNS
+    return met_data
+
+
+def read_isotope_seasonality(isofile='isotope-seasonality.csv'):
+    """ Read the monthly precipitation isotope values """
+    piso_data = pd.read_csv(isofile, header=None)
+    piso_data.columns = ['MONTH', 'd2H', 'd18O']
+    return piso_data
+
+
+def scale_runoff_params(params):
+    """ Scale raw hypercube values (0-1) to the runoff parameter ranges
+
+    Parameters
+    ----------
+
+    params : pandas.DataFrame or 2D array
+        Unscaled parameter matrix as read from lake-params-*.txt, one row
+        per trial
+
+    Returns
+    -------
+
+    scaled : pandas.DataFrame
+        One column per runoff parameter (see parameter_space.RUNOFF_PARAMETERS),
+        with a 'trial' column numbering the rows from 1
+
+    """
+    return RUNOFF_PARAMETERS.from_table(params)
+
+
+# Worker state, set once per process by _init_worker
+_shared = {}
+
+
+def _init_worker(forcing_name, forcing_shape, out_name, out_shape, d2H, d18O):
+    forcing_shm = shared_memory.SharedMemory(name=forcing_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    _shared['forcing_shm'] = forcing_shm
+    _shared['out_shm'] = out_shm
+    _shared['forcing'] = np.ndarray(forcing_shape, dtype=float, buffer=forcing_shm.buf)
+    _shared['out'] = np.ndarray(out_shape, dtype=float, buffer=out_shm.buf)
+    _shared['d2H'] = d2H
+    _shared['d18O'] = d18O
+
+
+def _close_worker():
+    forcing_shm = _shared['forcing_shm']
+    out_shm = _shared['out_shm']
+    _shared.clear()
+    forcing_shm.close()
+    out_shm.close()
+
+
+def _run_trial(task):
+    k, kwargs = task
+    T2M, TP, month = _shared['forcing']
+    res = run_runoff(T2M, TP, month, _shared['d2H'], _shared['d18O'], **kwargs)
+    for j, name in enumerate(BATCH_OUTPUTS):
+        _shared['out'][j, k] = res[name]
+    return k
+
+
+def run_batch(params, met_data, piso_data, processes=None, chunksize=4):
+    """ Run the runoff model for every parameter set of a hypercube
+
+    Parameters
+    ----------
+
+    params : pandas.DataFrame
+        Scaled runoff parameters, one row per trial (see scale_runoff_params)
+
+    met_data : pandas.DataFrame
+        6-hourly forcing (see read_met_input)
+
+    piso_data : pandas.DataFrame
+        Monthly precipitation isotopes (see read_isotope_seasonality)
+
+    processes : int
+        Number of worker processes; None uses all CPUs, 1 runs in this process
+
+    chunksize : int
+        Trials handed to a worker at a time
+
+    Returns
+    -------
+
+    out : dict of 2D arrays
+        RUNOFF, d18OR and d2HR with shape (trials, timesteps), plus the 1D
+        precipitation isotope series d18OP and d2HP shared by all trials
+
+    """
+    names = RUNOFF_PARAMETERS.names
+    tasks = [(k, {name: float(row[name]) for name in names})
+             for k, (_, row) in enumerate(params[names].iterrows())]
+    forcing = np.vstack([np.asarray(met_data[c], dtype=float) for c in _FORCING])
+    d2H = np.asarray(piso_data['d2H'].values, dtype=float)
+    d18O = np.asarray(piso_data['d18O'].values, dtype=float)
+    out_shape = (len(BATCH_OUTPUTS), len(tasks), forcing.shape[1])
+
+    forcing_shm = shared_memory.SharedMemory(create=True, size=forcing.nbytes)
+    out_shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(out_shape)) * 8, 1))
+    try:
+        np.ndarray(forcing.shape, dtype=float, buffer=forcing_shm.buf)[:] = forcing
+        initargs = (forcing_shm.name, forcing.shape, out_shm.name, out_shape, d2H, d18O)
+        with stage('run_batch', items=len(tasks), steps=forcing.shape[1], processes=processes):
+            if processes == 1:
+                _init_worker(*initargs)
+                for task in tasks:
+                    _run_trial(task)
+                _close_worker()
+            else:
+                with Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+                    for _ in pool.imap_unordered(_run_trial, tasks, chunksize=chunksize):
+                        pass
+        result = np.ndarray(out_shape, dtype=float, buffer=out_shm.buf).copy()
+    finally:
+        forcing_shm.close()
+        forcing_shm.unlink()
+        out_shm.close()
+        out_shm.unlink()
+
+    month = np.asarray(met_data['MONTH']).astype(int)
+    out = {name: result[j] for j, name in enumerate(BATCH_OUTPUTS)}
+    out['d18OP'] = d18O[month - 1]
+    out['d2HP'] = d2H[month - 1]
+    return out
+
+
+if __name__ == '__main__':
+    paramfile = sys.argv[1] if len(sys.argv) > 1 else 'lake-params-1000.txt'
+    outfile = sys.argv[2] if len(sys.argv) > 2 else 'runoff-ensemble.npz'
+
+    params = scale_runoff_params(pd.read_csv(paramfile, sep=r'\s+', header=None))
+    batch = run_batch(params, read_met_input(), read_isotope_seasonality())
+    np.savez(outfile, trial=params['trial'].values, **batch)
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Runoff and runoff-isotope engine for the Lake Imandra PSM.
+
+Callable version of the calculation in runoff-generate-hypercube-AGU.py. The
+spring/fall freezing thresholds are evaluated as array masks over the whole
+forcing record, and the snow accumulation/melt and isotope mixing recurrence
+runs in a single compiled (numba, if installed) or plain-float loop instead of
+eval()-ing a condition string at every 6-hourly step.
+
+Outputs are numerically identical to the original script.
+"""
+
+import numpy as np
+
+from profiling import stage
+from smoothing import smooth_runoff
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to the pure-Python kernel
+    njit = None
+
+FREEZING = 273  # K, threshold used for both the spring and fall conditions
+STEPS_PER_DAY = 4  # 6-hourly forcing
+
+# Months where the spring threshold applies (Nov-June), where there is no
+# threshold (July-Aug) and where the fall-winter threshold applies (Sept-Oct)
+SPRING_MONTHS = [0, 1, 2, 3, 4, 5, 6, 11, 12]
+SUMMER_MONTHS = [7, 8]
+FALL_MONTHS = [9, 10]
+
+
+def rp_ratio_by_month(rp_ratio_summer, rp_ratio_winter):
+    """ Monthly fraction of direct precip converted to runoff (growing season May-Sept) """
+    rp_ratio_months = [np.repeat(rp_ratio_winter, 4), np.repeat(rp_ratio_summer, 5), np.repeat(rp_ratio_winter, 3)]
+    return np.concatenate(rp_ratio_months)
+
+
+def _lagged_all(ok, thresh, thresh_avg=False, T2M=None, compare=None, steps_per_day=STEPS_PER_DAY):
+    """ Evaluate the freezing-threshold condition at every time step
+
+    Equivalent to the if_state_spring / if_state_fall strings built in the
+    original script: for each of the last ``thresh`` days, the step i-4j and
+    the step before it (i-4j-1) must both satisfy the condition (or, with
+    ``thresh_avg``, their mean must). With ``thresh == 0`` only step i is
+    checked. Look-backs that fall before the start of the record count as
+    not satisfying the condition.
+
+    Parameters
+    ----------
+
+    ok : 1D bool array
+        Condition evaluated at each step (e.g. T2M > 273)
+
+    thresh : int
+        Number of days the condition must hold
+
+    thresh_avg : bool
+        Use the mean of each step pair rather than requiring both
+
+    T2M : 1D array
+        Air temperature, only needed when ``thresh_avg`` is True
+
+    compare : ufunc
+        np.greater or np.less, only needed when ``thresh_avg`` is True
+
+    steps_per_day : int
+        Time steps per day of forcing
+
+    Returns
+    -------
+
+    mask : 1D bool array
+
+    """
+    n = len(ok)
+    if thresh == 0:
+        return ok.copy()
+
+    # condition on the pair (i, i-1)
+    pair = np.zeros(n, dtype=bool)
+    if thresh_avg:
+        pair[1:] = compare((T2M[1:] + T2M[:-1]) / 2, FREEZING)
+    else:
+        pair[1:] = ok[1:] & ok[:-1]
+
+    # count failures of the pair condition at i, i-4, ..., i-4*(thresh-1) with
+    # a cumulative sum along each phase of the day
+    lag = steps_per_day * thresh
+    fail = np.ones(lag + n + (-(lag + n) % steps_per_day), dtype=np.int64)
+    fail[lag:lag + n] = ~pair
+    csum = np.cumsum(fail.reshape(-1, steps_per_day), axis=0).ravel()
+    window = csum[lag:lag + n] - csum[:n]
+    return window == 0
+
+
+def threshold_masks(T2M, thresh_spring, thresh_fall, thresh_avg=False, steps_per_day=STEPS_PER_DAY):
+    """ Spring (all above freezing) and fall (all below freezing) threshold masks
+
+    Parameters
+    ----------
+
+    T2M : 1D array
+        6-hourly air temperature (K)
+
+    thresh_spring : int
+        Number of days above freezing required to allow runoff in spring
+
+    thresh_fall : int
+        Number of days below freezing required to stop runoff in fall
+
+    thresh_avg : bool
+        Test the mean of each pair of time steps rather than both steps
+
+    steps_per_day : int
+        Time steps per day of forcing
+
+    Returns
+    -------
+
+    spring, fall : 1D bool arrays
+
+    """
+    T2M = np.asarray(T2M, dtype=float)
+    spring = _lagged_all(T2M > FREEZING, int(thresh_spring), thresh_avg, T2M, np.greater, steps_per_day)
+    fall = _lagged_all(T2M < FREEZING, int(thresh_fall), thresh_avg, T2M, np.less, steps_per_day)
+    return spring, fall
+
+
+def combine_condition(T2M, month, spring, fall):
+    """ Runoff condition from the threshold masks and the month of each step """
+    T2M = np.asarray(T2M, dtype=float)
+    month = np.asarray(month).astype(int)
+    return ((spring & np.isin(month, SPRING_MONTHS)) |  # Spring statement applies Nov-June
+            ((T2M > FREEZING) & np.isin(month, SUMMER_MONTHS)) |  # No threshold for July-Aug
+            (np.isin(month, FALL_MONTHS) & ~fall))  # Fall-winter threshold applies Sept-Oct
+
+
+def runoff_condition(T2M, month, thresh_spring, thresh_fall, thresh_avg=False, steps_per_day=STEPS_PER_DAY):
+    """ Time steps where the catchment produces runoff (vs accumulating snow) """
+    spring, fall = threshold_masks(T2M, thresh_spring, thresh_fall, thresh_avg, steps_per_day)
+    return combine_condition(T2M, month, spring, fall)
+
+
+def _runoff_kernel(cond, tp, rp, p_d2H, p_d18O, melt_ratio, rsm_ratio,
+                   glacier_flux, glacier_2H, glacier_18O, acc_prev, acc_d2H_prev,
+                   acc_d18O_prev, first, single):
+    """ Snow accumulation/melt and isotope mixing recurrence
+
+    Port of the loop in the original script. The reservoir state (accumulated
+    precip and its isotopes) before the first step is passed in and the state
+    after the last step is returned, so a record can be run in pieces. With
+    ``first`` the steps are the start of the record and the original indexing
+    is reproduced: after step 0 the reservoir is reset to empty with the
+    first step's precipitation isotopes. ``single`` marks a record of one
+    step, whose only step starts from the empty reservoir; it is passed in
+    rather than read off the step count, since a record run in pieces can
+    start with a piece of one step.
+    """
+    n = len(tp)
+    M_acc = np.zeros(n)
+    M_runoff = np.zeros(n)
+    M_acc_d2H = np.zeros(n)
+    M_acc_d18O = np.zeros(n)
+    M_runoff_d2H = np.zeros(n)
+    M_runoff_d18O = np.zeros(n)
+
+    if first and single:
+        acc_prev, acc_d2H_prev, acc_d18O_prev = 0., p_d2H[0], p_d18O[0]
+
+    for i in range(n):
+        if cond[i]:
+            runoff = (tp[i] * rp[i]) + (acc_prev * melt_ratio * rsm_ratio) + (glacier_flux * rsm_ratio)
+            M_runoff[i] = runoff
+            if runoff < 0.0001:  # to prevent rounding errors with v low run-off amounts
+                M_acc[i] = acc_prev
+                M_runoff_d2H[i] = np.nan
+                M_acc_d2H[i] = acc_d2H_prev
+                M_runoff_d18O[i] = np.nan
+                M_acc_d18O[i] = acc_d18O_prev
+            else:
+                M_acc[i] = acc_prev * (1 - melt_ratio)
+                M_runoff_d2H[i] = (tp[i] * rp[i] * p_d2H[i] / runoff) + \
+                                  (acc_prev * melt_ratio * rsm_ratio * acc_d2H_prev / runoff) + \
+                                  (glacier_flux * rsm_ratio * glacier_2H / runoff)
+                M_acc_d2H[i] = acc_d2H_prev
+                M_runoff_d18O[i] = (tp[i] * rp[i] * p_d18O[i] / runoff) + \
+                                   (acc_prev * melt_ratio * rsm_ratio * acc_d18O_prev / runoff) + \
+                                   (glacier_flux * rsm_ratio * glacier_18O / runoff)
+                M_acc_d18O[i] = acc_d18O_prev
+        else:
+            M_runoff[i] = 0
+            M_acc[i] = acc_prev + tp[i]
+            M_runoff_d2H[i] = np.nan
+            M_runoff_d18O[i] = np.nan
+
+            if acc_prev == 0 and tp[i] == 0:
+                M_acc_d2H[i] = np.nan
+                M_acc_d18O[i] = np.nan
+            elif acc_prev == 0 and tp[i] > 0:
+                M_acc_d2H[i] = p_d2H[i]
+                M_acc_d18O[i] = p_d18O[i]
+            else:
+                M_acc_d2H[i] = ((acc_prev * acc_d2H_prev) / (acc_prev + tp[i])) + (
+                        (tp[i] * (p_d2H[i])) / (acc_prev + (tp[i])))
+                M_acc_d18O[i] = ((acc_prev * acc_d18O_prev) / (acc_prev + tp[i])) + (
+                        (tp[i] * (p_d18O[i])) / (acc_prev + (tp[i])))
+
+        if first and i == 0 and not single:
+            M_acc[0] = 0
+            M_acc_d2H[0] = p_d2H[0]
+            M_acc_d18O[0] = p_d18O[0]
+        acc_prev = M_acc[i]
+        acc_d2H_prev = M_acc_d2H[i]
+        acc_d18O_prev = M_acc_d18O[i]
+
+    return M_acc, M_runoff, M_acc_d2H, M_acc_d18O, M_runoff_d2H, M_runoff_d18O
+
+
+if njit is not None:
+    _runoff_kernel = njit(cache=True)(_runoff_kernel)
+
+
+# Reservoir state at the start of a record: no snowpack
+INITIAL_STATE = (0., 0., 0.)
+
+
+def run_reservoir(cond, TP, month, d2H, d18O, melt_ratio, rp_ratio_summer, rp_ratio_winter,
+                  rsm_ratio, glacier_flux=0., state=INITIAL_STATE, first=True, single=None):
+    """ Unsmoothed runoff and isotopes for given runoff-condition steps
+
+    Parameters
+    ----------
+
+    cond : 1D bool array
+        Steps with runoff (see runoff_condition)
+
+    TP, month : 1D arrays
+        Precipitation and month of each step
+
+    d2H, d18O : 1D arrays
+        The 12 monthly precipitation isotope values
+
+    state : tuple
+        Accumulated precip, its d2H and d18O before the first step
+
+    first : bool
+        The steps start the record (see _runoff_kernel)
+
+    single : bool
+        The steps are the whole record and it has one step; by default, when
+        they start the record and there is one of them. Pass False when a
+        longer record is run in pieces.
+
+    Other parameters are as in generate_runoff.
+
+    Returns
+    -------
+
+    out : dict of 1D arrays
+        d18OP, d2HP, ACC, d2HACC, d18OACC, runoff_raw, runoff_d2H_raw and
+        runoff_d18O_raw
+
+    state : tuple
+        Reservoir state after the last step
+
+    """
+    d2H = np.asarray(d2H, dtype=float)
+    d18O = np.asarray(d18O, dtype=float)
+    glacier_2H = min(d2H)  # glacier isotopes default to minimum monthly precip values
+    glacier_18O = min(d18O)
+
+    month = np.asarray(month).astype(int)
+    M_tp = np.asarray(TP, dtype=float)
+    M_d2H = d2H[month - 1]
+    M_d18O = d18O[month - 1]
+    rp = rp_ratio_by_month(rp_ratio_summer, rp_ratio_winter)[month - 1]
+
+    args = (np.asarray(cond, dtype=bool), M_tp, rp, M_d2H, M_d18O, float(melt_ratio), float(rsm_ratio),
+            float(glacier_flux), float(glacier_2H), float(glacier_18O)) + tuple(float(x) for x in state)
+    if single is None:
+        single = first and len(M_tp) == 1
+    args += (bool(first), bool(single))
+    if njit is None:
+        # plain Python floats are much faster to index than numpy scalars
+        args = tuple(a.tolist() if isinstance(a, np.ndarray) else a for a in args)
+    M_acc, M_runoff, M_acc_d2H, M_acc_d18O, M_runoff_d2H, M_runoff_d18O = _runoff_kernel(*args)
+    if len(M_acc):
+        state = (M_acc[-1], M_acc_d2H[-1], M_acc_d18O[-1])
+
+    # No runoff (or too little to carry an isotope signal): use monthly precipitation isotopes
+    fill = np.isnan(M_runoff_d18O)
+    M_runoff_d18O[fill] = M_d18O[fill]
+    M_runoff_d2H[fill] = M_d2H[fill]
+
+    return {'d18OP': M_d18O,
+            'd2HP': M_d2H,
+            'ACC': M_acc,
+            'd2HACC': M_acc_d2H,
+            'd18OACC': M_acc_d18O,
+            'runoff_raw': M_runoff,
+            'runoff_d2H_raw': M_runoff_d2H,
+            'runoff_d18O_raw': M_runoff_d18O}, state
+
+
+def run_runoff(T2M, TP, month, d2H, d18O, melt_ratio, rp_ratio_summer, rp_ratio_winter,
+               rsm_ratio, p, s, thresh_spring, thresh_fall, thresh_avg=False, glacier_flux=0.,
+               smoothing='auto', steps_per_day=STEPS_PER_DAY):
+    """ Run the runoff model for one parameter set on plain arrays
+
+    Same as generate_runoff, but takes the forcing as 1D arrays (T2M, TP and
+    MONTH columns of the met-input file) and the 12 monthly precipitation
+    isotope values, so it can be called on shared-memory buffers.
+    """
+    with stage('runoff_condition', items=len(T2M)):
+        cond = runoff_condition(T2M, month, round(thresh_spring), round(thresh_fall), thresh_avg,
+                                steps_per_day=steps_per_day)
+    with stage('runoff_reservoir', items=len(T2M), numba=njit is not None):
+        out, _ = run_reservoir(cond, TP, month, d2H, d18O, melt_ratio, rp_ratio_summer, rp_ratio_winter,
+                               rsm_ratio, glacier_flux)
+
+    ## Smooth runoff across timesteps
+    with stage('gtail_wma', items=len(T2M), period=p, sigma=s):
+        out['RUNOFF'], out['d2HR'], out['d18OR'] = smooth_runoff(
+            out['runoff_raw'], out['runoff_d2H_raw'], out['runoff_d18O_raw'], period=p, sigma=s, method=smoothing)
+    return out
+
+
+def generate_runoff(met_data, piso_data, melt_ratio, rp_ratio_summer, rp_ratio_winter,
+                    rsm_ratio, p, s, thresh_spring, thresh_fall, thresh_avg=False,
+                    glacier_flux=0., smoothing='auto'):
+    """ Run the runoff model for one parameter set
+
+    Parameters
+    ----------
+
+    met_data : pandas.DataFrame
+        6-hourly forcing with at least MONTH, T2M and TP columns
+
+    piso_data : pandas.DataFrame
+        Monthly precipitation isotopes with d2H and d18O columns (12 rows)
+
+    melt_ratio : float
+        Fraction of accumulated precip to runoff per time step
+
+    rp_ratio_summer, rp_ratio_winter : float
+        Fraction of direct precip converted to runoff (vs lost to ET)
+
+    rsm_ratio : float
+        Fraction of snowmelt converted to runoff
+
+    p, s : float
+        Period and sigma of the runoff smoothing (smoothing.gtail_wma)
+
+    thresh_spring, thresh_fall : float
+        Number of days above/below freezing, rounded to the nearest integer
+
+    thresh_avg : bool
+        Use the mean of each step pair for the thresholds
+
+    glacier_flux : float
+        mm runoff per ha basin area; 0 if no glacier in catchment
+
+    smoothing : {'auto', 'direct', 'fft'}
+        Convolution method for the runoff smoothing (see smoothing.gtail_wma)
+
+    Returns
+    -------
+
+    out : dict of 1D arrays
+        RUNOFF, d18OP, d18OR, d2HP, d2HR (the met-input columns), the
+        accumulation diagnostics ACC, d2HACC, d18OACC and the unsmoothed
+        runoff_raw, runoff_d2H_raw and runoff_d18O_raw
+
+    """
+    return run_runoff(met_data['T2M'], met_data['TP'], met_data['MONTH'],
+                      piso_data['d2H'].values, piso_data['d18O'].values,
+                      melt_ratio, rp_ratio_summer, rp_ratio_winter, rsm_ratio, p, s,
+                      thresh_spring, thresh_fall, thresh_avg=thresh_avg, glacier_flux=glacier_flux,
+                      smoothing=smoothing)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming runoff generation for long (multi-century, hourly) forcing records.
+
+The met-input forcing is read in chunks and each chunk is run through the
+runoff model with the state carried over from the previous one: the snowpack
+and its isotopes, the last days of T2M needed by the freezing thresholds and
+the last steps of runoff needed by the one-sided smoothing filter. Output rows
+are appended to met-input.txt (and optionally acc-met-input.txt), or to
+their binary equivalents, as each chunk finishes, so memory use depends on
+the chunk size and not on the record length. Results match
+runoff_model.run_runoff on the whole record up to floating-point rounding in
+the smoothing.
+
+Usage:
+    python runoff_stream.py met-input-long.txt met-input.txt melt_ratio rp_ratio_summer
+        rp_ratio_winter rsm_ratio p s thresh_spring thresh_fall
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+from met_io import MET_INPUT_COLUMNS, ACC_COLUMNS, MetInputWriter, write_met_text
+from profiling import stage
+from runoff_batch import MET_COLUMNS, read_isotope_seasonality
+from runoff_model import (STEPS_PER_DAY, INITIAL_STATE, threshold_masks, combine_condition,
+                          run_reservoir)
+from smoothing import gtail_kernel, smooth_runoff
+
+
+class RunoffStream:
+    """ Runoff model that consumes forcing one chunk at a time
+
+    Parameters
+    ----------
+
+    d2H, d18O : 1D arrays
+        The 12 monthly precipitation isotope values
+
+    melt_ratio, rp_ratio_summer, rp_ratio_winter, rsm_ratio, p, s,
+    thresh_spring, thresh_fall, thresh_avg, glacier_flux, smoothing :
+        As in runoff_model.generate_runoff
+
+    steps_per_day : int
+        Time steps per day of forcing
+
+    """
+
+    def __init__(self, d2H, d18O, melt_ratio, rp_ratio_summer, rp_ratio_winter, rsm_ratio,
+                 p, s, thresh_spring, thresh_fall, thresh_avg=False, glacier_flux=0.,
+                 smoothing='auto', steps_per_day=STEPS_PER_DAY):
+        self.d2H = np.asarray(d2H, dtype=float)
+        self.d18O = np.asarray(d18O, dtype=float)
+        self.melt_ratio = melt_ratio
+        self.rp_ratio_summer = rp_ratio_summer
+        self.rp_ratio_winter = rp_ratio_winter
+        self.rsm_ratio = rsm_ratio
+        self.p = p
+        self.s = s
+        self.thresh_spring = round(thresh_spring)
+        self.thresh_fall = round(thresh_fall)
+        self.thresh_avg = thresh_avg
+        self.glacier_flux = glacier_flux
+        self.smoothing = smoothing
+        self.steps_per_day = steps_per_day
+
+        # Steps of T2M history needed by the thresholds and of runoff history
+        # needed by the smoothing filter (its window is the current step and
+        # the previous period/2 steps)
+        self.t2m_lookback = steps_per_day * max(self.thresh_spring, self.thresh_fall, 1)
+        self.wma_lookback = len(gtail_kernel(float(p), float(s))) // 2
+
+        self.state = INITIAL_STATE
+        self.first = True
+        self.t2m_tail = np.zeros(0)
+        self.runoff_tail = np.zeros((3, 0))
+
+    def process(self, T2M, TP, month):
+        """ Run the next chunk of forcing
+
+        Parameters
+        ----------
+
+        T2M, TP, month : 1D arrays
+            Forcing for the chunk, continuing directly from the previous one
+
+        Returns
+        -------
+
+        out : dict of 1D arrays
+            Same keys as runoff_model.run_runoff, for the steps of this chunk
+
+        """
+        T2M = np.asarray(T2M, dtype=float)
+        n = len(T2M)
+
+        # Thresholds, with the end of the previous chunk as look-back
+        t2m = np.concatenate([self.t2m_tail, T2M])
+        spring, fall = threshold_masks(t2m, self.thresh_spring, self.thresh_fall, self.thresh_avg,
+                                       self.steps_per_day)
+        k = len(self.t2m_tail)
+        cond = combine_condition(T2M, month, spring[k:], fall[k:])
+        self.t2m_tail = t2m[-self.t2m_lookback:]
+
+        out, self.state = run_reservoir(cond, TP, month, self.d2H, self.d18O, self.melt_ratio,
+                                        self.rp_ratio_summer, self.rp_ratio_winter, self.rsm_ratio,
+                                        self.glacier_flux, self.state, self.first, single=False)
+        if n:
+            self.first = False
+
+        # Smoothing, with the filter's tail from the previous chunk
+        raw = np.vstack([out['runoff_raw'], out['runoff_d2H_raw'], out['runoff_d18O_raw']])
+        ext = np.hstack([self.runoff_tail, raw])
+        smoothed = smooth_runoff(ext[0], ext[1], ext[2], period=self.p, sigma=self.s, method=self.smoothing)
+        k = self.runoff_tail.shape[1]
+        out['RUNOFF'], out['d2HR'], out['d18OR'] = (x[k:] for x in smoothed)
+        self.runoff_tail = ext[:, max(ext.shape[1] - self.wma_lookback, 0):]
+        return out
+
+
+def stream_runoff(metfile, exportfile, params, piso_data=None, accexportfile=None,
+                  chunksize=100000, fmt='%2.3f', binary=False):
+    """ Generate met-input files from forcing read in chunks
+
+    Parameters
+    ----------
+
+    metfile : str
+        Tab separated forcing file with the met-input-Imandra-* columns
+
+    exportfile : str
+        met-input file for the lake model (forcing + RUNOFF, d18OP, d18OR,
+        d2HP, d2HR)
+
+    params : dict
+        Keyword arguments for RunoffStream (melt_ratio, ..., thresh_fall)
+
+    piso_data : pandas.DataFrame
+        Monthly precipitation isotopes; isotope-seasonality.csv by default
+
+    accexportfile : str
+        If given, also write the accumulation diagnostics ACC, d2HACC and
+        d18OACC here: as text, the met-input columns plus those three; as
+        binary, a side table with only those three
+
+    chunksize : int
+        Forcing rows read per chunk
+
+    fmt : str
+        Number format of text output rows
+
+    binary : bool
+        Write binary met-input files (see met_io) instead of text
+
+    Returns
+    -------
+
+    n : int
+        Number of rows written
+
+    """
+    if piso_data is None:
+        piso_data = read_isotope_seasonality()
+    stream = RunoffStream(piso_data['d2H'].values, piso_data['d18O'].values, **params)
+
+    if binary:
+        metout = MetInputWriter(exportfile, MET_COLUMNS + MET_INPUT_COLUMNS)
+        accout = MetInputWriter(accexportfile, ACC_COLUMNS) if accexportfile else None
+    else:
+        metout = open(exportfile, 'w')
+        accout = open(accexportfile, 'w') if accexportfile else None
+
+    n = 0
+    with stage('stream_runoff', chunksize=chunksize, binary=binary) as st:
+        try:
+            for chunk in pd.read_csv(metfile, sep="\t", header=None, names=MET_COLUMNS, chunksize=chunksize):
+                out = stream.process(chunk['T2M'].values, chunk['TP'].values, chunk['MONTH'].values)
+                table = np.column_stack([chunk.values] + [out[c] for c in MET_INPUT_COLUMNS])
+                acc = np.column_stack([out[c] for c in ACC_COLUMNS])
+                if binary:
+                    metout.write(table)
+                    if accout is not None:
+                        accout.write(acc)
+                else:
+                    write_met_text(metout, table, fmt)
+                    if accout is not None:
+                        write_met_text(accout, np.hstack([table, acc]), fmt)
+                n += len(chunk)
+        finally:
+            metout.close()
+            if accout is not None:
+                accout.close()
+            st.items = n
+    return n
+
+
+if __name__ == '__main__':
+    names = ['melt_ratio', 'rp_ratio_summer', 'rp_ratio_winter', 'rsm_ratio', 'p', 's',
+             'thresh_spring', 'thresh_fall']
+    params = dict(zip(names, map(float, sys.argv[3:3 + len(names)])))
+    stream_runoff(sys.argv[1], sys.argv[2], params)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Chunking, caching and resuming of ERA5_download, offline with LocalClient.
+
+Run with ``python -m pytest test_ERA5_download.py`` from the PSM directory.
+"""
+
+import os
+
+import pytest
+
+from ERA5_download import LocalClient, chunk_name, download, era5_requests
+
+VARIABLES = ['2t', 'tp']
+YEARS = (2000, 2002)
+
+
+class CountingClient(LocalClient):
+    """ LocalClient that records the chunks it serves """
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.fetched = []
+
+    def retrieve(self, dataset, request, target):
+        (variable,), (year,) = request['variable'], request['year']
+        self.fetched.append(chunk_name(variable, year))
+        super().retrieve(dataset, request, target)
+
+
+def _canned(source, variable, year):
+    with open(os.path.join(source, f'{variable}_{year}.nc'), 'wb') as fh:
+        fh.write(b'CDF\x01' + f'{variable} {year}'.encode())
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    path.mkdir()
+    for variable in VARIABLES:
+        for year in range(YEARS[0], YEARS[1] + 1):
+            _canned(path, variable, year)
+    return str(path)
+
+
+def _download(requests, cache, client):
+    return download(requests, str(cache), client=client, workers=2, retries=2, backoff=0., verbose=False)
+
+
+def test_one_request_per_variable_and_year():
+    requests = era5_requests(VARIABLES, *YEARS)
+    assert [name for name, _ in requests] == [chunk_name(v, y) for v in VARIABLES for y in range(YEARS[0], YEARS[1] + 1)]
+    for name, request in requests:
+        assert len(request['variable']) == 1 and len(request['year']) == 1
+        assert name == chunk_name(request['variable'][0], int(request['year'][0]))
+
+
+def test_cached_chunks_are_skipped(source, tmp_path):
+    requests = era5_requests(VARIABLES, *YEARS)
+    client = CountingClient(source)
+    paths = _download(requests, tmp_path / 'cache', client)
+    assert sorted(client.fetched) == sorted(name for name, _ in requests)
+    assert all(os.path.exists(p) for p in paths)
+    assert os.path.exists(tmp_path / 'cache' / 'era5-manifest.json')
+
+    client = CountingClient(source)
+    assert _download(requests, tmp_path / 'cache', client) == paths
+    assert client.fetched == []
+
+    # a damaged chunk no longer matches its checksum and is fetched again
+    with open(paths[0], 'ab') as fh:
+        fh.write(b'x')
+    _download(requests, tmp_path / 'cache', client)
+    assert client.fetched == [requests[0][0]]
+
+
+def test_resume_after_failure(source, tmp_path):
+    requests = era5_requests(VARIABLES, *YEARS)
+    os.remove(os.path.join(source, 'tp_2001.nc'))
+    client = CountingClient(source)
+    with pytest.raises(RuntimeError, match='Imandra_ERA5_tp_2001.nc'):
+        _download(requests, tmp_path / 'cache', client)
+    assert client.fetched.count(chunk_name('tp', 2001)) == 2  # retried
+    assert not os.path.exists(tmp_path / 'cache' / (chunk_name('tp', 2001) + '.part'))
+
+    _canned(source, 'tp', 2001)
+    client = CountingClient(source)
+    _download(requests, tmp_path / 'cache', client)
+    assert client.fetched == [chunk_name('tp', 2001)]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Units of the forcing written by era5_metinput, from small synthetic NetCDF3
+chunks laid out like the ERA5_download cache.
+
+Run with ``python -m pytest test_era5_metinput.py`` from the PSM directory.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.io import netcdf_file
+
+from ERA5_download import ACCUMULATED, HOURS, TIMES, VARIABLES, chunk_name, era5_requests
+from era5_metinput import NETCDF_NAMES, write_met_input
+from runoff_batch import MET_COLUMNS
+
+ORIGIN = np.datetime64('1900-01-01T00:00:00')
+
+# Instantaneous values, and accumulations per hour
+INSTANT = {'2t': 278.15, '2d': 278.15, '10u': 3., '10v': 4., 'sp': 100000.}
+PER_HOUR = {'ssrd': 360000., 'strd': 1080000., 'tp': 0.0005}
+
+
+def _write_chunk(path, variable, time, values):
+    hours = ((time - ORIGIN) // np.timedelta64(1, 'h')).astype('int32')
+    with netcdf_file(path, 'w') as nc:
+        nc.createDimension('time', len(time))
+        nc.createDimension('latitude', 2)
+        nc.createDimension('longitude', 2)
+        t = nc.createVariable('time', 'i4', ('time',))
+        t.units = 'hours since 1900-01-01 00:00:00'
+        t[:] = hours
+        nc.createVariable('latitude', 'f8', ('latitude',))[:] = [67.5, 67.25]
+        nc.createVariable('longitude', 'f8', ('longitude',))[:] = [33., 33.25]
+        field = nc.createVariable(NETCDF_NAMES[variable], 'f8', ('time', 'latitude', 'longitude'))
+        field[:] = np.broadcast_to(np.asarray(values, dtype=float)[:, None, None], (len(time), 2, 2))
+
+
+def _cache(path, year, days=2, hourly=True, per_hour=None, start=None):
+    """ Chunks for ``days`` days of a year from start (1 January); per_hour overrides the accumulations """
+    start = np.datetime64(start or f'{year}-01-01T00:00:00')
+    six_hourly = start + np.arange(4 * days) * np.timedelta64(6, 'h')
+    hours = start + np.arange(24 * days) * np.timedelta64(1, 'h') if hourly else six_hourly
+    for v in VARIABLES:
+        if v in ACCUMULATED:
+            values = per_hour[v] if per_hour is not None else np.full(len(hours), PER_HOUR[v])
+            _write_chunk(path / chunk_name(v, year), v, hours, values)
+        else:
+            _write_chunk(path / chunk_name(v, year), v, six_hourly, np.full(len(six_hourly), INSTANT[v]))
+
+
+def _read(path):
+    return pd.read_csv(path, sep='\t', header=None, names=MET_COLUMNS)
+
+
+def test_accumulated_variables_requested_hourly():
+    for name, request in era5_requests(VARIABLES, 2000, 2000):
+        variable = request['variable'][0]
+        assert request['time'] == (HOURS if variable in ACCUMULATED else TIMES)
+
+
+def test_units(tmp_path):
+    _cache(tmp_path, 2001)
+    out = tmp_path / 'met-input.txt'
+    assert write_met_input(str(tmp_path), str(out), 2001, 2001, blocksize=3) == 8
+    met = _read(out)
+    assert met['HOUR'].tolist() == [0, 6, 12, 18] * 2
+    np.testing.assert_allclose(met['TP'], 3.)  # 0.5 mm per hour -> 3 mm per 6 h
+    np.testing.assert_allclose(met['SSRD'], 100.)  # 360 kJ m-2 per hour -> 100 W m-2
+    np.testing.assert_allclose(met['STRD'], 300.)
+    np.testing.assert_allclose(met['SP'], 1000.)
+    np.testing.assert_allclose(met['WIND'], 5.)
+    np.testing.assert_allclose(met['RH'], 100.)
+    np.testing.assert_allclose(met['T2M'], 278.15)
+
+
+def test_windows_end_at_each_step_across_years(tmp_path):
+    # precipitation of k mm in the k-th hour of the record
+    for year, start, offset in ((2001, '2001-12-31T00:00:00', 0), (2002, None, 24)):
+        k = offset + np.arange(1, 25)
+        _cache(tmp_path, year, days=1, per_hour={'ssrd': 0. * k, 'strd': 0. * k, 'tp': k / 1000.}, start=start)
+    out = tmp_path / 'met-input.txt'
+    write_met_input(str(tmp_path), str(out), 2001, 2002)
+    tp = _read(out)['TP'].values
+    # the first step has only its own hour, scaled up to 6
+    expected = [6 * 1.] + [sum(range(h - 4, h + 2)) for h in (6, 12, 18, 24, 30, 36, 42)]
+    np.testing.assert_allclose(tp, expected)
+
+
+def test_six_hourly_accumulations_rejected(tmp_path):
+    _cache(tmp_path, 2001, hourly=False)
+    with pytest.raises(ValueError, match='hourly'):
+        write_met_input(str(tmp_path), str(tmp_path / 'met-input.txt'), 2001, 2001)
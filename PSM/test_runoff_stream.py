@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Streamed runoff against the whole-record run.
+
+Run with ``python -m pytest test_runoff_stream.py`` from the PSM directory.
+"""
+
+import numpy as np
+import pytest
+
+from benchmarks import synthetic_forcing, synthetic_isotopes
+from met_io import MetInput
+from runoff_model import run_runoff
+from runoff_stream import stream_runoff
+
+PARAMS = dict(melt_ratio=0.3, rp_ratio_summer=0.6, rp_ratio_winter=0.4, rsm_ratio=0.7,
+              p=100., s=8., thresh_spring=5, thresh_fall=5)
+
+COLUMNS = ['RUNOFF', 'd2HR', 'd18OR', 'd2HP', 'd18OP']
+ACC = ['ACC', 'd2HACC', 'd18OACC']
+
+
+@pytest.fixture(scope='module')
+def forcing(tmp_path_factory):
+    met = synthetic_forcing(1, seed=3).iloc[:600]
+    metfile = tmp_path_factory.mktemp('forcing') / 'met-input.txt'
+    met.to_csv(metfile, sep='\t', header=False, index=False, float_format='%.17g')
+    piso = synthetic_isotopes()
+    whole = run_runoff(met['T2M'].values, met['TP'].values, met['MONTH'].values,
+                       piso['d2H'].values, piso['d18O'].values, **PARAMS)
+    return metfile, piso, whole
+
+
+@pytest.mark.parametrize('chunksize', [1, 2, 13, 40, 599])
+def test_stream_matches_whole_record(forcing, tmp_path, chunksize):
+    metfile, piso, whole = forcing
+    out, acc = tmp_path / 'met.bin', tmp_path / 'acc.bin'
+    stream_runoff(str(metfile), str(out), PARAMS, piso, accexportfile=str(acc), chunksize=chunksize,
+                  binary=True)
+    streamed, streamed_acc = MetInput(str(out)), MetInput(str(acc))
+    for name in COLUMNS:
+        np.testing.assert_allclose(streamed[name], whole[name], rtol=1e-9, atol=1e-12, err_msg=name)
+    for name in ACC:
+        np.testing.assert_allclose(streamed_acc[name], whole[name], rtol=1e-9, atol=1e-12, err_msg=name)
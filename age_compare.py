@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+Age-uncertain comparison of the Imandra record with other Scandinavian records.
+
+regrid draws age realizations of every record (from its age ensemble, or
+its median ages when it has none) and puts all of them on one time grid in
+a single vectorized step: either the mean of the samples falling in each
+bin, by one bincount over every (record, realization, bin), or linear
+interpolation at the bin centres, by one searchsorted over every
+realization. The regridded (realizations x bins) matrices are cached per
+record in a .npz file, keyed by the archive's size and modification time and
+by the grid settings, so a rerun reads only the archives that changed.
+
+correlate then computes, for every pair of records, the correlation of
+each pair of realizations and its significance, one pair of records per
+worker of a process pool. Significance is a t-test with the degrees of
+freedom reduced for the lag-1 autocorrelation of both series, or a test
+against AR(1) surrogates of the second series; the fraction of significant
+realizations is reported with and without a false discovery rate control.
+
+Other records (e.g. NGRIP, once downloaded) are compared by adding them to
+the records dict.
+
+Examples
+--------
+
+>>> regridded = regrid(SCANDINAVIAN_RECORDS, HOLOCENE_EDGES, draws=1000, cache_dir='regrid-cache')
+>>> result = correlate(regridded, method='ar1', n_surrogates=200, seed=1)
+>>> result.summary()
+"""
+
+import hashlib
+import itertools
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from lipd_utils import LiPDSession
+
+# Record name -> archive, variable, depth and median-age columns; 'table' picks
+# a paleo table when the variable name is used in several, and ens_num=None
+# uses the median ages only (Soylegrotta has no age ensemble)
+SCANDINAVIAN_RECORDS = {
+    'Imandra': dict(filename='Imandra.Holtzman.2024.lpd', variable='c22d2h',
+                    depth_name='midpointdepth', ageMedian_name='ageMedian'),
+    'Spaime': dict(filename='spaime.Hammarlund.2004.lpd', variable='d18O',
+                   depth_name='depth', ageMedian_name='age'),
+    'Tibetanus': dict(filename='tibetanus.Hammarlund.2002.lpd', variable='d18O',
+                      depth_name='depth', ageMedian_name='age'),
+    'Chuna': dict(filename='chuna.Jones.2005.lpd', variable='d18O',
+                  depth_name='depth', ageMedian_name='age'),
+    'Soylegrotta': dict(filename='Soylegrottacave.Linge.2001.lpd', variable='d18O',
+                        depth_name='depth', ageMedian_name='ageBchron', table=1, ens_num=None),
+}
+
+# 200-year bins over the Holocene, in yr BP
+HOLOCENE_EDGES = np.arange(0., 12001., 200.)
+
+_PERCENTILES = (2.5, 50, 97.5)
+
+# Surrogate values (realizations x surrogates x bins) evaluated at once
+_BLOCK_VALUES = 1 << 22
+
+
+def record_ages(session, spec, directory=None):
+    """ Age realizations and values of one record's samples
+
+    Parameters
+    ----------
+
+    session : lipd_utils.LiPDSession
+
+    spec : dict
+        filename, variable, depth_name and optionally ageMedian_name,
+        table and ens_num, as in SCANDINAVIAN_RECORDS
+
+    directory : str
+        Directory the filename is relative to
+
+    Returns
+    -------
+
+    ages : 2D array (samples x realizations)
+        A single column of median ages if spec['ens_num'] is None
+
+    values : 1D array
+
+    """
+    filename = os.path.join(directory, spec['filename']) if directory else spec['filename']
+    record = session.load(filename)
+    options = {'table': spec['table']} if spec.get('table') is not None else {}
+    axis = record.age_axis(spec['variable'], spec['depth_name'], spec.get('ageMedian_name', 'ageMedian'),
+                           **options)
+    values = axis['paleoData_values'].to_numpy(dtype=float)
+    ens_num = spec.get('ens_num', 0)
+    if ens_num is None:
+        return axis['ageMedian'].to_numpy(dtype=float)[:, None], values
+    return np.asarray(session.age_ensemble(filename, ens_num).at(axis['depth'].to_numpy(dtype=float))), values
+
+
+def bin_realizations(items, edges):
+    """ Bin means of several records' realizations in one pass
+
+    Parameters
+    ----------
+
+    items : list of (ages, values)
+        ages (samples x realizations) and values (samples) per record; all
+        records have the same number of realizations
+
+    edges : 1D array
+        Increasing bin edges; bins are closed on the left
+
+    Returns
+    -------
+
+    binned : 3D array (records x realizations x bins)
+        Mean of the values whose age falls in each bin, NaN for empty bins
+
+    """
+    nbins = len(edges) - 1
+    draws = items[0][0].shape[1]
+    ages = np.concatenate([a.ravel() for a, _ in items])
+    values = np.concatenate([np.repeat(v, a.shape[1]) for a, v in items])
+    draw = np.concatenate([np.tile(np.arange(a.shape[1]), a.shape[0]) for a, _ in items])
+    record = np.repeat(np.arange(len(items)), [a.size for a, _ in items])
+
+    b = np.searchsorted(edges, ages, side='right') - 1  # NaN ages fall past the last edge
+    ok = (b >= 0) & (b < nbins) & ~np.isnan(values)
+    flat = ((record * draws + draw) * nbins + b)[ok]
+    size = len(items) * draws * nbins
+    total = np.bincount(flat, weights=values[ok], minlength=size)
+    count = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = np.where(count > 0, total / count, np.nan)
+    return binned.reshape(len(items), draws, nbins)
+
+
+def interp_realizations(x, ages, values):
+    """ np.interp(x, ages[:, k], values[:, k]) for every column k at once
+
+    The columns need not be sorted and may hold NaN (padding, or missing
+    ages or values), which are ignored.
+
+    Parameters
+    ----------
+
+    x : 1D array
+        Points to interpolate at
+
+    ages, values : 2D array (samples x realizations)
+
+    Returns
+    -------
+
+    f : 2D array (realizations x len(x))
+        NaN outside the range of ages of a column
+
+    """
+    x = np.asarray(x, dtype=float)
+    n, k = ages.shape
+    if n < 2:
+        return np.full((k, len(x)), np.nan)
+    a = np.where(np.isnan(values), np.nan, ages)
+    order = np.argsort(a, axis=0)  # NaN last
+    a = np.take_along_axis(a, order, axis=0)
+    v = np.take_along_axis(values, order, axis=0)
+    count = (~np.isnan(a)).sum(axis=0)
+    if not count.any():
+        return np.full((k, len(x)), np.nan)
+
+    # Shift every column by its own offset so all columns form one sorted
+    # array and a single searchsorted finds the bracketing samples
+    lo = min(np.nanmin(a), x.min())
+    hi = max(np.nanmax(a), x.max())
+    step = hi - lo + 1.
+    offset = step * np.arange(k)
+    keys = (np.where(np.isnan(a), hi + .5, a) + offset).T.ravel()
+    j = np.searchsorted(keys, (x[None, :] + offset[:, None]).ravel(), side='right').reshape(k, len(x))
+    j = np.clip(j - n * np.arange(k)[:, None], 1, np.maximum(count - 1, 1)[:, None])
+
+    cols = np.arange(k)[:, None]
+    x0, x1 = a[j - 1, cols], a[j, cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(x1 > x0, (x - x0) / (x1 - x0), 0.)
+        f = v[j - 1, cols] + w * (v[j, cols] - v[j - 1, cols])
+    last = a[np.maximum(count - 1, 0), np.arange(k)]
+    inside = (count[:, None] >= 2) & (x >= a[0][:, None]) & (x <= last[:, None])
+    return np.where(inside, f, np.nan)
+
+
+def _realizations(m, draws, rng):
+    """ Columns drawn from m realizations, without replacement when possible """
+    if m == 1:
+        return np.zeros(draws, dtype=int)
+    if draws <= m:
+        return rng.choice(m, draws, replace=False)
+    return rng.integers(m, size=draws)
+
+
+def _settings(name, spec, filename, edges, draws, method, seed):
+    st = os.stat(filename)
+    return repr((name, sorted(spec.items()), os.path.abspath(filename), st.st_size, st.st_mtime_ns,
+                 hashlib.md5(np.ascontiguousarray(edges).tobytes()).hexdigest(), draws, method, seed))
+
+
+def _cachefile(cache_dir, name, settings):
+    return os.path.join(cache_dir, f'{name}-regrid-{hashlib.md5(settings.encode()).hexdigest()[:16]}.npz')
+
+
+def _read_cache(cachefile, settings):
+    try:
+        cache = np.load(cachefile, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+    with cache:
+        if str(cache['settings']) != settings:
+            return None
+        return cache['values']
+
+
+def regrid(records=SCANDINAVIAN_RECORDS, edges=HOLOCENE_EDGES, draws=1000, method='bin', seed=0,
+           session=None, directory=None, cache_dir=None):
+    """ Put the age realizations of several records on one time grid
+
+    Parameters
+    ----------
+
+    records : dict
+        Record spec per name, as in SCANDINAVIAN_RECORDS
+
+    edges : 1D array
+        Increasing edges of the time bins, in the units of the ages
+
+    draws : int
+        Realizations kept per record, drawn from its ensemble (records with
+        median ages only repeat them)
+
+    method : {'bin', 'interp'}
+        Mean of the samples in each bin, or linear interpolation at the bin
+        centres
+
+    seed : int
+        Seed of the realization draws; each record gets its own stream, so
+        its draws do not depend on the other records
+
+    session : lipd_utils.LiPDSession
+        Session the archives are read with (default: a new 'zip' session)
+
+    directory : str
+        Directory the record filenames are relative to
+
+    cache_dir : str
+        Directory for the regridded records, created if missing; None
+        disables the cache
+
+    Returns
+    -------
+
+    regridded : dict
+        (draws x bins) array per record name, in the order of records
+
+    """
+    if method not in ('bin', 'interp'):
+        raise ValueError(f"method must be 'bin' or 'interp', not {method!r}")
+    edges = np.asarray(edges, dtype=float)
+    if session is None:
+        session = LiPDSession(engine='zip', verbose=False)
+
+    regridded = {}
+    todo = {}
+    for name, spec in records.items():
+        filename = os.path.join(directory, spec['filename']) if directory else spec['filename']
+        settings = _settings(name, spec, filename, edges, draws, method, seed)
+        if cache_dir:
+            values = _read_cache(_cachefile(cache_dir, name, settings), settings)
+            if values is not None:
+                regridded[name] = values
+                continue
+        ages, values = record_ages(session, spec, directory)
+        rng = np.random.default_rng([seed, zlib.crc32(name.encode())])
+        todo[name] = (ages[:, _realizations(ages.shape[1], draws, rng)], values, settings)
+
+    if todo:
+        if method == 'bin':
+            results = bin_realizations([(a, v) for a, v, _ in todo.values()], edges)
+        else:
+            # Pad the records to a common number of samples and interpolate all columns together
+            n = max(len(v) for _, v, _ in todo.values())
+            ages = np.full((n, len(todo) * draws), np.nan)
+            values = np.full((n, len(todo) * draws), np.nan)
+            for r, (a, v, _) in enumerate(todo.values()):
+                ages[:len(v), r * draws:(r + 1) * draws] = a
+                values[:len(v), r * draws:(r + 1) * draws] = v[:, None]
+            centers = (edges[:-1] + edges[1:]) / 2
+            results = interp_realizations(centers, ages, values).reshape(len(todo), draws, len(centers))
+
+        for (name, (_, _, settings)), values in zip(todo.items(), results):
+            regridded[name] = values
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+                cachefile = _cachefile(cache_dir, name, settings)
+                tmp = cachefile + '.part'
+                with open(tmp, 'wb') as fh:
+                    np.savez(fh, settings=np.array(settings), values=values)
+                os.replace(tmp, cachefile)
+
+    return {name: regridded[name] for name in records}
+
+
+def _pearson(x, y, min_overlap):
+    """ Correlation along the last axis over the pairwise-finite entries """
+    ok = np.isfinite(x) & np.isfinite(y)
+    n = ok.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = np.where(ok, x - np.where(ok, x, 0.).sum(axis=-1, keepdims=True) / n[..., None], 0.)
+        dy = np.where(ok, y - np.where(ok, y, 0.).sum(axis=-1, keepdims=True) / n[..., None], 0.)
+        r = (dx * dy).sum(axis=-1) / np.sqrt((dx * dx).sum(axis=-1) * (dy * dy).sum(axis=-1))
+    return np.where(n >= min_overlap, r, np.nan), n
+
+
+def _lag1(x):
+    """ Lag-1 autocorrelation of every row, limited to [0, 0.99] (0 when undefined) """
+    r, _ = _pearson(x[:, :-1], x[:, 1:], 3)
+    return np.clip(np.nan_to_num(r), 0., .99)
+
+
+def _correlate_pair(task):
+    """ Correlations and p-values of one pair of regridded records (one realization pair per row) """
+    x, y, method, n_surrogates, min_overlap, seed = task
+    r, n = _pearson(x, y, min_overlap)
+    if method == 'ttest':
+        rho = _lag1(x) * _lag1(y)
+        neff = np.minimum(n * (1 - rho) / (1 + rho), n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = r * np.sqrt((neff - 2) / (1 - r ** 2))
+            p = np.where(neff > 2, 2 * stats.t.sf(np.abs(t), np.maximum(neff - 2, 1)), np.nan)
+        return r, n, np.where(np.isnan(r), np.nan, p)
+
+    rng = np.random.default_rng(seed)
+    phi = _lag1(y)
+    p = np.full(len(r), np.nan)
+    nbins = x.shape[1]
+    block = max(1, _BLOCK_VALUES // (n_surrogates * nbins))
+    for start in range(0, len(r), block):
+        rows = slice(start, start + block)
+        f = phi[rows, None]
+        noise = rng.standard_normal((len(f), n_surrogates, nbins))
+        surrogate = np.empty_like(noise)
+        surrogate[..., 0] = noise[..., 0]
+        for i in range(1, nbins):
+            surrogate[..., i] = f * surrogate[..., i - 1] + np.sqrt(1 - f ** 2) * noise[..., i]
+        surrogate[np.broadcast_to(np.isnan(y[rows, None, :]), surrogate.shape)] = np.nan
+        rs, _ = _pearson(x[rows, None, :], surrogate, min_overlap)
+        exceed = (np.abs(rs) >= np.abs(r[rows, None])).sum(axis=1)
+        p[rows] = (1 + exceed) / (1 + n_surrogates)
+    return r, n, np.where(np.isnan(r), np.nan, p)
+
+
+def _fdr(p, alpha):
+    """ Benjamini-Hochberg: which of the p-values are significant at false discovery rate alpha """
+    ok = ~np.isnan(p)
+    significant = np.zeros(len(p), dtype=bool)
+    if ok.any():
+        q = np.sort(p[ok])
+        passed = np.nonzero(q <= alpha * np.arange(1, len(q) + 1) / len(q))[0]
+        if len(passed):
+            significant[ok] = p[ok] <= q[passed[-1]]
+    return significant
+
+
+class CorrelationResult:
+    """ Correlations of pairs of regridded records, one per pair of realizations
+
+    Parameters
+    ----------
+
+    r, p, n : dict
+        Correlations, p-values and number of shared bins (arrays) per
+        (record, record) pair
+
+    alpha : float
+        Significance level
+
+    """
+
+    def __init__(self, r, p, n, alpha=0.05):
+        self.r = r
+        self.p = p
+        self.n = n
+        self.alpha = alpha
+
+    def summary(self, q=_PERCENTILES):
+        """ Percentiles of the correlation and fraction of significant realizations per pair
+
+        Returns
+        -------
+
+        summary : pandas.DataFrame
+            One row per pair
+
+        """
+        rows = []
+        for (a, b), r in self.r.items():
+            p = self.p[a, b]
+            ok = ~np.isnan(p)
+            row = {'record 1': a, 'record 2': b, 'realizations': int(ok.sum()),
+                   'overlap': float(np.median(self.n[a, b]))}
+            if ok.any():
+                row.update({f'r {x:g}%': v for x, v in zip(q, np.nanpercentile(r, q))})
+                row['fraction significant'] = float((p[ok] < self.alpha).mean())
+                row['fraction significant (FDR)'] = float(_fdr(p, self.alpha)[ok].mean())
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def correlate(regridded, pairs=None, method='ttest', n_surrogates=200, alpha=0.05, min_overlap=5,
+              workers=None, seed=0):
+    """ Ensemble correlations and their significance for pairs of records
+
+    Parameters
+    ----------
+
+    regridded : dict
+        (realizations x bins) array per record, as returned by regrid
+
+    pairs : list of (str, str)
+        Pairs of record names; all pairs if None
+
+    method : {'ttest', 'ar1'}
+        t-test with autocorrelation-adjusted degrees of freedom, or the
+        fraction of AR(1) surrogates of the second record at least as
+        correlated with the first
+
+    n_surrogates : int
+        Surrogates per realization ('ar1')
+
+    alpha : float
+        Significance level
+
+    min_overlap : int
+        Fewest shared bins for a correlation to be computed
+
+    workers : int
+        Processes of the pool (None: executor default; 1 runs in this
+        process). Call from a __main__ guarded script on Windows
+
+    seed : int
+        Seed of the surrogates
+
+    Returns
+    -------
+
+    result : CorrelationResult
+
+    """
+    if method not in ('ttest', 'ar1'):
+        raise ValueError(f"method must be 'ttest' or 'ar1', not {method!r}")
+    if pairs is None:
+        pairs = list(itertools.combinations(regridded, 2))
+    tasks = [(regridded[a], regridded[b], method, n_surrogates, min_overlap, [seed, k])
+             for k, (a, b) in enumerate(pairs)]
+    if workers == 1 or len(tasks) <= 1:
+        results = list(map(_correlate_pair, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_correlate_pair, tasks))
+    pairs = [tuple(pair) for pair in pairs]
+    return CorrelationResult({pair: res[0] for pair, res in zip(pairs, results)},
+                             {pair: res[2] for pair, res in zip(pairs, results)},
+                             {pair: res[1] for pair, res in zip(pairs, results)},
+                             alpha=alpha)
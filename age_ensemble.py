@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Age ensembles mapped onto paleoData depths.
+
+An AgeEnsemble holds the (depth x realizations) age matrix of one core's
+chronology once. Mapping it onto the depths of a proxy interpolates all
+realizations in a single vectorized pass (they share the ensemble depths, so
+the bracketing rows and weights are found once), and the result is kept per
+depth vector, so proxies measured on the same samples share one matrix.
+
+LazyEnsembleSeries pairs such a matrix with a proxy's values. It creates a
+pyleoclim.Series for a realization only when one is asked for (indexing or
+iterating), and forwards every other attribute (common_time, plot_envelope,
+...) to a pyleoclim.EnsembleSeries built on first use.
+"""
+
+import operator
+
+import numpy as np
+
+try:
+    import pyleoclim as pyleo
+except ImportError:  # only needed to materialize Series objects
+    pyleo = None
+
+
+def interp_columns(x, xp, fp):
+    """ np.interp(x, xp, fp[:, i]) for every column i of fp at once
+
+    Parameters
+    ----------
+
+    x : 1D array
+        Points to interpolate at
+
+    xp : 1D array
+        Increasing sample points, one per row of fp
+
+    fp : 2D array
+        Sampled values, one series per column
+
+    Returns
+    -------
+
+    f : 2D array (len(x) x fp.shape[1])
+        Values are held constant beyond the ends of xp, as np.interp does,
+        and rows for NaN points are NaN
+
+    """
+    x = np.asarray(x, dtype=float)
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    if len(xp) == 1:
+        return np.where(np.isnan(x)[:, None], np.nan, np.broadcast_to(fp[0], (len(x), fp.shape[1])))
+    j = np.clip(np.searchsorted(xp, x, side='right'), 1, len(xp) - 1)
+    x0, x1 = xp[j - 1], xp[j]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(x1 > x0, (x - x0) / (x1 - x0), 1.)
+    w = np.clip(w, 0., 1.)[:, None]  # NaN stays NaN
+    lo, hi = fp[j - 1], fp[j]
+    return np.where(w == 1., hi, lo + w * (hi - lo))
+
+
+class AgeEnsemble:
+    """ Age realizations of a core on its ensemble depths
+
+    Parameters
+    ----------
+
+    depth : 1D array
+        Increasing depths of the ensemble rows
+
+    values : 2D array
+        Age realizations in columns (len(depth) x realizations)
+
+    time_name, time_unit : str
+        Name and unit given to the time axis of mapped series
+
+    """
+
+    def __init__(self, depth, values, time_name='Time', time_unit=None):
+        self.depth = np.squeeze(np.asarray(depth, dtype=float))
+        self.values = np.asarray(values, dtype=float)
+        if self.depth.ndim > 1:
+            raise ValueError('ensembleDepth has more than one dimension, please pass it as a 1D array')
+        if len(self.depth) != np.shape(self.values)[0]:
+            raise ValueError("Ensemble depth and age need to have the same length")
+        self.time_name = time_name
+        self.time_unit = time_unit
+        self._mapped = {}
+
+    @property
+    def realizations(self):
+        return self.values.shape[1]
+
+    def at(self, depth):
+        """ (len(depth) x realizations) ages at the given depths, computed once per depth vector
+
+        The returned matrix is shared and read-only.
+        """
+        depth = np.ascontiguousarray(np.squeeze(np.asarray(depth, dtype=float)))
+        if depth.ndim > 1:
+            raise ValueError('paleoDepth has more than one dimension, please pass it as a 1D array')
+        key = depth.tobytes()
+        if key not in self._mapped:
+            ages = interp_columns(depth, self.depth, self.values)
+            ages.flags.writeable = False
+            self._mapped[key] = ages
+        return self._mapped[key]
+
+    def map(self, paleoDepth, paleoValues, value_name=None, value_unit=None):
+        """ Ensemble of a proxy's values against the age realizations at its depths
+
+        Returns
+        -------
+
+        ensemble : LazyEnsembleSeries
+
+        """
+        paleoValues = np.squeeze(np.asarray(paleoValues))
+        if paleoValues.ndim > 1:
+            raise ValueError('ensembleValues has more than one dimension, please pass it as a 1D array')
+        if len(paleoValues) != len(np.atleast_1d(np.squeeze(paleoDepth))):
+            raise ValueError("Paleo depth and age need to have the same length")
+        return LazyEnsembleSeries(self.at(paleoDepth), paleoValues, value_name=value_name,
+                                  value_unit=value_unit, time_name=self.time_name, time_unit=self.time_unit)
+
+
+class LazyEnsembleSeries:
+    """ Proxy values against an age matrix, one realization per column
+
+    Parameters
+    ----------
+
+    time : 2D array
+        Ages (samples x realizations); not copied
+
+    value : 1D array
+        Proxy values of the samples, shared by all realizations
+
+    value_name, value_unit, time_name, time_unit : str
+        Labels passed on to the pyleoclim Series
+
+    """
+
+    def __init__(self, time, value, value_name=None, value_unit=None, time_name=None, time_unit=None):
+        self.time = time
+        self.value = value
+        self.value_name = value_name
+        self.value_unit = value_unit
+        self.time_name = time_name
+        self.time_unit = time_unit
+        self._ensemble = None
+
+    def __len__(self):
+        return self.time.shape[1]
+
+    def __getitem__(self, i):
+        """ Realization i as a pyleoclim Series; a slice or sequence gives a LazyEnsembleSeries """
+        if isinstance(i, slice) or (not isinstance(i, str) and np.ndim(i) == 1):
+            return LazyEnsembleSeries(self.time[:, i], self.value, value_name=self.value_name,
+                                      value_unit=self.value_unit, time_name=self.time_name,
+                                      time_unit=self.time_unit)
+        try:
+            i = operator.index(i)
+        except TypeError:
+            raise TypeError(f'Realizations are indexed by an integer, a slice or a sequence, not {type(i).__name__}') from None
+        if pyleo is None:
+            raise ImportError('Ensemble series require pyleoclim')
+        return pyleo.Series(time=self.time[:, i], value=self.value,
+                            verbose=False,
+                            clean_ts=False,
+                            value_name=self.value_name,
+                            value_unit=self.value_unit,
+                            time_name=self.time_name,
+                            time_unit=self.time_unit)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_pyleo(self):
+        """ The pyleoclim.EnsembleSeries, built on first use """
+        if self._ensemble is None:
+            if pyleo is None:
+                raise ImportError('Ensemble series require pyleoclim')
+            self._ensemble = pyleo.EnsembleSeries(series_list=list(self))
+        return self._ensemble
+
+    @property
+    def series_list(self):
+        return self.to_pyleo().series_list
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.to_pyleo(), name)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo uncertainty of GDGT indices and temperature calibrations.
+
+Every index (MBT'5Me, CBT'5Me, IR, fC, BIT, HP5, TEX, ...) is a registered
+formula over compound abundances, and every temperature calibration is a
+registered sum of coefficients times terms (indices or fractional
+abundances), as written in the ResultsFigs notebook. The indices are ratios,
+so peak areas, concentrations and fractional abundances give the same
+values.
+
+monte_carlo evaluates any set of them on (samples x draws) arrays, sampling
+together for every draw
+    - the measurement error of each compound (multiplicative, lognormal),
+    - the calibration coefficients and the calibration residual,
+    - one realization of the age ensemble,
+and keeps only the resulting (samples x draws) values; no intermediate
+DataFrames are built. The draws are evaluated in blocks, so memory stays
+bounded for 10,000 draws of the whole core.
+
+Examples
+--------
+
+>>> result = monte_carlo(allGDGT_df, ["MBT'5Me", 'Russell MBT', 'Russell SFS'], draws=10000,
+...                      rel_error=0.05, ages=session.age_ensemble(lpd).at(allGDGT_df['depth']), seed=1)
+>>> bands = result.percentiles()
+>>> russell = result.time_bands('Russell MBT', np.arange(0, 12000, 100))
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+BR_TETRA = ['Ia', 'Ib', 'Ic']
+BR_PENTA = ['IIa5', 'IIa6', 'IIb5', 'IIb6', 'IIc5', 'IIc6']
+BR_HEXA = ['IIIa5', 'IIIa6', 'IIIb5', 'IIIb6', 'IIIc5', 'IIIc6']
+BR_GDGTS = BR_TETRA + BR_PENTA + BR_HEXA
+ISO_GDGTS = ['iso0', 'iso1', 'iso2', 'iso3', 'cren', 'crenreg']
+
+# Raberg et al. (2021) methylation sets
+_METH_A = ['Ia', 'IIa5', 'IIIa5']
+_METH_B = ['Ib', 'IIb5', 'IIIb5']
+_METH_C = ['Ic', 'IIc5', 'IIIc5']
+
+_PERCENTILES = (2.5, 16, 50, 84, 97.5)
+
+# Values (samples x draws x compounds) evaluated at once
+_BLOCK_VALUES = 1 << 22
+
+
+class Abundances:
+    """ Compound abundances of one block of draws
+
+    Indexing with a compound name gives its (samples x draws) array,
+    indexing with a registered index name evaluates the index (once per
+    block).
+
+    Parameters
+    ----------
+
+    values : dict
+        Array per compound name
+
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self._totals = {}
+        self._indices = {}
+
+    def __getitem__(self, name):
+        if name in self.values:
+            return self.values[name]
+        if name not in self._indices:
+            if name not in INDICES:
+                raise KeyError(f'No compound or index {name!r}')
+            self._indices[name] = INDICES[name](self)
+        return self._indices[name]
+
+    def total(self, group):
+        """ Sum of the abundances of a group of compounds """
+        key = tuple(group)
+        if key not in self._totals:
+            self._totals[key] = sum(self.values[c] for c in key)
+        return self._totals[key]
+
+    def frac(self, name, group=BR_GDGTS):
+        """ Fractional abundance of a compound within a group """
+        return self[name] / self.total(group)
+
+
+INDICES = {}
+
+
+def register_index(name):
+    """ Decorator registering ``func(x)`` of an Abundances ``x`` as an index """
+    def register(func):
+        INDICES[name] = func
+        return func
+    return register
+
+
+@register_index("MBT'5Me")
+def _mbt5me(x):
+    return x.total(BR_TETRA) / x.total(BR_TETRA + ['IIa5', 'IIb5', 'IIc5', 'IIIa5'])
+
+
+@register_index("CBT'5Me")
+def _cbt5me(x):
+    return -np.log10((x['Ib'] + x['IIb5']) / (x['Ia'] + x['IIa5']))
+
+
+@register_index('HP5')
+def _hp5(x):
+    return x['IIIa5'] / (x['IIa5'] + x['IIIa5'])
+
+
+@register_index('BIT')
+def _bit(x):
+    br = x.total(['Ia', 'IIa5', 'IIIa5'])
+    return br / (br + x['cren'])
+
+
+@register_index('IR')
+def _ir(x):
+    six = x.total(['IIa6', 'IIb6', 'IIc6', 'IIIa6', 'IIIb6', 'IIIc6'])
+    return six / (six + x.total(['IIa5', 'IIb5', 'IIc5', 'IIIa5', 'IIIb5', 'IIIc5']))
+
+
+@register_index('fC')
+def _fc(x):
+    b = x.total(['Ib', 'IIb5', 'IIb6', 'IIIb5', 'IIIb6'])
+    c = x.total(['Ic', 'IIc5', 'IIc6', 'IIIc5', 'IIIc6'])
+    return 0.5 * (b + 2 * c) / x.total(BR_GDGTS)
+
+
+@register_index('%hexa')
+def _hexa(x):
+    return x.total(BR_HEXA) / x.total(BR_GDGTS)
+
+
+@register_index('conductivity')
+def _conductivity(x):
+    # Raberg et al. (2021), fractional abundances within each ring-count group
+    return np.exp(6.62 + 8.87 * x.frac('Ib', BR_TETRA) + 5.12 * x.frac('IIa6', BR_PENTA) ** 2
+                  + 10.64 * x.frac('IIa5', BR_PENTA) ** 2 - 8.59 * x.frac('IIa5', BR_PENTA)
+                  - 4.32 * x.frac('IIIa6', BR_HEXA) ** 2 - 5.32 * x.frac('IIIa5', BR_HEXA) ** 2
+                  - 142.67 * x.frac('IIIb5', BR_HEXA) ** 2)
+
+
+@register_index('cald/cren')
+def _cald_cren(x):
+    return x['iso0'] / x['cren']
+
+
+@register_index('TEX')
+def _tex(x):
+    tex = x.total(['iso2', 'iso3', 'crenreg']) / x.total(['iso1', 'iso2', 'iso3', 'crenreg'])
+    return np.where(x['crenreg'] == 0, np.nan, tex)  # no TEX without cren'
+
+
+class Calibration:
+    """ Calibration linear in its coefficients: intercept + sum(coef * term(x))
+
+    Parameters
+    ----------
+
+    name : str
+
+    intercept : float
+
+    terms : list of (float, callable)
+        Coefficient and term; a term is ``func(x)`` of an Abundances or the
+        name of a registered index
+
+    coef_sd : list of float
+        Standard errors of the intercept and of each coefficient (None: the
+        coefficients are not sampled)
+
+    rmse : float
+        Residual standard error of the calibration (None: no residual)
+
+    """
+
+    def __init__(self, name, intercept, terms, coef_sd=None, rmse=None):
+        self.name = name
+        self.intercept = intercept
+        self.terms = [(c, (lambda x, n=t: x[n]) if isinstance(t, str) else t) for c, t in terms]
+        self.coef_sd = coef_sd
+        self.rmse = rmse
+
+    @property
+    def coefficients(self):
+        return np.array([self.intercept] + [c for c, _ in self.terms])
+
+    def __call__(self, x, coefficients=None):
+        """ Temperatures of an Abundances; ``coefficients`` may have a trailing draws axis """
+        c = self.coefficients if coefficients is None else coefficients
+        return c[0] + sum(c[k + 1] * term(x) for k, (_, term) in enumerate(self.terms))
+
+
+CALIBRATIONS = {}
+
+
+def register_calibration(calibration):
+    """ Make a Calibration available to monte_carlo by its name """
+    CALIBRATIONS[calibration.name] = calibration
+    return calibration
+
+
+def _meth(name, group):
+    return lambda x: x[name] / x.total(group)
+
+
+def _frac(name):
+    return lambda x: x.frac(name)
+
+
+def _frac2(name):
+    return lambda x: x.frac(name) ** 2
+
+
+# Residual errors are those published with the calibrations (Russell et al.,
+# 2018); calibrations without one need calibration_sd for their error
+register_calibration(Calibration('Russell MBT', -1.21, [(32.42, "MBT'5Me")], rmse=2.44))
+register_calibration(Calibration('Russell SFS', 23.81, [(-31.02, _frac('IIIa5')), (-51.59, _frac('IIb6')),
+                                                        (-24.70, _frac('IIa5')), (68.80, _frac('Ib'))],
+                                 rmse=2.14))
+register_calibration(Calibration('Zhao MBT', -1.82, [(56.06, "MBT'5Me")]))
+register_calibration(Calibration('Raberg Meth Set', 92.9, [
+    (63.84, lambda x: _meth('Ib', _METH_B)(x) ** 2),
+    (-130.51, _meth('Ib', _METH_B)),
+    (-28.77, lambda x: _meth('IIa5', _METH_A)(x) ** 2),
+    (-72.28, lambda x: _meth('IIb5', _METH_B)(x) ** 2),
+    (-5.88, lambda x: _meth('IIc5', _METH_C)(x) ** 2),
+    (20.89, lambda x: _meth('IIIa5', _METH_A)(x) ** 2),
+    (-40.54, _meth('IIIa5', _METH_A)),
+    (-80.47, _meth('IIIb5', _METH_B)),
+]))
+register_calibration(Calibration('Raberg Full Set', -8.06, [
+    (37.52, _frac('Ia')), (-266.83, _frac2('Ib')), (133.42, _frac('Ib')),
+    (100.85, _frac2('IIa6')), (58.15, _frac2('IIIa6')), (12.79, _frac('IIIa5')),
+]))
+register_calibration(Calibration('Powers TEX', -14.0, [(55.2, 'TEX')]))
+
+
+class MonteCarloResult:
+    """ Draws of indices and temperatures for every sample
+
+    Attributes
+    ----------
+
+    depth : 1D array
+
+    age : 2D array or None
+        Age of every sample in every draw (samples x draws)
+
+    values : dict
+        (samples x draws) array per index or calibration
+
+    """
+
+    def __init__(self, depth, age, values):
+        self.depth = depth
+        self.age = age
+        self.values = values
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def percentiles(self, q=_PERCENTILES):
+        """ Percentiles over the draws for every sample
+
+        Returns
+        -------
+
+        bands : pandas.DataFrame
+            depth, the median age if there are ages, and a '<name> <q>%'
+            column per quantity and percentile
+
+        """
+        q = list(q)
+        columns = {'depth': self.depth}
+        if self.age is not None:
+            columns['ageMedian'] = np.median(self.age, axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # samples without any finite draw
+            for name, v in self.values.items():
+                for qk, band in zip(q, np.nanpercentile(v, q, axis=1)):
+                    columns[f'{name} {qk:g}%'] = band
+        return pd.DataFrame(columns)
+
+    def time_bands(self, name, time_axis, q=_PERCENTILES):
+        """ Percentiles of a quantity on a common time axis
+
+        Every draw is interpolated linearly from its own ages to
+        ``time_axis`` (no extrapolation), then percentiles are taken over
+        the draws.
+
+        Returns
+        -------
+
+        bands : pandas.DataFrame
+            'time' and a '<q>%' column per percentile
+
+        """
+        if self.age is None:
+            raise ValueError('No age ensemble was sampled')
+        time_axis = np.asarray(time_axis, dtype=float)
+        v = self.values[name]
+        on_axis = np.full((len(time_axis), v.shape[1]), np.nan)
+        for k in range(v.shape[1]):
+            ok = np.isfinite(v[:, k]) & np.isfinite(self.age[:, k])
+            if ok.sum() < 2:
+                continue
+            t, y = self.age[ok, k], v[ok, k]
+            order = np.argsort(t)
+            on_axis[:, k] = np.interp(time_axis, t[order], y[order], left=np.nan, right=np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bands = np.nanpercentile(on_axis, list(q), axis=1)
+        return pd.DataFrame({'time': time_axis, **{f'{qk:g}%': b for qk, b in zip(q, bands)}})
+
+
+def monte_carlo(table, quantities=None, draws=10000, rel_error=0., ages=None, calibration_error=True,
+                calibration_sd=None, seed=None):
+    """ Monte Carlo distribution of GDGT indices and calibrated temperatures
+
+    Parameters
+    ----------
+
+    table : pandas.DataFrame
+        One row per sample, a column per compound (e.g. allGDGT_df) and a
+        'depth' column
+
+    quantities : list of str
+        Registered indices and calibrations to evaluate (all by default)
+
+    draws : int
+        Number of Monte Carlo draws
+
+    rel_error : float, dict or 2D array
+        Relative standard error of the measured abundances: one value, one
+        per compound, or a (samples x compounds) array in table column order
+
+    ages : 2D array
+        Age realizations at the sample depths (samples x realizations), e.g.
+        AgeEnsemble.at(table['depth']); one is drawn per Monte Carlo draw
+
+    calibration_error : bool
+        Sample the calibration coefficients and residuals; warns for a
+        calibration with neither registered nor given errors
+
+    calibration_sd : dict
+        Calibration residual standard error (float) or (coef_sd, rmse) per
+        calibration name, overriding the registered values
+
+    seed : int or numpy.random.Generator
+
+    Returns
+    -------
+
+    result : MonteCarloResult
+
+    """
+    rng = np.random.default_rng(seed)
+    quantities = list(INDICES) + list(CALIBRATIONS) if quantities is None else list(quantities)
+    calibration_sd = calibration_sd or {}
+    compounds = [c for c in BR_GDGTS + ISO_GDGTS if c in table.columns]
+    measured = table[compounds].to_numpy(dtype=float)  # samples x compounds
+    n = len(measured)
+
+    if isinstance(rel_error, dict):
+        rel_error = [rel_error.get(c, 0.) for c in compounds]
+    sd = np.broadcast_to(np.asarray(rel_error, dtype=float), measured.shape)
+
+    calibrations = {}
+    for name in quantities:
+        if name in CALIBRATIONS:
+            cal = CALIBRATIONS[name]
+            coef_sd, rmse = cal.coef_sd, cal.rmse
+            if name in calibration_sd:
+                given = calibration_sd[name]
+                coef_sd, rmse = given if isinstance(given, tuple) else (coef_sd, given)
+            if calibration_error and coef_sd is None and not rmse:
+                warnings.warn(f'Calibration {name!r} has no coefficient or residual errors; pass them in '
+                              'calibration_sd to sample its calibration error', UserWarning, stacklevel=2)
+            calibrations[name] = (cal, coef_sd, rmse)
+        elif name not in INDICES:
+            raise KeyError(f'No index or calibration {name!r}')
+
+    values = {name: np.empty((n, draws)) for name in quantities}
+    block = max(1, _BLOCK_VALUES // max(n * len(compounds), 1))
+    for start in range(0, draws, block):
+        stop = min(start + block, draws)
+        m = stop - start
+        z = rng.standard_normal((n, m, len(compounds)))
+        # lognormal, unbiased and positive; zero abundances stay zero
+        sampled = measured[:, None, :] * np.exp(sd[:, None, :] * z - 0.5 * sd[:, None, :] ** 2)
+        x = Abundances({c: sampled[:, :, k] for k, c in enumerate(compounds)})
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name in quantities:
+                if name in calibrations:
+                    cal, coef_sd, rmse = calibrations[name]
+                    coefs = cal.coefficients[:, None]
+                    if calibration_error and coef_sd is not None:
+                        coefs = coefs + np.asarray(coef_sd, dtype=float)[:, None] * rng.standard_normal((len(coefs), m))
+                    out = cal(x, coefs)
+                    if calibration_error and rmse:
+                        out = out + rmse * rng.standard_normal((n, m))
+                else:
+                    out = x[name]
+                values[name][:, start:stop] = np.where(np.isinf(out), np.nan, out)
+
+    age = None
+    if ages is not None:
+        ages = np.asarray(ages, dtype=float)
+        if len(ages) != n:
+            raise ValueError('ages needs one row per sample')
+        age = ages[:, rng.integers(ages.shape[1], size=draws)]
+    return MonteCarloResult(np.asarray(table['depth'], dtype=float), age, values)
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+LiPD helpers for the Imandra biomarker notebooks.
+
+getlipd returns the age ensemble of one paleoData variable mapped onto its
+depths (an age_ensemble.LazyEnsembleSeries, used like a
+pyleoclim.EnsembleSeries) and a depth / ageMedian / value table.
+Loading a .lpd archive, building its ensemble tables and flattening it to a
+timeseries table is by far the slowest part of a call, so the work is done
+once per archive by a LiPDSession: the timeseries are indexed by
+paleoData_variableName, the ensemble tables are kept, and every further
+variable from the same archive is served from memory. With a cache
+directory, the parsed tables are also pickled to disk under the archive's MD5
+checksum, so a kernel restart does not parse the archive again, and a
+changed archive is never served from a stale cache. With engine='zip' the
+archives are read by lpd_reader.LpdArchive straight from the zip instead of
+through pylipd, which is much faster and reads only the tables asked for.
+
+Examples
+--------
+
+>>> session = LiPDSession(engine='zip')
+>>> c20_area_ens, c20_area = session.getlipd('Imandra.Holtzman.2024.lpd', 'C20area',
+...                                          depth_name='midpointdepth', val_unit='percent')
+>>> waxes = session.getlipd_many('Imandra.Holtzman.2024.lpd', ['C20area', 'C22area'],
+...                              depth_name='midpointdepth', val_unit='percent')
+>>> brGDGT_df = session.table('Imandra.Holtzman.2024.lpd', proxy_table.BR_GDGT_VARIABLES,
+...                           depth_name='midpointdepth')
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import proxy_table
+from age_ensemble import AgeEnsemble
+from lpd_reader import LpdArchive
+
+try:
+    from pylipd.lipd import LiPD
+except ImportError:
+    LiPD = None
+
+
+def mapAgeEnsembleToPaleoData(ensembleValues, paleoValues, ensembleDepth, paleoDepth,
+                             value_name = None,value_unit = None,time_name = None,time_unit = None):
+    """ Map the depth for the ensemble age values to the paleo values
+
+    Parameters
+    ----------
+
+    ensembleValues : array
+        A matrix of possible age models. Realizations
+        should be stored in columns
+
+    paleoValues : 1D array
+        A vector containing the paleo data values. The vector
+        should have the same length as depthPaleo
+
+    ensembleDepth : 1D array
+        A vector of depth. The vector should have the same
+        length as the number of rows in the ensembleValues
+
+    paleoDepth : 1D array
+        A vector corresponding to the depth at which there
+        are paleodata information
+
+    value_name : str
+        Paleo data value name
+
+    value_unit : str
+        Paleo data value unit
+
+    time_name : str
+        Time name
+
+    time_unit : str
+        Time unit
+
+    Returns
+    -------
+
+    ensemble : age_ensemble.LazyEnsembleSeries
+        A matrix of age ensemble on the PaleoData scale, used like
+        a pyleoclim.EnsembleSeries
+
+    """
+
+    # All realizations share ensembleDepth, so they are interpolated in one pass,
+    # and the per-realization Series are only built when the ensemble is used
+    ages = AgeEnsemble(ensembleDepth, ensembleValues, time_name=time_name, time_unit=time_unit)
+    return ages.map(paleoDepth, paleoValues, value_name=value_name, value_unit=value_unit)
+
+
+def archive_checksum(filename, blocksize=1 << 20):
+    """ MD5 hex digest of a .lpd archive """
+    h = hashlib.md5()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _parse_pylipd(filename):
+    """ Ensemble tables and timeseries table of an archive, via pylipd """
+    if LiPD is None:
+        raise ImportError('Reading .lpd archives requires pylipd')
+    D = LiPD()
+    D.load(filename)
+    ensemble_df = D.get_ensemble_tables()
+    timeseries, df = D.get_timeseries(D.get_all_dataset_names(), to_dataframe=True)
+    return ensemble_df, df
+
+
+class LiPDRecord:
+    """ Parsed .lpd archive
+
+    Parameters
+    ----------
+
+    ensemble_df : pandas.DataFrame
+        Ensemble tables, as from LiPD.get_ensemble_tables()
+
+    timeseries : pandas.DataFrame
+        One row per paleoData variable, as from LiPD.get_timeseries(...,
+        to_dataframe=True)
+
+    checksum : str
+        MD5 of the archive the tables come from
+
+    """
+
+    def __init__(self, ensemble_df, timeseries, checksum=None):
+        self.ensemble_df = ensemble_df
+        self.timeseries = timeseries
+        self.checksum = checksum
+        self._rows = {}
+        for k, name in enumerate(timeseries['paleoData_variableName']):
+            self._rows.setdefault(name, []).append(k)
+        self._ensembles = {}
+
+    @property
+    def variables(self):
+        return list(self._rows)
+
+    def row(self, paleoData_variableName):
+        """ Timeseries row of a variable """
+        rows = self._rows.get(paleoData_variableName)
+        if rows is None:
+            raise KeyError(f'No paleoData variable {paleoData_variableName!r}')
+        if len(rows) > 1:
+            raise ValueError(f'{len(rows)} paleoData variables are named {paleoData_variableName!r}')
+        return self.timeseries.iloc[rows[0]]
+
+    def age_axis(self, paleoData_variableName, depth_name, ageMedian_name='ageMedian'):
+        """ Depth, median age and values of a variable as a DataFrame """
+        row = self.row(paleoData_variableName)
+        return pd.DataFrame({'depth': np.array(row[depth_name]),
+                             'ageMedian': np.array(row[ageMedian_name]),
+                             'paleoData_values': np.array(row['paleoData_values'])})
+
+    def ensemble_table(self, ens_num=0):
+        """ Age ensemble table, converted to arrays once
+
+        Returns
+        -------
+
+        depth : 1D array
+            Depths of the ensemble rows
+
+        values : 2D array
+            Age realizations in columns
+
+        time_unit : str
+            Ensemble variable name and units, e.g. 'age yr BP'
+
+        """
+        if ens_num not in self._ensembles:
+            table = self.ensemble_df.iloc[ens_num]
+            self._ensembles[ens_num] = (
+                np.squeeze(np.asarray(table['ensembleDepthValues'], dtype=float)),
+                np.asarray(table['ensembleVariableValues'], dtype=float),
+                f'{table["ensembleVariableName"]} {table["ensembleVariableUnits"]}')
+        return self._ensembles[ens_num]
+
+
+class LiPDSession:
+    """ Serve getlipd calls from archives parsed once
+
+    Parameters
+    ----------
+
+    cache_dir : str
+        Directory for pickled parsed archives, created if missing; None
+        keeps them in memory only. Only used by the pylipd engine
+
+    verbose : bool
+        Print the ensemble tables when an archive is parsed by pylipd, as
+        getlipd always did
+
+    engine : {'pylipd', 'zip'}
+        Parse archives with pylipd, or read them directly with
+        lpd_reader.LpdArchive
+
+    verify : bool
+        Check archives against their manifest-md5.txt ('zip' engine)
+
+    """
+
+    def __init__(self, cache_dir=None, verbose=True, engine='pylipd', verify=False):
+        if engine not in ('pylipd', 'zip'):
+            raise ValueError(f"engine must be 'pylipd' or 'zip', not {engine!r}")
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.engine = engine
+        self.verify = verify
+        self._records = {}
+        self._ages = {}
+
+    def _cachefile(self, filename, checksum):
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cache_dir, f'{stem}-{checksum}.pkl')
+
+    def load(self, filename):
+        """ Parsed archive, from memory, the disk cache or the archive itself
+
+        Parameters
+        ----------
+
+        filename : str
+            Path of the .lpd archive
+
+        Returns
+        -------
+
+        record : LiPDRecord or lpd_reader.LpdArchive
+
+        """
+        key = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = (st.st_size, st.st_mtime_ns)
+        hit = self._records.get(key)
+        if hit is not None and hit[0] == stamp:
+            return hit[1]
+
+        if self.engine == 'zip':
+            record = LpdArchive(filename, verify=self.verify)
+            self._records[key] = (stamp, record)
+            return record
+
+        checksum = archive_checksum(filename)
+        tables = None
+        if self.cache_dir:
+            cachefile = self._cachefile(filename, checksum)
+            try:
+                with open(cachefile, 'rb') as fh:
+                    tables = pickle.load(fh)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                tables = None
+        if tables is None:
+            tables = _parse_pylipd(filename)
+            if self.verbose:
+                pd.set_option('display.max_columns', None)
+                print(tables[0])
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = cachefile + '.part'
+                with open(tmp, 'wb') as fh:
+                    pickle.dump(tables, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, cachefile)
+
+        record = LiPDRecord(*tables, checksum=checksum)
+        self._records[key] = (stamp, record)
+        return record
+
+    def clear(self):
+        """ Forget the archives held in memory (the disk cache is kept) """
+        self._records.clear()
+        self._ages.clear()
+
+    def age_ensemble(self, filename, ens_num=0):
+        """ Age ensemble of an archive, shared by all its variables
+
+        Returns
+        -------
+
+        ages : age_ensemble.AgeEnsemble
+
+        """
+        record = self.load(filename)
+        key = (os.path.abspath(filename), ens_num)
+        hit = self._ages.get(key)
+        if hit is None or hit[0] is not record:
+            depth, values, time_unit = record.ensemble_table(ens_num)
+            hit = self._ages[key] = (record, AgeEnsemble(depth, values, time_name='Time', time_unit=time_unit))
+        return hit[1]
+
+    def getlipd(self, filename, paleoData_variableName, depth_name, val_unit, ens_num=0,
+                ageMedian_name='ageMedian'):
+        """ Age ensemble and age axis of one paleoData variable
+
+        Parameters
+        ----------
+
+        filename : str
+            Name of the LiPD file
+
+        paleoData_variableName : str
+            Column name of the variable being imported
+
+        depth_name : str
+            Column name of the depth variable of the variable's table
+
+        val_unit : str
+            Unit of the variable
+
+        ens_num : int
+            Index of the ensemble table
+
+        ageMedian_name : str
+            Column name of the median age
+
+        Returns
+        -------
+
+        ensemble : age_ensemble.LazyEnsembleSeries
+            Age ensemble mapped to the variable's depths; variables
+            sampled at the same depths share one age matrix
+
+        age_axis : pandas.DataFrame
+            Columns depth, ageMedian and paleoData_values
+
+        """
+        record = self.load(filename)
+        age_axis = record.age_axis(paleoData_variableName, depth_name, ageMedian_name)
+        ensemble = self.age_ensemble(filename, ens_num).map(age_axis['depth'].values,
+                                                            age_axis['paleoData_values'].values,
+                                                            value_name=paleoData_variableName, value_unit=val_unit)
+        return ensemble, age_axis
+
+    def getlipd_many(self, filename, paleoData_variableNames, depth_name, val_unit, ens_num=0,
+                     ageMedian_name='ageMedian'):
+        """ getlipd for several variables of one archive
+
+        Parameters
+        ----------
+
+        filename : str
+
+        paleoData_variableNames : list of str
+
+        depth_name, val_unit, ageMedian_name : str or dict
+            As for getlipd; a dict gives the value per variable name
+
+        ens_num : int
+
+        Returns
+        -------
+
+        results : dict
+            (ensemble, age_axis) per variable name, in the order given
+
+        """
+        def pick(option, name):
+            return option[name] if isinstance(option, dict) else option
+
+        return {name: self.getlipd(filename, name, pick(depth_name, name), pick(val_unit, name), ens_num,
+                                   pick(ageMedian_name, name))
+                for name in paleoData_variableNames}
+
+    def table(self, filename, variables, depth_name, ageMedian_name='ageMedian', dedup='first', how='inner'):
+        """ Several variables of one archive aligned on a shared depth index
+
+        Replaces getlipd per variable, drop_duplicates and the pairwise
+        merges on depth and ageMedian; the variables are matched on depth
+        only and the rows sorted by depth (see proxy_table.align).
+
+        Parameters
+        ----------
+
+        filename : str
+
+        variables : dict or list of str
+            paleoData_variableName per column name of the table, e.g.
+            proxy_table.BR_GDGT_VARIABLES
+
+        depth_name, ageMedian_name : str or dict
+            As for getlipd; a dict gives the value per variable name
+
+        dedup : {'first', 'last', 'mean', 'error'}
+            Handling of repeated depths, see proxy_table.align
+
+        how : {'inner', 'outer'}
+            Keep the depths shared by all variables, or every depth
+
+        Returns
+        -------
+
+        table : pandas.DataFrame
+            Columns depth, ageMedian and one per variable
+
+        """
+        return proxy_table.from_record(self.load(filename), variables, depth_name, ageMedian_name,
+                                       dedup=dedup, how=how)
+
+
+_session = LiPDSession()
+
+
+def getlipd(filename, paleoData_variableName, depth_name, val_unit, ens_num=0, ageMedian_name='ageMedian'):
+    """ LiPDSession.getlipd on a module-wide session (archives are parsed once per kernel) """
+    return _session.getlipd(filename, paleoData_variableName, depth_name, val_unit, ens_num, ageMedian_name)
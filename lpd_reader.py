@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Direct reader for .lpd archives.
+
+A .lpd file is a BagIt zip holding one JSON-LD metadata file and one CSV
+file per data table. LpdArchive parses the metadata when it is opened and
+decompresses a CSV table, into NumPy arrays, only the first time one of its
+columns is asked for, so a query touches the members it needs and nothing
+else; pylipd's RDF graph is not built at all. Checking the members against
+the bag's manifest-md5.txt is optional and done by a pool of threads.
+
+An LpdArchive answers the same age_axis / ensemble_table queries as a
+lipd_utils.LiPDRecord, so it can stand in for one in a LiPDSession
+(engine='zip').
+
+Variables are named as in pylipd's timeseries tables: the variableName of a
+column, followed by '.' and its ProxyObservationType when it has one (e.g.
+'MS.Magnetic susceptibility', 'pinus.Floral'). The bare variableName is
+accepted as well when it is unambiguous.
+"""
+
+import hashlib
+import io
+import json
+import posixpath
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def variable_name(column):
+    """ paleoData_variableName of a column's metadata """
+    name = column['variableName']
+    if column.get('ProxyObservationType'):
+        name = f'{name}.{column["ProxyObservationType"]}'
+    return name
+
+
+def column_numbers(column):
+    """ Zero-based CSV column indices of a column's metadata (several for an ensemble) """
+    number = column['number']
+    if isinstance(number, str):
+        number = json.loads(number)
+    return [int(n) - 1 for n in np.atleast_1d(number)]
+
+
+def _tables(sections, kind):
+    """ Tables of one kind from paleoData or chronData, in file order """
+    tables = []
+    for section in sections:
+        if kind == 'ensembleTable':
+            for model in section.get('model', []):
+                tables.extend(model.get(kind, []))
+        else:
+            tables.extend(section.get(kind, []))
+    return tables
+
+
+def _member_md5(path, member, blocksize=1 << 20):
+    h = hashlib.md5()
+    with zipfile.ZipFile(path) as z, z.open(member) as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class LpdArchive:
+    """ Lazily read .lpd archive
+
+    Parameters
+    ----------
+
+    path : str
+        Path of the .lpd file
+
+    verify : bool
+        Check every member against manifest-md5.txt when opening
+
+    workers : int
+        Threads used by the check (None: executor default)
+
+    Raises
+    ------
+
+    ValueError
+        If the archive has no JSON-LD metadata, or if ``verify`` is set and
+        some members do not match the manifest
+
+    """
+
+    def __init__(self, path, verify=False, workers=None):
+        self.path = path
+        with zipfile.ZipFile(path) as z:
+            self._names = z.namelist()
+            jsonld = [n for n in self._names if n.endswith('.jsonld')]
+            if not jsonld:
+                raise ValueError(f'{path}: no JSON-LD metadata in the archive')
+            self.metadata = json.loads(z.read(jsonld[0]).decode('utf-8'))
+        self._members = {posixpath.basename(n): n for n in self._names if n.endswith('.csv')}
+        self._frames = {}
+        self._ensembles = {}
+
+        self.paleo_tables = _tables(self.metadata.get('paleoData', []), 'measurementTable')
+        self.ensemble_tables = _tables(self.metadata.get('chronData', []), 'ensembleTable')
+        self._by_name = {}
+        self._by_plain = {}
+        for table in self.paleo_tables:
+            for column in table['columns']:
+                self._by_name.setdefault(variable_name(column), []).append((table, column))
+                self._by_plain.setdefault(column['variableName'], []).append((table, column))
+
+        if verify:
+            bad = self.verify(workers)
+            if bad:
+                raise ValueError(f'{path}: {len(bad)} members do not match the manifest ({", ".join(bad)})')
+
+    @property
+    def variables(self):
+        return list(self._by_name)
+
+    def verify(self, workers=None):
+        """ Members that are missing or whose MD5 differs from manifest-md5.txt
+
+        Returns
+        -------
+
+        bad : list of str
+            Paths as written in the manifest; empty if the archive is intact
+
+        """
+        manifest = [n for n in self._names if posixpath.basename(n) == 'manifest-md5.txt']
+        if not manifest:
+            raise ValueError(f'{self.path}: no manifest-md5.txt in the archive')
+        root = posixpath.dirname(manifest[0])
+        with zipfile.ZipFile(self.path) as z:
+            lines = z.read(manifest[0]).decode('utf-8').splitlines()
+        expected = {}
+        for line in lines:
+            fields = line.split(None, 1)
+            if len(fields) == 2:  # some writers add lines with a digest only
+                expected[fields[1].strip()] = fields[0].lower()
+        members = set(self._names)
+        bad = [p for p in expected if posixpath.join(root, p) not in members]
+        todo = [p for p in expected if posixpath.join(root, p) in members]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = pool.map(lambda p: _member_md5(self.path, posixpath.join(root, p)), todo)
+            bad.extend(p for p, md5 in zip(todo, digests) if md5 != expected[p])
+        return sorted(bad)
+
+    def _frame(self, table):
+        """ CSV of a table, decompressed and parsed on first use """
+        filename = table['filename']
+        if filename not in self._frames:
+            member = self._members.get(posixpath.basename(filename))
+            if member is None:
+                raise KeyError(f'{self.path}: no member {filename}')
+            with zipfile.ZipFile(self.path) as z:
+                raw = z.read(member)
+            missing = table.get('missingValue')
+            self._frames[filename] = pd.read_csv(io.BytesIO(raw), header=None,
+                                                 na_values=[missing] if missing else None)
+        return self._frames[filename]
+
+    def values(self, table, column):
+        """ Values of one column of a table as an array """
+        frame = self._frame(table)
+        values = frame.iloc[:, column_numbers(column)[0]].to_numpy()
+        if values.dtype == object:
+            try:
+                return values.astype(float)
+            except (TypeError, ValueError):
+                return values
+        return values
+
+    def find(self, paleoData_variableName, table=None):
+        """ Table and column metadata of a paleoData variable
+
+        ``table`` (index into paleo_tables) picks one of several variables
+        with the same name.
+        """
+        hits = self._by_name.get(paleoData_variableName) or self._by_plain.get(paleoData_variableName)
+        if hits and table is not None:
+            hits = [hit for hit in hits if hit[0] is self.paleo_tables[table]]
+        if not hits:
+            raise KeyError(f'No paleoData variable {paleoData_variableName!r}')
+        if len(hits) > 1:
+            raise ValueError(f'{len(hits)} paleoData variables are named {paleoData_variableName!r}')
+        return hits[0]
+
+    def _table_column(self, table, name):
+        """ First column of a table with the given variableName (e.g. its depth or age) """
+        for column in table['columns']:
+            if column['variableName'] == name or variable_name(column) == name:
+                return column
+        raise KeyError(f'No column {name!r} in table {table.get("tableName")!r}')
+
+    def age_axis(self, paleoData_variableName, depth_name, ageMedian_name='ageMedian', table=None):
+        """ Depth, median age and values of a variable as a DataFrame
+
+        The depth and age columns are taken from the variable's own table.
+        """
+        table, column = self.find(paleoData_variableName, table)
+        return pd.DataFrame({'depth': self.values(table, self._table_column(table, depth_name)),
+                             'ageMedian': self.values(table, self._table_column(table, ageMedian_name)),
+                             'paleoData_values': self.values(table, column)})
+
+    def ensemble_table(self, ens_num=0):
+        """ Age ensemble table as arrays
+
+        Returns
+        -------
+
+        depth : 1D array
+            Depths of the ensemble rows
+
+        values : 2D array
+            Age realizations in columns
+
+        time_unit : str
+            Ensemble variable name and units, e.g. 'ageEnsemble yr BP'
+
+        """
+        if ens_num not in self._ensembles:
+            table = self.ensemble_tables[ens_num]
+            columns = table['columns']
+            ens = max(columns, key=lambda c: len(column_numbers(c)))
+            depth = next((c for c in columns if c['variableName'] == 'depth'),
+                         next(c for c in columns if c is not ens))
+            frame = self._frame(table)
+            self._ensembles[ens_num] = (
+                frame.iloc[:, column_numbers(depth)[0]].to_numpy(dtype=float),
+                frame.iloc[:, column_numbers(ens)].to_numpy(dtype=float),
+                f'{ens["variableName"]} {ens.get("units", "")}'.strip())
+        return self._ensembles[ens_num]
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Depth-aligned multi-proxy tables.
+
+The notebooks build wax_df, brGDGT_df, isoGDGT_df and allGDGT_df by
+dropping duplicate depths from every proxy and merging the proxies pairwise
+on depth and ageMedian, renaming the suffixed paleoData_values columns
+afterwards. align builds such a table in one pass: the depths of all
+proxies are put on one sorted index, duplicates are resolved by an explicit
+policy, and the values are scattered into a single float matrix, so the
+resulting DataFrame is one contiguous block with one column per proxy, named
+as the caller chose. normalize, acl and cpi then work on its columns in
+place.
+
+Unlike the merges, align matches the proxies on depth only (see align), so
+its tables can differ from the merged ones in row order and in rows.
+
+Examples
+--------
+
+>>> brGDGT_df = session.table('Imandra.Holtzman.2024.lpd', BR_GDGT_VARIABLES,
+...                           depth_name='midpointdepth')
+>>> brGDGT_df_norm = normalize(brGDGT_df, list(BR_GDGT_VARIABLES))
+>>> wax_df['ACL'] = acl(wax_df, ['C20', 'C22', 'C24', 'C26', 'C28', 'C30'])
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# Column name -> paleoData_variableName in the Imandra archive
+WAX_AREAS = {f'C{n}': f'C{n}area' for n in range(20, 33)}
+WAX_CONCENTRATIONS = {f'C{n}conc': f'c{n}concentration' for n in range(20, 31, 2)}
+BR_GDGT_VARIABLES = {'Ia': 'brGDGT-Ia', 'Ib': 'brGDGT-Ib', 'Ic': 'brGDGT-Ic',
+                     'IIa5': 'brGDGT-IIa5me', 'IIa6': 'brGDGT-IIa6me', 'IIb5': 'brGDGT-IIb5me',
+                     'IIb6': 'brGDGT-IIb6me', 'IIc5': 'brGDGT-IIc5me', 'IIc6': 'brGDGT-IIc6me',
+                     'IIIa5': 'brGDGT-IIIa5me', 'IIIa6': 'brGDGT-IIIa6me', 'IIIb5': 'brGDGT-IIIb5me',
+                     'IIIb6': 'brGDGT-IIIb6me', 'IIIc5': 'brGDGT-IIIc5me', 'IIIc6': 'brGDGT-IIIc6me'}
+ISO_GDGT_VARIABLES = {'iso0': 'GDGT-0', 'iso1': 'GDGT-1', 'iso2': 'GDGT-2', 'iso3': 'GDGT-3',
+                      'cren': 'Cren', 'crenreg': "Cren'"}
+
+DEDUP_POLICIES = ('first', 'last', 'mean', 'error')
+
+
+def align(frames, dedup='first', how='inner'):
+    """ Put several depth / ageMedian / paleoData_values tables on one depth index
+
+    Rows of different proxies are matched on depth only, not on depth and
+    ageMedian as the pairwise merges were: proxies whose ageMedian differs at
+    a shared depth still share a row, and its ageMedian is the one of the
+    first proxy (in ``frames`` order) with a row there. Rows without a depth
+    are dropped and the rows are sorted by depth, whereas the merges kept the
+    order of the first table and carried a row without a depth along.
+
+    Parameters
+    ----------
+
+    frames : dict
+        age_axis DataFrame (as returned by getlipd) per output column name
+
+    dedup : {'first', 'last', 'mean', 'error'}
+        Value kept when a proxy has several rows at one depth: the first or
+        last of them (drop_duplicates(keep=...)), the mean of the non-NaN
+        ones (replicate measurements), or raise a ValueError
+
+    how : {'inner', 'outer'}
+        Keep only the depths where every proxy has a row, as the pairwise
+        merges did, or all depths, with NaN where a proxy has none
+
+    Returns
+    -------
+
+    table : pandas.DataFrame
+        Columns depth, ageMedian and one per frame, sorted by depth
+
+    """
+    if dedup not in DEDUP_POLICIES:
+        raise ValueError(f'dedup must be one of {DEDUP_POLICIES}, not {dedup!r}')
+    if how not in ('inner', 'outer'):
+        raise ValueError(f"how must be 'inner' or 'outer', not {how!r}")
+    names = list(frames)
+    depth = [np.asarray(frames[n]['depth'], dtype=float) for n in names]
+    age = np.concatenate([np.asarray(frames[n]['ageMedian'], dtype=float) for n in names])
+    value = np.concatenate([np.asarray(frames[n]['paleoData_values'], dtype=float) for n in names])
+    column = np.repeat(np.arange(len(names)), [len(d) for d in depth])
+    depth = np.concatenate(depth)
+
+    keep = ~np.isnan(depth)
+    depth, age, value, column = depth[keep], age[keep], value[keep], column[keep]
+    grid, row = np.unique(depth, return_inverse=True)
+    cell = row * len(names) + column
+
+    matrix = np.full((len(grid), len(names)), np.nan)
+    if dedup == 'mean':
+        cells, inverse = np.unique(cell, return_inverse=True)
+        ok = ~np.isnan(value)
+        total = np.bincount(inverse, weights=np.where(ok, value, 0.), minlength=len(cells))
+        count = np.bincount(inverse, weights=ok, minlength=len(cells))
+        with np.errstate(invalid='ignore'):
+            matrix.flat[cells] = np.where(count > 0, total / count, np.nan)
+    else:
+        order = np.arange(len(cell))[::-1] if dedup == 'last' else np.arange(len(cell))
+        cells, first = np.unique(cell[order], return_index=True)
+        if dedup == 'error' and len(cells) < len(cell):
+            counts = np.bincount(cell, minlength=matrix.size).reshape(matrix.shape)
+            dup = np.nonzero(counts > 1)
+            raise ValueError('Duplicate depths: ' + ', '.join(
+                f'{names[j]} at {grid[i]:g}' for i, j in zip(*dup)))
+        matrix.flat[cells] = value[order[first]]
+
+    present = np.zeros(matrix.shape, dtype=bool)
+    present.flat[cells] = True
+    _, first_row = np.unique(row, return_index=True)
+    ages = age[first_row]
+    rows = present.all(axis=1) if how == 'inner' else slice(None)
+
+    block = np.column_stack([grid[rows], ages[rows], matrix[rows]])
+    return pd.DataFrame(block, columns=['depth', 'ageMedian'] + names)
+
+
+def from_record(record, variables, depth_name, ageMedian_name='ageMedian', dedup='first', how='inner'):
+    """ Depth-aligned table of several variables of one parsed archive
+
+    Parameters
+    ----------
+
+    record : lipd_utils.LiPDRecord or lpd_reader.LpdArchive
+
+    variables : dict or list of str
+        paleoData_variableName per output column name; a list keeps the
+        variable names as column names
+
+    depth_name, ageMedian_name : str or dict
+        As for getlipd; a dict gives the value per variable name
+
+    dedup, how : str
+        See align
+
+    Returns
+    -------
+
+    table : pandas.DataFrame
+
+    """
+    if not isinstance(variables, dict):
+        variables = {name: name for name in variables}
+
+    def pick(option, name):
+        return option[name] if isinstance(option, dict) else option
+
+    frames = {column: record.age_axis(name, pick(depth_name, name), pick(ageMedian_name, name))
+              for column, name in variables.items()}
+    return align(frames, dedup=dedup, how=how)
+
+
+def normalize(table, columns, inplace=False):
+    """ Fractional abundances of a group of columns (each row sums to 1)
+
+    Parameters
+    ----------
+
+    table : pandas.DataFrame
+
+    columns : list of str
+
+    inplace : bool
+        Overwrite the columns of table instead of returning a copy
+
+    Returns
+    -------
+
+    table : pandas.DataFrame
+        The normalized table (table itself if inplace)
+
+    """
+    values = np.array(table[columns], dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values /= np.nansum(values, axis=1, keepdims=True)
+    if not inplace:
+        table = table.copy()
+    table[columns] = values
+    return table
+
+
+def _chain_length(column):
+    match = re.search(r'\d+', column)
+    if match is None:
+        raise ValueError(f'No chain length in column name {column!r}')
+    return int(match.group())
+
+
+def acl(table, columns, lengths=None):
+    """ Average chain length of the given homologues
+
+    Parameters
+    ----------
+
+    table : pandas.DataFrame
+
+    columns : list of str
+        Homologue columns, e.g. ['C20', 'C22', ..., 'C30']
+
+    lengths : list of int
+        Carbon numbers of the columns; read from the column names if None
+
+    Returns
+    -------
+
+    acl : pandas.Series
+
+    """
+    if lengths is None:
+        lengths = [_chain_length(c) for c in columns]
+    values = table[columns].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (values * np.asarray(lengths, dtype=float)).sum(axis=1) / np.nansum(values, axis=1)
+    return pd.Series(out, index=table.index)
+
+
+def cpi(table, odds, small_evens, large_evens):
+    """ Carbon preference index, 0.5 * (sum(small_evens) + sum(large_evens)) / sum(odds)
+
+    Returns
+    -------
+
+    cpi : pandas.Series
+
+    """
+    def total(columns):
+        return np.nansum(table[columns].to_numpy(dtype=float), axis=1)
+
+    odd = total(odds)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = 0.5 * (total(small_evens) / odd + total(large_evens) / odd)
+    return pd.Series(out, index=table.index)